@@ -1,4 +1,6 @@
+import atexit
 import collections
+import os
 import typing
 
 from settei import config_property, Configuration
@@ -26,6 +28,18 @@ class App(Configuration):
         'web.secret_key', str
     )
 
+    web_event_keepalive = config_property(
+        'web.event_keepalive', typing.Union[int, float], default=15
+    )
+
+    web_event_queue_size = config_property(
+        'web.event_queue_size', int, default=16
+    )
+
+    web_tree_cache_size = config_property(
+        'web.tree_cache_size', int, default=256
+    )
+
     game_round_time = config_property(
         'game.duration', int, default=30
     )
@@ -62,6 +76,126 @@ class App(Configuration):
         'game.p2_initial_position', int, default=3
     )
 
+    game_turn_timeout = config_property(
+        'game.turn_timeout', typing.Union[int, float], default=1.0
+    )
+
+    game_match_timeout = config_property(
+        'game.match_timeout', typing.Union[int, float], default=10.0
+    )
+
+    game_protocol = config_property(
+        'game.protocol', int, default=1
+    )
+
+    game_concurrent_turns = config_property(
+        'game.concurrent_turns', bool, default=False
+    )
+
+    game_match_storage = config_property(
+        'game.match_storage', str, default='full'
+    )
+
+    game_pool_size = config_property(
+        'game.pool_size', int, default=32
+    )
+
+    game_pool_max_uses = config_property(
+        'game.pool_max_uses', int, default=64
+    )
+
+    game_concurrency = config_property(
+        'game.concurrency', int, default=os.cpu_count() or 1
+    )
+
+    game_cpu_limit = config_property(
+        'game.cpu_limit', typing.Union[int, float], default=None
+    )
+
+    game_memory_limit = config_property(
+        'game.memory_limit', int, default=None
+    )
+
+    game_file_limit = config_property(
+        'game.file_limit', int, default=None
+    )
+
+    game_bytecode_cache_dir = config_property(
+        'game.bytecode_cache_dir', str, default=None
+    )
+
+    game_zygote = config_property(
+        'game.zygote', bool, default=False
+    )
+
+    game_engine = config_property(
+        'game.engine', str, default='reference'
+    )
+
+    game_fast_forward = config_property(
+        'game.fast_forward', bool, default=False
+    )
+
+    game_league_initial_rating = config_property(
+        'game.league_initial_rating', typing.Union[int, float], default=1500
+    )
+
+    game_league_k_factor = config_property(
+        'game.league_k_factor', typing.Union[int, float], default=32
+    )
+
+    game_league_round_robin_limit = config_property(
+        'game.league_round_robin_limit', int, default=64
+    )
+
+    game_league_swiss_rounds = config_property(
+        'game.league_swiss_rounds', int, default=8
+    )
+
+    game_result_cache_size = config_property(
+        'game.result_cache_size', int, default=1024
+    )
+
+    game_result_cache_samples = config_property(
+        'game.result_cache_samples', int, default=0
+    )
+
+    game_result_cache_seed = config_property(
+        'game.result_cache_seed', int, default=None
+    )
+
+    game_estimate_max_matches = config_property(
+        'game.estimate_max_matches', int, default=1000
+    )
+
+    game_estimate_indifference = config_property(
+        'game.estimate_indifference', typing.Union[int, float], default=0.05
+    )
+
+    game_estimate_error_rate = config_property(
+        'game.estimate_error_rate', typing.Union[int, float], default=0.05
+    )
+
+    game_job_queue = config_property(
+        'game.job_queue', bool, default=False
+    )
+
+    game_worker_processes = config_property(
+        'game.worker_processes', int, default=2
+    )
+
+    game_job_poll_interval = config_property(
+        'game.job_poll_interval', typing.Union[int, float], default=0.5
+    )
+
+    game_job_timeout = config_property(
+        'game.job_timeout', typing.Union[int, float], default=300
+    )
+
+    game_job_heartbeat_interval = config_property(
+        'game.job_heartbeat_interval', typing.Union[int, float], default=30
+    )
+
     sentry_dsn = config_property(
         'sentry.dsn', str, default=None
     )
@@ -78,6 +212,16 @@ class App(Configuration):
     def game_hit_point_guard_range(self) -> typing.Tuple[int]:
         return (self.game_hit_point_guard_min, self.game_hit_point_guard_max)
 
+    @property
+    def runner_environment(self) -> typing.Optional[typing.Mapping[str, str]]:
+        """The environment of script runners.  If ``game.result_cache_seed``
+        is set, their hash seed is fixed as well, so that a script which
+        iterates over a set of strings does the same in every runner."""
+        if self.game_result_cache_seed is None:
+            return None
+        return dict(os.environ,
+                    PYTHONHASHSEED=str(self.game_result_cache_seed % 2 ** 32))
+
     @cached_property
     def database_engine(self) -> Engine:
         url = self.database_url
@@ -85,10 +229,52 @@ class App(Configuration):
         db_options.pop('url', None)
         return create_engine(url, **db_options)
 
+    @cached_property
+    def game_rules(self):
+        from .rules import GameRules
+        return GameRules.from_app(self)
+
+    @cached_property
+    def runner_pool(self):
+        from .pool import RunnerPool
+        pool = RunnerPool(self, self.game_pool_size, self.game_pool_max_uses)
+        atexit.register(pool.close)
+        return pool
+
+    @cached_property
+    def zygote(self):
+        from .zygote import Zygote
+        zygote = Zygote([self.game_evaluator_path],
+                        env=self.runner_environment)
+        atexit.register(zygote.close)
+        return zygote
+
+    @cached_property
+    def result_cache(self):
+        from .cache import ResultCache
+        return ResultCache(self.game_result_cache_size,
+                           self.game_result_cache_samples)
+
+    @cached_property
+    def tree_broker(self):
+        from .broker import TreeBroker
+        return TreeBroker(self.web_event_queue_size)
+
+    @cached_property
+    def tree_cache(self):
+        from .tree import TreeCache
+        return TreeCache(self.web_tree_cache_size)
+
+    @cached_property
+    def group_name_cache(self):
+        from .util import GroupNameCache
+        return GroupNameCache()
+
     def create_session(self, bind=None) -> Session:
         if bind is None:
             bind = self.database_engine
-        return Session(bind=bind)
+        return Session(bind=bind,
+                       info={'group_name_cache': self.group_name_cache})
 
     @cached_property
     def web_config(self) -> collections.abc.Mapping:
@@ -0,0 +1,305 @@
+"""Batch simulator which plays many matches at once with NumPy.
+
+It only works with agents whose actions can be computed without a
+subprocess (see :func:`policy_for`) and follows the same rules as
+:func:`~.game.evaluate`, so it can be used to tune the ``game.*``
+configuration or to check baselines quickly.  NumPy is required, which
+the web server itself doesn't need::
+
+    $ pip install pycon2018[batch]
+
+The module can still be imported without NumPy (e.g. by
+:func:`~.orm.import_all_modules`), but simulating anything fails.
+
+"""
+import typing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .app import App
+from .game import Action, Agent, FixedAgent, RandomAgent, evaluate
+
+__all__ = ('ACTIONS', 'BatchState', 'FixedPolicy', 'Policy', 'RandomPolicy',
+           'TablePolicy', 'check_equivalence', 'policy_for',
+           'simulate_matches', 'simulate_rounds')
+
+
+#: Actions in the order of their indices in the batch engine.
+ACTIONS = list(Action.__members__.values())
+
+(IDLE, FORWARD, BACKWARD, PUNCH, KICK,
+ CROUCH, JUMP, GUARD) = map(ACTIONS.index, (
+     Action.idle, Action.forward, Action.backward, Action.punch, Action.kick,
+     Action.crouch, Action.jump, Action.guard,
+ ))
+
+#: Winner value of a draw in the arrays returned by the simulator.
+DRAW = -1
+
+HISTORY_LENGTH = 5
+
+
+class BatchState:
+    """The state of ``count`` rounds being played at once.  Arrays with
+    a leading axis of 2 are indexed by player number."""
+
+    def __init__(self, app: App, count: int):
+        self.count = count
+        self.time_left = app.game_round_time
+        self.initial_position = numpy.array([app.game_p1_initial_position,
+                                             app.game_p2_initial_position])
+        self.health = numpy.full((2, count), 100, dtype=numpy.int64)
+        self.position = numpy.repeat(self.initial_position[:, None], count, 1)
+        self.guard_count = numpy.zeros((2, count), dtype=numpy.int64)
+        self.last_action = numpy.full((2, count), -1, dtype=numpy.int64)
+        self.history = numpy.full((2, count, HISTORY_LENGTH), -1,
+                                  dtype=numpy.int64)
+        self.ticks = 0
+        self.active = numpy.ones(count, dtype=bool)
+        self.winner = numpy.full(count, DRAW, dtype=numpy.int64)
+
+    @property
+    def distance(self) -> 'numpy.ndarray':
+        return numpy.abs(self.position[1] - self.position[0])
+
+    def act(self, actions: 'numpy.ndarray'):
+        self.last_action = actions
+        self.history[:, :, self.ticks % HISTORY_LENGTH] = actions
+        self.ticks += 1
+
+    def diversity_multiplier(self, player: int) -> 'numpy.ndarray':
+        multiplier = numpy.ones(self.count)
+        if min(self.ticks, HISTORY_LENGTH) < 3:
+            return multiplier
+        history = self.history[player]
+        unique = numpy.ones(self.count, dtype=numpy.int64)
+        for i in range(1, HISTORY_LENGTH):
+            seen = (history[:, :i] == history[:, i:i + 1]).any(axis=1)
+            unique += (history[:, i] >= 0) & ~seen
+        multiplier[unique == 1] = 1 / 3
+        multiplier[unique == 2] = 2 / 3
+        return multiplier
+
+
+class Policy:
+    """Chooses the actions of one player for every round of a batch."""
+
+    def __call__(self, state: BatchState, player: int,
+                 rng: 'numpy.random.Generator') -> 'numpy.ndarray':
+        raise NotImplementedError
+
+
+class FixedPolicy(Policy):
+
+    def __init__(self, action: Action):
+        self.action = ACTIONS.index(action)
+
+    def __call__(self, state: BatchState, player: int,
+                 rng: 'numpy.random.Generator') -> 'numpy.ndarray':
+        return numpy.full(state.count, self.action, dtype=numpy.int64)
+
+
+class RandomPolicy(Policy):
+
+    def __init__(self, choices: typing.Sequence[Action]=ACTIONS):
+        self.choices = numpy.array([ACTIONS.index(a) for a in choices])
+
+    def __call__(self, state: BatchState, player: int,
+                 rng: 'numpy.random.Generator') -> 'numpy.ndarray':
+        return rng.choice(self.choices, state.count)
+
+
+class TablePolicy(Policy):
+    """Plays ``table[i]`` on the ``i``-th tick of a round, repeating the
+    table if the round outlasts it."""
+
+    def __init__(self, table: typing.Sequence[Action]):
+        self.table = [ACTIONS.index(a) for a in table]
+
+    def __call__(self, state: BatchState, player: int,
+                 rng: 'numpy.random.Generator') -> 'numpy.ndarray':
+        action = self.table[state.ticks % len(self.table)]
+        return numpy.full(state.count, action, dtype=numpy.int64)
+
+
+def default_rng(
+    rng: typing.Optional['numpy.random.Generator']
+) -> 'numpy.random.Generator':
+    if numpy is None:
+        raise ImportError('the batch simulator requires NumPy; install '
+                          'pycon2018[batch]')
+    return numpy.random.default_rng() if rng is None else rng
+
+
+def policy_for(agent: typing.Union[Agent, Policy]) -> Policy:
+    if isinstance(agent, Policy):
+        return agent
+    elif isinstance(agent, FixedAgent):
+        return FixedPolicy(agent.action)
+    elif isinstance(agent, RandomAgent):
+        return RandomPolicy(agent.choices)
+    raise TypeError(f'{agent!r} cannot be simulated in a batch')
+
+
+def attack(app: App, state: BatchState, rng: 'numpy.random.Generator',
+           attacker: int, actions: 'numpy.ndarray'):
+    defender = 1 - attacker
+    attack_action = actions[attacker]
+    defend_action = actions[defender]
+    reachable = state.active & (state.distance == 0)
+    punch = reachable & (attack_action == PUNCH)
+    kick = reachable & (attack_action == KICK)
+    avoided = (
+        (punch & (defend_action == CROUCH)) |
+        (kick & (defend_action == JUMP))
+    )
+    landed = (punch | kick) & ~avoided
+    guarded = landed & (defend_action == GUARD)
+    hit = landed & ~guarded
+    state.guard_count[defender] += 2 * avoided + guarded
+    damage = numpy.zeros(state.count, dtype=numpy.int64)
+    damage[guarded] = rng.integers(*app.game_hit_point_guard_range,
+                                   size=numpy.count_nonzero(guarded))
+    damage[hit] = rng.integers(*app.game_hit_point_range,
+                               size=numpy.count_nonzero(hit))
+    modified = numpy.trunc(
+        damage * state.diversity_multiplier(attacker) *
+        1.25 ** state.guard_count[attacker]
+    ).astype(numpy.int64)
+    health = state.health[defender]
+    health[landed] = numpy.maximum(0, health[landed] - modified[landed])
+    state.guard_count[attacker][landed] = 0
+    knocked_out = state.active & (health <= 0)
+    state.winner[knocked_out] = attacker
+    state.active &= ~knocked_out
+
+
+def simulate_rounds(app: App,
+                    p1: typing.Union[Agent, Policy],
+                    p2: typing.Union[Agent, Policy],
+                    count: int,
+                    rng: typing.Optional['numpy.random.Generator']=None
+                    ) -> 'numpy.ndarray':
+    """Play ``count`` rounds like :func:`~.game.evaluate` and return the
+    winner of each of them: 0, 1 or :const:`DRAW`."""
+    rng = default_rng(rng)
+    policies = policy_for(p1), policy_for(p2)
+    state = BatchState(app, count)
+    position = state.position
+    lower_bound = state.initial_position[0] - 2
+    upper_bound = state.initial_position[1] + 2
+    while state.time_left >= 0 and state.active.any():
+        actions = numpy.stack([policies[0](state, 0, rng),
+                               policies[1](state, 1, rng)])
+        state.act(actions)
+        active = state.active
+        position[0][
+            active & (actions[0] == FORWARD) & (position[1] > position[0])
+        ] += 1
+        position[0][
+            active & (actions[0] == BACKWARD) & (position[0] >= lower_bound)
+        ] -= 1
+        position[1][
+            active & (actions[1] == FORWARD) & (position[1] > position[0])
+        ] -= 1
+        position[1][
+            active & (actions[1] == BACKWARD) & (position[1] <= upper_bound)
+        ] += 1
+        attack(app, state, rng, 0, actions)
+        attack(app, state, rng, 1, actions)
+        state.time_left -= 1
+    health = state.health
+    state.winner[state.active & (health[0] > health[1])] = 0
+    state.winner[state.active & (health[0] < health[1])] = 1
+    return state.winner
+
+
+def simulate_matches(app: App,
+                     p1: typing.Union[Agent, Policy],
+                     p2: typing.Union[Agent, Policy],
+                     count: int,
+                     rng: typing.Optional['numpy.random.Generator']=None
+                     ) -> 'numpy.ndarray':
+    """Play ``count`` matches like :func:`~.game.run_matches` and return
+    the winner of each of them: 0, 1 or :const:`DRAW`."""
+    rng = default_rng(rng)
+    wins = numpy.zeros((2, count), dtype=numpy.int64)
+    playing = numpy.ones(count, dtype=bool)
+    max_wins = app.game_round_count - 1
+    for _ in range(app.game_round_count):
+        winners = simulate_rounds(app, p1, p2, count, rng)
+        wins[0] += playing & (winners == 0)
+        wins[1] += playing & (winners == 1)
+        playing &= (wins[0] != max_wins) & (wins[1] != max_wins)
+        if not playing.any():
+            break
+    result = numpy.full(count, DRAW, dtype=numpy.int64)
+    result[wins[0] > wins[1]] = 0
+    result[wins[0] < wins[1]] = 1
+    return result
+
+
+#: 99.9th percentile of the chi-squared distribution with 2 degrees of
+#: freedom, i.e. the p1 win/p2 win/draw table of :func:`check_equivalence`.
+CHI_SQUARED_CRITICAL_VALUE = 13.816
+
+
+def check_equivalence(app: App, p1: Agent, p2: Agent,
+                      count: int=2000) -> typing.Tuple[bool, float]:
+    """Check that the batch engine and :func:`~.game.evaluate` give the
+    same distribution of round results for the given agents, using
+    Pearson's chi-squared test of homogeneity.
+
+    Returns whether the two are indistinguishable at the 0.1% level, and
+    the chi-squared statistic.
+
+    """
+    winners = simulate_rounds(app, p1, p2, count)
+    observed = numpy.zeros((2, 3))
+    for winner in winners:
+        observed[0, winner] += 1
+    for _ in range(count):
+        winner, _ = evaluate(app, p1, p2, [])
+        observed[1, DRAW if winner is None else winner] += 1
+    observed = observed[:, observed.sum(axis=0) > 0]
+    expected = (observed.sum(axis=1, keepdims=True) *
+                observed.sum(axis=0, keepdims=True) / observed.sum())
+    statistic = float(((observed - expected) ** 2 / expected).sum())
+    return statistic < CHI_SQUARED_CRITICAL_VALUE, statistic
+
+
+def test():
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('count', type=int, nargs='?', default=10000,
+                        help='matches to simulate for every pair')
+    count = parser.parse_args().count
+    app = App()
+    pairs = [
+        (RandomAgent(), RandomAgent()),
+        (RandomAgent(), FixedAgent(Action.punch)),
+        (FixedAgent(Action.kick), FixedAgent(Action.guard)),
+        (FixedAgent(Action.punch), FixedAgent(Action.forward)),
+    ]
+    for p1, p2 in pairs:
+        name = f'{type(p1).__name__} vs. {type(p2).__name__}'
+        started_at = time.perf_counter()
+        winners = simulate_matches(app, p1, p2, count)
+        elapsed = time.perf_counter() - started_at
+        rates = [numpy.count_nonzero(winners == w) / count
+                 for w in (0, 1, DRAW)]
+        equivalent, statistic = check_equivalence(app, p1, p2)
+        print(f'{name}: p1 {rates[0]:.3f} / p2 {rates[1]:.3f} / '
+              f'draw {rates[2]:.3f} ({count / elapsed:.0f} matches/s); '
+              f'chi2={statistic:.2f} '
+              f'{"equivalent" if equivalent else "DIFFERENT"}')
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,388 @@
+"""Benchmarks of the game engine.  Run it with the same configuration file
+as the server::
+
+    $ python -m pycon2018.benchmark -o results.json local.toml
+
+Every benchmark prints a summary, and with ``-o`` all measurements are
+written to a JSON file along with the environment they were taken in, so
+that runs can be compared across changes.  ``-b`` picks benchmarks to run
+(all of them by default).
+
+"""
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import random
+import sys
+import tempfile
+import time
+import typing
+
+from .app import App
+from .game import (Action, ExternalScriptAgent, FixedAgent, RandomAgent,
+                   run_matches)
+from .pool import RunnerPool, run_matches_concurrently
+
+__all__ = ('BENCHMARKS', 'FIGHTER_SCRIPT', 'SAMPLE_SCRIPT', 'count_ticks',
+           'measure_bracket', 'measure_fast_forward', 'measure_in_process',
+           'measure_pool', 'measure_spawn', 'measure_turns', 'run_benchmarks')
+
+
+#: A script which never wins, so every round lasts until the time is over.
+#: It spends ``{think}`` loop iterations on every turn before answering.
+SAMPLE_SCRIPT = '''\
+import sys
+while True:
+    sys.stdin.readline()
+    for _ in range({think}):
+        pass
+    sys.stdout.write('idle\\n')
+    sys.stdout.flush()
+'''
+
+#: A script which walks up to its opponent and attacks at random.
+#: ``{index}`` makes the code of every entry of a bracket different.
+FIGHTER_SCRIPT = '''\
+import json
+import random
+import sys
+# entry {index}
+while True:
+    payload = json.loads(sys.stdin.readline())
+    if payload['distance'] > 0:
+        action = 'forward'
+    else:
+        action = random.choice(['punch', 'kick', 'guard', 'crouch'])
+    sys.stdout.write(action + '\\n')
+    sys.stdout.flush()
+'''
+
+
+def count_ticks(app: App, records) -> int:
+    return sum(app.game_round_time - record.time[-1] + 1
+               for record in records)
+
+
+def measure_in_process(app: App, matches: int) -> typing.Mapping[str, float]:
+    """Play matches between agents which don't need a subprocess."""
+    ticks = 0
+    started_at = time.perf_counter()
+    for i in range(matches):
+        _, records = run_matches(app, RandomAgent(), FixedAgent(Action.punch),
+                                 seed=i)
+        ticks += count_ticks(app, records)
+    elapsed = time.perf_counter() - started_at
+    return {
+        'matches': matches,
+        'ticks': ticks,
+        'seconds': elapsed,
+        'matches_per_second': matches / elapsed,
+        'ticks_per_second': ticks / elapsed,
+    }
+
+
+def measure_fast_forward(app: App, matches: int,
+                         enabled: bool) -> typing.Mapping[str, typing.Any]:
+    """Play matches between every pair of :class:`~.game.FixedAgent`,
+    with ``game.fast_forward`` ``enabled`` or not.  The encoded records
+    are returned too, so that both ways can be compared."""
+    game_config = dict(app.config.get('game', {}), fast_forward=enabled)
+    variant_app = App(dict(app.config, game=game_config))
+    pairs = [(p1, p2) for p1 in Action for p2 in Action]
+    ticks = 0
+    encoded = []
+    started_at = time.perf_counter()
+    for i in range(matches):
+        for p1, p2 in pairs:
+            _, records = run_matches(variant_app, FixedAgent(p1),
+                                     FixedAgent(p2), seed=i)
+            ticks += count_ticks(variant_app, records)
+            if i == 0:
+                encoded.append([(r.encode(), r.encode_actions())
+                                for r in records])
+    elapsed = time.perf_counter() - started_at
+    return {
+        'matches': matches * len(pairs),
+        'ticks': ticks,
+        'seconds': elapsed,
+        'matches_per_second': matches * len(pairs) / elapsed,
+        'records': encoded,
+    }
+
+
+def measure_spawn(app: App, count: int,
+                  code: str=SAMPLE_SCRIPT.format(think=0)
+                  ) -> typing.Mapping[str, float]:
+    """Measure how long it takes from starting a runner until it answers
+    its first turn."""
+    opponent = FixedAgent(Action.idle)
+    latencies = []
+    with tempfile.NamedTemporaryFile('w', suffix='.py') as script:
+        script.write(code)
+        script.flush()
+        os.chmod(script.name, 0o644)
+        for _ in range(count):
+            started_at = time.perf_counter()
+            agent = ExternalScriptAgent(app, script.name)
+            with agent:
+                agent.get_action(opponent, [], app.game_round_time)
+            latencies.append(time.perf_counter() - started_at)
+    latencies.sort()
+    return {
+        'count': count,
+        'mean': sum(latencies) / count,
+        'p50': latencies[count // 2],
+        'max': latencies[-1],
+    }
+
+
+def measure_turns(app: App, matches: int,
+                  code: str=SAMPLE_SCRIPT.format(think=0)
+                  ) -> typing.Mapping[str, float]:
+    """Play ``matches`` matches between two warm runners of ``code`` and
+    measure how long a tick takes."""
+    pool = app.runner_pool
+    ticks = 0
+    elapsed = 0.0
+    cpu_time = 0.0
+    bytes_sent = 0
+    for _ in range(matches):
+        p1, p2 = pool.agent(code), pool.agent(code)
+        started_at = time.perf_counter()
+        cpu_started_at = time.process_time()
+        _, records = run_matches(app, p1, p2, raise_=True)
+        cpu_time += time.process_time() - cpu_started_at
+        elapsed += time.perf_counter() - started_at
+        ticks += count_ticks(app, records)
+        bytes_sent += p1.bytes_sent + p2.bytes_sent
+    return {
+        'matches': matches,
+        'ticks': ticks,
+        'seconds': elapsed,
+        'ticks_per_second': ticks / elapsed,
+        'tick_latency': elapsed / ticks,
+        'evaluator_cpu_per_match': cpu_time / matches,
+        'bytes_sent_per_match': bytes_sent / matches,
+    }
+
+
+def measure_pool(app: App, matches: int, warm: bool,
+                 code: str=FIGHTER_SCRIPT.format(index=0)
+                 ) -> typing.Mapping[str, float]:
+    """Play matches between external scripts, either starting new runners
+    for every match (``warm=False``) or reusing them from a pool."""
+    pool = RunnerPool(app, app.game_pool_size if warm else 0,
+                      app.game_pool_max_uses)
+    try:
+        ticks = 0
+        started_at = time.perf_counter()
+        for i in range(matches):
+            _, records = run_matches(app, pool.agent(code), pool.agent(code),
+                                     seed=i)
+            ticks += count_ticks(app, records)
+        elapsed = time.perf_counter() - started_at
+        stats = pool.stats()
+    finally:
+        pool.close()
+    return {
+        'matches': matches,
+        'ticks': ticks,
+        'seconds': elapsed,
+        'matches_per_second': matches / elapsed,
+        'ticks_per_second': ticks / elapsed,
+        'spawned': stats['spawned'],
+        'reused': stats['reused'],
+    }
+
+
+def measure_bracket(app: App, entries: int) -> typing.Mapping[str, float]:
+    """Play a single-elimination bracket of ``entries`` different scripts
+    one level at a time, like :func:`~.web.create_matches` does."""
+    codes = [FIGHTER_SCRIPT.format(index=i) for i in range(entries)]
+    matches = 0
+    levels = 0
+    spawned = app.runner_pool.stats()['spawned']
+    started_at = time.perf_counter()
+    while len(codes) > 1:
+        pairs = list(zip(codes[::2], codes[1::2]))
+        results = run_matches_concurrently(app, pairs)
+        winners = [pair[winner or 0]
+                   for pair, (winner, _, __) in zip(pairs, results)]
+        codes = winners + codes[len(pairs) * 2:]
+        matches += len(pairs)
+        levels += 1
+    elapsed = time.perf_counter() - started_at
+    return {
+        'entries': entries,
+        'levels': levels,
+        'matches': matches,
+        'seconds': elapsed,
+        'matches_per_second': matches / elapsed,
+        'spawned': app.runner_pool.stats()['spawned'] - spawned,
+    }
+
+
+def benchmark_in_process(app: App, args) -> typing.Mapping:
+    result = measure_in_process(app, args.matches)
+    print(f'in-process: {result["matches_per_second"]:.1f} matches/s, '
+          f'{result["ticks_per_second"]:.0f} ticks/s')
+    return result
+
+
+def benchmark_engine(app: App, args) -> typing.Mapping:
+    results = {}
+    for name in ('reference', 'table'):
+        game_config = dict(app.config.get('game', {}), engine=name)
+        result = measure_in_process(App(dict(app.config, game=game_config)),
+                                    args.matches)
+        print(f'engine ({name}): {result["matches_per_second"]:.1f} '
+              f'matches/s, {result["ticks_per_second"]:.0f} ticks/s')
+        results[name] = result
+    return results
+
+
+def benchmark_fast_forward(app: App, args) -> typing.Mapping:
+    results = {}
+    for name, enabled in (('off', False), ('on', True)):
+        result = measure_fast_forward(app, args.matches, enabled)
+        print(f'fast-forward ({name}): '
+              f'{result["matches_per_second"]:.1f} matches/s')
+        results[name] = result
+    equivalent = results['off'].pop('records') == results['on'].pop('records')
+    print(f'fast-forward: records are {"" if equivalent else "NOT "}'
+          'equivalent')
+    results['equivalent'] = equivalent
+    return results
+
+
+def benchmark_spawn(app: App, args) -> typing.Mapping:
+    results = {}
+    for name, zygote in (('exec', False), ('zygote', True)):
+        game_config = dict(app.config.get('game', {}), zygote=zygote)
+        variant_app = App(dict(app.config, game=game_config))
+        if zygote:
+            variant_app.zygote  # Boot it before measuring.
+        result = measure_spawn(variant_app, args.matches)
+        if zygote:
+            variant_app.zygote.close()
+        print(f'spawn ({name}): {result["mean"] * 1e3:.1f} ms mean, '
+              f'{result["p50"] * 1e3:.1f} ms p50, '
+              f'{result["max"] * 1e3:.1f} ms max')
+        results[name] = result
+    return results
+
+
+def benchmark_turns(app: App, args) -> typing.Mapping:
+    variants = {
+        'json': {},
+        'json, concurrent turns': {'concurrent_turns': True},
+        'lean': {'protocol': 2},
+    }
+    results = {}
+    for name, variant in variants.items():
+        game_config = dict(app.config.get('game', {}), **variant)
+        variant_app = App(dict(app.config, game=game_config))
+        result = measure_turns(variant_app, args.matches,
+                               SAMPLE_SCRIPT.format(think=args.think))
+        variant_app.runner_pool.close()
+        print(f'turns ({name}): '
+              f'{result["tick_latency"] * 1e6:.0f} us/tick, '
+              f'{result["ticks_per_second"]:.0f} ticks/s, '
+              f'{result["evaluator_cpu_per_match"] * 1e3:.2f} ms CPU and '
+              f'{result["bytes_sent_per_match"]:.0f} bytes sent per match')
+        results[name] = result
+    return results
+
+
+def benchmark_pool(app: App, args) -> typing.Mapping:
+    results = {}
+    for name, warm in (('cold', False), ('warm', True)):
+        result = measure_pool(app, args.matches, warm)
+        print(f'pool ({name}): {result["matches_per_second"]:.1f} matches/s, '
+              f'{result["ticks_per_second"]:.0f} ticks/s, '
+              f'{result["spawned"]} spawned, {result["reused"]} reused')
+        results[name] = result
+    return results
+
+
+def benchmark_bracket(app: App, args) -> typing.Mapping:
+    result = measure_bracket(app, args.entries)
+    print(f'bracket of {result["entries"]}: {result["seconds"]:.2f} s, '
+          f'{result["matches_per_second"]:.1f} matches/s, '
+          f'{result["spawned"]} spawned')
+    return result
+
+
+BENCHMARKS = {
+    'in_process': benchmark_in_process,
+    'engine': benchmark_engine,
+    'fast_forward': benchmark_fast_forward,
+    'spawn': benchmark_spawn,
+    'turns': benchmark_turns,
+    'pool': benchmark_pool,
+    'bracket': benchmark_bracket,
+}
+
+
+def run_benchmarks(app: App, args,
+                   names: typing.Sequence[str]) -> typing.Mapping:
+    random.seed(args.seed)
+    return {name: BENCHMARKS[name](app, args) for name in names}
+
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('-n', '--matches', type=int, default=20,
+                    help='number of matches (or spawns) for each measurement')
+parser.add_argument('-e', '--entries', type=int, default=16,
+                    help='number of entries of the bracket')
+parser.add_argument('-t', '--think', type=int, default=0,
+                    help='loop iterations the sample script spends on every '
+                         'turn')
+parser.add_argument('-s', '--seed', type=int, default=0,
+                    help='seed of the random number generator')
+parser.add_argument('-b', '--benchmark', action='append',
+                    choices=list(BENCHMARKS),
+                    help='benchmark to run; can be given several times')
+parser.add_argument('-o', '--output', type=pathlib.Path,
+                    help='JSON file to write the results to')
+parser.add_argument('config', type=pathlib.Path, nargs='?')
+
+
+def main():
+    args = parser.parse_args()
+    if args.config is None:
+        app = App({})
+    elif args.config.is_file():
+        app = App.from_path(args.config)
+    else:
+        parser.error('file not found: {!s}'.format(args.config))
+    results = run_benchmarks(app, args, args.benchmark or list(BENCHMARKS))
+    app.runner_pool.close()
+    if args.output:
+        report = {
+            'created_at': datetime.datetime.now(
+                datetime.timezone.utc
+            ).isoformat(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'arguments': {
+                'matches': args.matches,
+                'entries': args.entries,
+                'think': args.think,
+                'seed': args.seed,
+            },
+            'game': dict(app.config.get('game', {})),
+            'results': results,
+        }
+        with args.output.open('w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Live updates of match trees for spectators, sent as server-sent events.
+
+Pages of a tournament or a match set subscribe to its channel, which is
+keyed like ``('tournament', id)`` or ``('match_set', id)``.  When a match
+is disclosed or a bracket is made, the web server builds the new tree
+once and :meth:`TreeBroker.publish` sends every subscriber only what
+changed since the last tree of the channel.  Subscribers wait on their
+own queue, so holding hundreds of them costs no database queries.
+
+The broker lives in the memory of the web server process, which is a
+single gevent server (see :file:`run.py`).  Versions start over when the
+process does, so the ids of events also carry the epoch of the broker,
+and a client which reconnects with an id of another epoch is sent the
+whole tree.
+
+"""
+import collections
+import json
+import queue
+import threading
+import typing
+import uuid
+
+__all__ = ('Subscription', 'TreeBroker', 'format_event', 'tree_delta')
+
+
+Key = typing.Tuple[str, typing.Any]
+Tree = typing.List[typing.Mapping[str, typing.Any]]
+
+
+def tree_delta(old: Tree, new: Tree) -> typing.Mapping[str, typing.Any]:
+    """What changed from ``old`` to ``new``: matches which are new or
+    different, ids of the removed ones, and the order of the ids if it
+    isn't the same anymore."""
+    old_matches = {match['id']: match for match in old}
+    new_ids = [match['id'] for match in new]
+    kept = set(new_ids)
+    delta = {
+        'changed': [match for match in new
+                    if old_matches.get(match['id']) != match],
+        'removed': [id for id in old_matches if id not in kept],
+    }
+    if new_ids != [match['id'] for match in old]:
+        delta['order'] = new_ids
+    return delta
+
+
+def format_event(event: str, data, id: typing.Optional[str]=None) -> str:
+    lines = []
+    if id is not None:
+        lines.append(f'id: {id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data))
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+    """A subscriber of a channel.  Deltas are queued up to ``size``; one
+    which falls behind further is sent the whole tree instead."""
+
+    def __init__(self, key: Key, size: int):
+        self.key = key
+        self.queue = queue.Queue(size)
+        self.stale = False
+
+    def put(self, version: int, delta: typing.Mapping[str, typing.Any]):
+        try:
+            self.queue.put_nowait((version, delta))
+        except queue.Full:
+            self.stale = True
+
+    def get(self, timeout: float
+            ) -> typing.Optional[typing.Tuple[int, typing.Mapping]]:
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def resync(self):
+        self.stale = False
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+
+class TreeBroker:
+    """Fans out the deltas of trees from publishers to subscribers, and
+    keeps the latest tree of every channel which has been published or
+    loaded, numbered by a version which grows with every change."""
+
+    def __init__(self, queue_size: int=16):
+        self.queue_size = queue_size
+        #: Tells the versions of this broker from those of the brokers of
+        #: other or earlier processes.
+        self.epoch = uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+        self.trees: typing.Dict[Key, typing.Tuple[int, Tree]] = {}
+        self.subscribers: typing.Dict[Key, typing.Set[Subscription]] = \
+            collections.defaultdict(set)
+        self.published = 0
+        self.sent = 0
+
+    def event_id(self, version: int) -> str:
+        """The id of an event which brings a tree up to ``version``."""
+        return f'{self.epoch}-{version}'
+
+    def parse_event_id(self, event_id: typing.Optional[str]
+                       ) -> typing.Optional[int]:
+        """The version of an :meth:`event_id`, or :const:`None` if it isn't
+        one of this broker."""
+        epoch, _, version = (event_id or '').partition('-')
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def subscribe(self, key: Key) -> Subscription:
+        subscription = Subscription(key, self.queue_size)
+        with self.lock:
+            self.subscribers[key].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.key)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[subscription.key]
+
+    def snapshot(self, key: Key,
+                 load: typing.Callable[[], Tree]) -> typing.Tuple[int, Tree]:
+        """The latest tree of the channel and its version.  ``load`` builds
+        it if nothing has been published yet."""
+        with self.lock:
+            if key in self.trees:
+                return self.trees[key]
+        tree = load()
+        with self.lock:
+            # Another subscriber or a publisher may have been faster.
+            return self.trees.setdefault(key, (1, tree))
+
+    def latest(self, key: Key) -> typing.Tuple[int, Tree]:
+        """The latest tree of a channel which has been published or
+        loaded by :meth:`snapshot`, and its version.  Trees are never
+        dropped, so it's there for any channel which has a subscriber."""
+        with self.lock:
+            return self.trees[key]
+
+    def publish(self, key: Key, tree: Tree):
+        """Make ``tree`` the latest tree of the channel, and send what
+        changed to its subscribers.  Nothing is sent if nothing changed."""
+        with self.lock:
+            version, old = self.trees.get(key, (0, []))
+            delta = tree_delta(old, tree)
+            if not delta['changed'] and not delta['removed'] and \
+               'order' not in delta:
+                return
+            version += 1
+            self.trees[key] = version, tree
+            subscribers = self.subscribers.get(key, ())
+            self.published += 1
+            self.sent += len(subscribers)
+            # Putting never blocks, and doing it under the lock keeps the
+            # deltas of every subscriber in the order of their versions.
+            for subscription in subscribers:
+                subscription.put(version, delta)
+
+    def stats(self) -> typing.Mapping[str, int]:
+        with self.lock:
+            return {
+                'channels': len(self.trees),
+                'subscribers': sum(map(len, self.subscribers.values())),
+                'published': self.published,
+                'sent': self.sent,
+            }
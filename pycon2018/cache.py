@@ -0,0 +1,328 @@
+"""Cache of match results, so that the same two submissions (or a
+submission and a built-in agent) under the same rules aren't played over
+and over again.
+
+A result is keyed by what both players are, the rules and the seed policy
+(``game.result_cache_seed``).  If the seed is fixed and neither player
+uses :mod:`random`, the match is deterministic and its single result is
+pinned, i.e. reused for good.  That holds for pooled runners too, as they
+start the script in a fresh process for every match, and runners get
+a fixed hash seed along with it (see :attr:`~.app.App.runner_environment`).
+A match where a player failed to act on some tick, e.g. as its turn timed
+out on a loaded server, isn't pinned though, as it may go otherwise the
+next time.  Otherwise, if ``game.result_cache_samples`` is set, up to that
+many results are played and stored, and then served at random; by default
+such matches are always played.
+
+Recently used keys are kept in memory (``game.result_cache_size`` of
+them), and every result is stored in :class:`~.entities.CachedResult`.
+
+Random matches, playground tests and the matches of brackets all go
+through the cache.  Matches of a bracket which are served from it come
+without metrics.
+
+"""
+import ast
+import collections
+import hashlib
+import json
+import random
+import threading
+import typing
+
+from sqlalchemy.orm.session import Session
+
+from .app import App
+from .entities import CachedResult, ValidatedCode
+from .game import (Agent, FixedAgent, RandomAgent, iter_matches, load_match,
+                   match_winner, rules_config, store_match)
+from .metrics import MatchMetrics
+from .pool import code_hash, run_matches_concurrently
+from .record import FAILED, Record
+
+__all__ = ('Player', 'ResultCache', 'cache_key', 'find_cached_match',
+           'is_deterministic_code', 'is_validated', 'iter_cached_matches',
+           'mark_validated', 'player_key', 'rules_hash',
+           'run_cached_matches', 'run_cached_matches_concurrently',
+           'store_cached_match')
+
+
+#: A submission's code, or a built-in agent.
+Player = typing.Union[str, Agent]
+
+#: Modules whose use makes a script behave differently from one run to
+#: another, among those :prog:`script_runner` permits.
+NONDETERMINISTIC_MODULES = frozenset({'random'})
+
+
+def is_deterministic_code(code: str) -> bool:
+    """Whether the script always takes the same actions given the same
+    inputs, i.e. it doesn't import any of :const:`NONDETERMINISTIC_MODULES`.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or '']
+        elif isinstance(node, ast.Name) and node.id == '__import__':
+            return False
+        else:
+            continue
+        if any(module.partition('.')[0] in NONDETERMINISTIC_MODULES
+               for module in modules):
+            return False
+    return True
+
+
+def player_key(player: Player) -> str:
+    if isinstance(player, str):
+        return 'code:' + code_hash(player)
+    elif isinstance(player, FixedAgent):
+        return 'fixed:' + player.action.value
+    elif isinstance(player, RandomAgent):
+        return 'random'
+    raise TypeError(f'{player!r} cannot be cached')
+
+
+def is_deterministic(player: Player) -> bool:
+    if isinstance(player, str):
+        return is_deterministic_code(player)
+    return isinstance(player, FixedAgent)
+
+
+def hash_json(value) -> str:
+    encoded = json.dumps(value, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def rules_hash(app: App) -> str:
+    """Hash of the configuration the result of a match depends on: the
+    rules, and everything which changes what scripts see or how much they
+    may spend."""
+    return hash_json({
+        'rules': rules_config(app),
+        'round_count': app.game_round_count,
+        'turn_timeout': app.game_turn_timeout,
+        'match_timeout': app.game_match_timeout,
+        'concurrent_turns': app.game_concurrent_turns,
+        'fast_forward': app.game_fast_forward,
+        'protocol': app.game_protocol,
+        'engine': app.game_engine,
+        'cpu_limit': app.game_cpu_limit,
+        'memory_limit': app.game_memory_limit,
+        'file_limit': app.game_file_limit,
+    })
+
+
+def cache_key(app: App, p1: Player, p2: Player,
+              seed: typing.Optional[int], pinned: bool=False) -> str:
+    """The key of the pinned result of a match, or of its samples."""
+    return hash_json({
+        'p1': player_key(p1),
+        'p2': player_key(p2),
+        'rules': rules_hash(app),
+        'seed': 'random' if seed is None else seed,
+        'pinned': pinned,
+    })
+
+
+def can_pin(app: App, p1: Player, p2: Player) -> bool:
+    return (app.game_result_cache_seed is not None and
+            is_deterministic(p1) and is_deterministic(p2))
+
+
+def has_failures(records: typing.Iterable[Record]) -> bool:
+    """Whether a player failed to act on some tick of the rounds."""
+    return any(FAILED in record.p1_actions or FAILED in record.p2_actions
+               for record in records)
+
+
+class ResultCache:
+    """Results of matches by :func:`cache_key`, with the most recently
+    used ``size`` keys in memory and all of them in the database."""
+
+    def __init__(self, size: int, samples: int):
+        self.size = size
+        self.samples = samples
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def lookup(self, session: Session,
+               key: str) -> typing.List[typing.Tuple[typing.Optional[int],
+                                                     typing.Any]]:
+        """The stored results for ``key``, as pairs of a winner and
+        :attr:`~.entities.CachedResult.match_data`."""
+        with self.lock:
+            results = self.entries.get(key)
+            if results is not None:
+                self.entries.move_to_end(key)
+                return list(results)
+            self.loads += 1
+        results = [
+            (winner, data)
+            for winner, data in session.query(
+                CachedResult.winner, CachedResult.match_data
+            ).filter_by(key=key).limit(max(self.samples, 1))
+        ]
+        self.remember(key, results)
+        return results
+
+    def remember(self, key: str, results: typing.List):
+        with self.lock:
+            self.entries[key] = results
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def add(self, session: Session, key: str, winner: typing.Optional[int],
+            data):
+        """Store a result.  It commits ``session``."""
+        session.add(CachedResult(key=key, winner=winner, match_data=data))
+        session.commit()
+        with self.lock:
+            results = self.entries.get(key)
+        self.remember(key, (results or []) + [(winner, data)])
+
+    def record(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> typing.Mapping[str, int]:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'capacity': self.size,
+                'samples': self.samples,
+                'hits': self.hits,
+                'misses': self.misses,
+                'loads': self.loads,
+            }
+
+
+def find_cached_match(app: App, session: Session, p1: Player,
+                      p2: Player) -> typing.Optional[typing.List[Record]]:
+    """The records of a stored match between two players to serve instead
+    of playing it, or :const:`None` if it has to be played."""
+    cache = app.result_cache
+    seed = app.game_result_cache_seed
+    pinnable = can_pin(app, p1, p2)
+    if not pinnable and cache.samples <= 0:
+        return None
+    results = []
+    if pinnable:
+        results = cache.lookup(session, cache_key(app, p1, p2, seed, True))
+    if not results and cache.samples > 0:
+        results = cache.lookup(session, cache_key(app, p1, p2, seed))
+        if len(results) < cache.samples:
+            results = []
+    cache.record(bool(results))
+    if not results:
+        return None
+    _, data = random.choice(results)
+    return load_match(data)
+
+
+def store_cached_match(app: App, session: Session, p1: Player, p2: Player,
+                       winner: typing.Optional[int],
+                       records: typing.Sequence[Record]):
+    """Store a match between two players which has been played: pin it
+    if it can be, or else keep it as a sample unless samples aren't kept.
+    It commits ``session``."""
+    cache = app.result_cache
+    seed = app.game_result_cache_seed
+    if can_pin(app, p1, p2) and not has_failures(records):
+        key = cache_key(app, p1, p2, seed, True)
+    elif cache.samples > 0:
+        key = cache_key(app, p1, p2, seed)
+    else:
+        return
+    cache.add(session, key, winner, store_match(app, records))
+
+
+def iter_cached_matches(
+    app: App, session: Session, p1: Player, p2: Player, raise_: bool=False
+) -> typing.Iterator[typing.Tuple[typing.Optional[int], Record]]:
+    """:func:`~.game.iter_matches` between two players which may be served
+    from :attr:`~.app.App.result_cache`.  Codes are played by runners of
+    :attr:`~.app.App.runner_pool`.  A match which is played is stored
+    once its last round is over."""
+    records = find_cached_match(app, session, p1, p2)
+    if records is not None:
+        for record in records:
+            yield record.winner, record
+        return
+    rounds = []
+    for winner, record in iter_matches(app, agent_for(app, p1),
+                                       agent_for(app, p2), raise_,
+                                       app.game_result_cache_seed):
+        rounds.append((winner, record))
+        yield winner, record
+    store_cached_match(app, session, p1, p2,
+                       match_winner(winner for winner, _ in rounds),
+                       [record for _, record in rounds])
+
+
+def run_cached_matches(app: App, session: Session, p1: Player, p2: Player,
+                       raise_: bool=False):
+    """:func:`~.game.run_matches` through :func:`iter_cached_matches`."""
+    rounds = list(iter_cached_matches(app, session, p1, p2, raise_))
+    return (match_winner(winner for winner, _ in rounds),
+            [record for _, record in rounds])
+
+
+def run_cached_matches_concurrently(
+    app: App, session: Session, pairs: typing.Sequence[typing.Tuple[str, str]]
+) -> typing.List[
+    typing.Tuple[typing.Optional[int], typing.List[Record],
+                 typing.Optional[MatchMetrics]]
+]:
+    """:func:`~.pool.run_matches_concurrently` through the cache.  The
+    cache is looked up and stored to by the calling thread, as the
+    ``session`` is, and the matches which have to be played are played
+    concurrently.  Matches served from the cache have no metrics."""
+    results = [None] * len(pairs)
+    missed = []
+    for index, (p1, p2) in enumerate(pairs):
+        records = find_cached_match(app, session, p1, p2)
+        if records is None:
+            missed.append(index)
+        else:
+            winner = match_winner(record.winner for record in records)
+            results[index] = winner, records, None
+    played = run_matches_concurrently(app, [pairs[i] for i in missed],
+                                      app.game_result_cache_seed)
+    for index, (winner, records, metrics) in zip(missed, played):
+        store_cached_match(app, session, *pairs[index], winner, records)
+        results[index] = winner, records, metrics
+    return results
+
+
+def agent_for(app: App, player: Player) -> Agent:
+    if isinstance(player, str):
+        return app.runner_pool.agent(player)
+    return player
+
+
+def is_validated(session: Session, app: App, code: str) -> bool:
+    """Whether ``code`` has passed validation under the current rules."""
+    return session.query(ValidatedCode).filter_by(
+        code_hash=code_hash(code), rules_hash=rules_hash(app)
+    ).count() > 0
+
+
+def mark_validated(session: Session, app: App, code: str):
+    """Record that ``code`` has passed validation.  Only passes are
+    recorded: a failure may be due to bad luck or a loaded server."""
+    if not is_validated(session, app, code):
+        session.add(ValidatedCode(code_hash=code_hash(code),
+                                  rules_hash=rules_hash(app)))
@@ -3,7 +3,7 @@ import uuid
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.orm import backref, object_session, relationship
 from sqlalchemy.schema import Column, ForeignKey, UniqueConstraint
-from sqlalchemy.types import Boolean, Integer, String, Text, Unicode
+from sqlalchemy.types import Boolean, Float, Integer, String, Text, Unicode
 from sqlalchemy_utils import UUIDType
 
 from .orm import Base
@@ -38,7 +38,8 @@ class Tournament(Base):
     finish_at = Column(UtcDateTime, nullable=False)
 
     final_match_id = Column(UUIDType, ForeignKey('match.id'))
-    final_match = relationship('Match', uselist=False)
+    final_match = relationship('Match', foreign_keys=[final_match_id],
+                               uselist=False)
 
     @property
     def active(self) -> bool:
@@ -104,13 +105,14 @@ class TournamentMatchSet(Base):
     )
 
     final_match_id = Column(UUIDType, ForeignKey('match.id'))
-    final_match = relationship('Match', uselist=False)
+    final_match = relationship('Match', foreign_keys=[final_match_id],
+                               uselist=False)
 
     @property
     def group_name(self):
         from .util import get_match_set_group_names
         session = object_session(self)
-        gns = get_match_set_group_names(session, self.tournament)
+        gns = get_match_set_group_names(session, self.tournament_id, [self.id])
         if self.id in gns:
             return gns[self.id]
         return None
@@ -163,10 +165,27 @@ class Match(Base):
 
     iteration = Column(Integer, nullable=False)
     match_data = Column(JSON, nullable=False)
+    metrics = Column(JSON)
     disclosed = Column(Boolean, nullable=False, default=False)
 
+    # Where the match is in its bracket, set when the bracket is made, so
+    # that neither its terminal match nor its match set have to be found
+    # by walking the bracket.  A match of the final bracket of a
+    # tournament has no match set.
+    terminal_id = Column(UUIDType, ForeignKey('match.id'), index=True)
+    tournament_id = Column(UUIDType, ForeignKey(Tournament.id), index=True)
+    match_set_id = Column(UUIDType, ForeignKey(TournamentMatchSet.id),
+                          index=True)
+    #: How many rounds the match is before the terminal match.
+    depth = Column(Integer)
+    #: The order of the match in its round, from 0.  The parents of a
+    #: match are at ``2 * position`` and ``2 * position + 1``.
+    position = Column(Integer)
+
     @property
     def terminal(self):
+        if self.terminal_id is not None:
+            return object_session(self).query(Match).get(self.terminal_id)
         child = self
         while child.p1_child or child.p2_child:
             child = child.p1_child or child.p2_child
@@ -174,6 +193,10 @@ class Match(Base):
 
     @property
     def match_set(self) -> TournamentMatchSet:
+        if self.match_set_id is not None:
+            return object_session(self).query(TournamentMatchSet).get(
+                self.match_set_id
+            )
         assert self.p1 or self.p2, f'Match {self} has no players.'
         if self.p1:
             return self.p1.tournament_match_set
@@ -181,3 +204,129 @@ class Match(Base):
             return self.p2.tournament_match_set
 
     __tablename__ = 'match'
+
+
+class LeagueRating(Base):
+    """The rating of a submission in the league of its tournament.  It is
+    only valid for the code whose hash is :attr:`code_hash`; when the
+    submission is updated it starts over."""
+
+    id = Column(UUIDType, primary_key=True, default=uuid.uuid4)
+
+    tournament_id = Column(UUIDType, ForeignKey(Tournament.id),
+                           nullable=False, index=True)
+    tournament = relationship(Tournament, uselist=False)
+
+    submission_id = Column(UUIDType, ForeignKey(Submission.id),
+                           nullable=False, unique=True)
+    submission = relationship(Submission, uselist=False, lazy='joined')
+
+    code_hash = Column(String(64), nullable=False)
+    rating = Column(Float, nullable=False)
+    wins = Column(Integer, nullable=False, default=0)
+    losses = Column(Integer, nullable=False, default=0)
+    draws = Column(Integer, nullable=False, default=0)
+
+    updated_at = Column(UtcDateTime, nullable=False, default=utcnow,
+                        onupdate=utcnow)
+
+    @property
+    def games(self) -> int:
+        return self.wins + self.losses + self.draws
+
+    __tablename__ = 'league_rating'
+
+
+class LeagueResult(Base):
+    """A league match between two submissions, as they were when their
+    code had the recorded hashes.  :attr:`winner` is 0 or 1 for p1 or p2,
+    or :const:`None` for a draw."""
+
+    id = Column(UUIDType, primary_key=True, default=uuid.uuid4)
+
+    tournament_id = Column(UUIDType, ForeignKey(Tournament.id),
+                           nullable=False)
+    tournament = relationship(Tournament, uselist=False)
+
+    p1_id = Column(UUIDType, ForeignKey(Submission.id), nullable=False,
+                   index=True)
+    p1 = relationship(Submission, foreign_keys=[p1_id], uselist=False)
+    p1_code_hash = Column(String(64), nullable=False)
+
+    p2_id = Column(UUIDType, ForeignKey(Submission.id), nullable=False,
+                   index=True)
+    p2 = relationship(Submission, foreign_keys=[p2_id], uselist=False)
+    p2_code_hash = Column(String(64), nullable=False)
+
+    winner = Column(Integer)
+
+    created_at = Column(UtcDateTime, nullable=False, default=utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('p1_id', 'p2_id', name='uc_league_result'),
+    )
+    __tablename__ = 'league_result'
+
+
+class CachedResult(Base):
+    """A result of a match kept by :class:`~.cache.ResultCache`.  There can
+    be several results for the same :attr:`key` when the match is not
+    deterministic."""
+
+    id = Column(UUIDType, primary_key=True, default=uuid.uuid4)
+    key = Column(String(64), nullable=False, index=True)
+    winner = Column(Integer)
+    match_data = Column(JSON, nullable=False)
+    created_at = Column(UtcDateTime, nullable=False, default=utcnow)
+
+    __tablename__ = 'cached_result'
+
+
+class ValidatedCode(Base):
+    """Code which passed the test match of
+    :func:`~.web.submit` under the rules whose hash is :attr:`rules_hash`,
+    so that submitting it again doesn't have to play it."""
+
+    id = Column(UUIDType, primary_key=True, default=uuid.uuid4)
+    code_hash = Column(String(64), nullable=False)
+    rules_hash = Column(String(64), nullable=False)
+    created_at = Column(UtcDateTime, nullable=False, default=utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('code_hash', 'rules_hash',
+                         name='uc_validated_code'),
+    )
+    __tablename__ = 'validated_code'
+
+
+class Job(Base):
+    """An evaluation queued by the web server for the worker processes to
+    run (see :mod:`~.jobs`).  :attr:`result` is the response the web
+    server would have given if it had run the evaluation itself."""
+
+    id = Column(UUIDType, primary_key=True, default=uuid.uuid4)
+    kind = Column(String(32), nullable=False)
+
+    #: ``queued``, ``running``, ``done`` or ``failed``.
+    status = Column(String(16), nullable=False, default='queued', index=True)
+
+    user_id = Column(UUIDType, ForeignKey(User.id), nullable=False)
+    user = relationship(User, uselist=False)
+
+    payload = Column(JSON, nullable=False)
+    result = Column(JSON)
+
+    #: The lines a running job has published so far, e.g., the rounds of
+    #: a test match which are over, or :const:`None` if it hasn't.
+    progress = Column(JSON)
+
+    worker = Column(String(128))
+    created_at = Column(UtcDateTime, nullable=False, default=utcnow)
+    started_at = Column(UtcDateTime)
+
+    #: When the worker running the job last told it's alive.
+    heartbeat_at = Column(UtcDateTime)
+
+    finished_at = Column(UtcDateTime)
+
+    __tablename__ = 'job'
@@ -0,0 +1,254 @@
+"""Estimate which of two players is stronger by playing many independent
+matches between them.
+
+Since damage is random, a single match says little about two close
+players.  :func:`estimate` plays seeded matches at most
+``game.concurrency`` at a time, and stops as soon as a sequential
+probability ratio test on the decisive ones tells which player wins more
+than half of them by at least ``game.estimate_indifference``, with error
+rates of ``game.estimate_error_rate``.  It also stops once the confidence
+interval of the score of p1 (a draw counting as half a win) lies within
+``0.5 ± game.estimate_indifference``, for players which are about as
+strong, or which mostly draw.  Otherwise it gives up after
+``game.estimate_max_matches`` matches.
+
+Run it from the command line with paths of scripts or built-in agents
+(``random`` or an action)::
+
+    $ python -m pycon2018.estimate -c local.toml bot.py punch
+
+"""
+import argparse
+import concurrent.futures
+import copy
+import json
+import math
+import pathlib
+import random
+import typing
+
+from .app import App
+from .cache import Player, agent_for
+from .game import Action, Agent, FixedAgent, RandomAgent, run_matches
+
+__all__ = 'Estimate', 'estimate', 'wilson_interval'
+
+
+def normal_quantile(p: float) -> float:
+    """The ``p`` quantile of the standard normal distribution, by
+    bisection."""
+    low, high = -10.0, 10.0
+    for _ in range(64):
+        middle = (low + high) / 2
+        if (1 + math.erf(middle / math.sqrt(2))) / 2 < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def wilson_interval(successes: int, trials: int,
+                    z: float=1.96) -> typing.Tuple[float, float]:
+    """Wilson score interval of a binomial proportion, 95% by default."""
+    if trials == 0:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    centre = (p + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(
+        p * (1 - p) / trials + z * z / (4 * trials * trials)
+    ) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+class Estimate:
+    """Results of the matches played so far, and the verdict of the test
+    between "p1 wins ``0.5 + indifference`` of decisive matches" and "p2
+    does", each rejected with an error rate of ``error_rate``."""
+
+    def __init__(self, indifference: float, error_rate: float):
+        self.indifference = indifference
+        self.z = normal_quantile(1 - error_rate / 2)
+        self.wins = [0, 0]
+        self.draws = 0
+        self.finished = False
+        self.step = math.log((0.5 + indifference) / (0.5 - indifference))
+        self.bound = math.log((1 - error_rate) / error_rate)
+
+    @property
+    def matches(self) -> int:
+        return self.wins[0] + self.wins[1] + self.draws
+
+    def add(self, winner: typing.Optional[int]):
+        if winner is None:
+            self.draws += 1
+        else:
+            self.wins[winner] += 1
+
+    @property
+    def log_likelihood_ratio(self) -> float:
+        return (self.wins[0] - self.wins[1]) * self.step
+
+    @property
+    def winner(self) -> typing.Optional[int]:
+        """0 or 1 once the test has decided, or :const:`None`."""
+        llr = self.log_likelihood_ratio
+        if llr >= self.bound:
+            return 0
+        elif llr <= -self.bound:
+            return 1
+        return None
+
+    @property
+    def score(self) -> typing.Tuple[float, float]:
+        """Confidence interval of the score of p1."""
+        return wilson_interval(self.wins[0] + self.draws / 2, self.matches,
+                               self.z)
+
+    @property
+    def even(self) -> bool:
+        """Whether the players are about as strong."""
+        low, high = self.score
+        return (self.matches > 0 and
+                0.5 - self.indifference <= low and
+                high <= 0.5 + self.indifference)
+
+    @property
+    def decided(self) -> bool:
+        return self.winner is not None or self.even
+
+    def to_json(self) -> typing.Mapping[str, typing.Any]:
+        matches = self.matches
+        winner = self.winner
+        return {
+            'matches': matches,
+            'p1_wins': self.wins[0],
+            'p2_wins': self.wins[1],
+            'draws': self.draws,
+            'p1_win_rate': wilson_interval(self.wins[0], matches),
+            'p2_win_rate': wilson_interval(self.wins[1], matches),
+            'draw_rate': wilson_interval(self.draws, matches),
+            'score': self.score,
+            'log_likelihood_ratio': self.log_likelihood_ratio,
+            'bound': self.bound,
+            'winner': None if winner is None else f'p{winner + 1}',
+            'even': self.even,
+            'finished': self.finished,
+        }
+
+
+def fresh_agent(app: App, player: Player) -> Agent:
+    # Built-in agents keep the state of the round they play, so matches
+    # running at the same time need their own.
+    if isinstance(player, Agent):
+        return copy.copy(player)
+    return agent_for(app, player)
+
+
+def estimate(app: App, p1: Player, p2: Player,
+             max_matches: typing.Optional[int]=None,
+             seed: typing.Optional[int]=None) -> typing.Iterator[Estimate]:
+    """Play matches between ``p1`` and ``p2`` until the test decides or
+    ``max_matches`` (``game.estimate_max_matches`` by default) have been
+    played, yielding the :class:`Estimate` every time a match is over.
+    The last one yielded is :attr:`~Estimate.finished`.
+
+    Matches which are still being played when the test decides are
+    thrown away, so that they don't bias the verdict.
+
+    """
+    if max_matches is None:
+        max_matches = app.game_estimate_max_matches
+    seeds = random.Random(seed)
+    result = Estimate(app.game_estimate_indifference,
+                      app.game_estimate_error_rate)
+    workers = max(1, min(app.game_concurrency, max_matches))
+
+    def play(match_seed: int) -> typing.Optional[int]:
+        winner, _ = run_matches(app, fresh_agent(app, p1),
+                                fresh_agent(app, p2), seed=match_seed)
+        return winner
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = set()
+        submitted = 0
+        while True:
+            while submitted < max_matches and len(pending) < workers:
+                pending.add(executor.submit(play, seeds.getrandbits(32)))
+                submitted += 1
+            if not pending:
+                break
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                result.add(future.result())
+                if result.decided:
+                    break
+            if result.decided:
+                for future in pending:
+                    future.cancel()
+                break
+            if pending or submitted < max_matches:
+                yield result
+    result.finished = True
+    yield result
+
+
+def load_player(name: str) -> Player:
+    """A built-in agent by its name (``random`` or an action), or else
+    the code of the script at the path ``name``."""
+    if name == 'random':
+        return RandomAgent()
+    elif name in Action.__members__:
+        return FixedAgent(Action(name))
+    return pathlib.Path(name).read_text()
+
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('-c', '--config', type=pathlib.Path,
+                    help='configuration file')
+parser.add_argument('-n', '--max-matches', type=int,
+                    help='matches to play at most; game.estimate_max_matches '
+                         'by default')
+parser.add_argument('-s', '--seed', type=int,
+                    help='seed of the seeds of the matches')
+parser.add_argument('--json', action='store_true',
+                    help='print every update as a line of JSON')
+parser.add_argument('p1', help='script path, random or an action')
+parser.add_argument('p2', help='script path, random or an action')
+
+
+def main():
+    args = parser.parse_args()
+    if args.config is None:
+        app = App({})
+    elif args.config.is_file():
+        app = App.from_path(args.config)
+    else:
+        parser.error('file not found: {!s}'.format(args.config))
+    p1 = load_player(args.p1)
+    p2 = load_player(args.p2)
+    for result in estimate(app, p1, p2, args.max_matches, args.seed):
+        if args.json:
+            print(json.dumps(result.to_json()), flush=True)
+            continue
+        summary = result.to_json()
+        low, high = summary['p1_win_rate']
+        print(f'{summary["matches"]} matches: '
+              f'{summary["p1_wins"]}/{summary["draws"]}/'
+              f'{summary["p2_wins"]} (p1 wins {low:.2f}-{high:.2f}), '
+              f'LLR {summary["log_likelihood_ratio"]:+.2f} '
+              f'of ±{summary["bound"]:.2f}', flush=True)
+    if result.winner is not None:
+        print(f'p{result.winner + 1} is stronger')
+    elif result.even:
+        print('about as strong')
+    else:
+        print('undecided')
+    app.runner_pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,27 @@
 import collections
 import enum
+import functools
 import json
+import os
 import random
+import re
+import select
+import selectors
+import signal
 import subprocess
+import time
 import typing
 
 from .app import App
+from .metrics import AgentMetrics
+from .record import (EVENT_CODES, FAILED, Record, decode_match, dump_match,
+                     encode_match, encode_replay, unpack)
+from .zygote import ZygoteProcess
 
 
 class Action(enum.Enum):
+    # The order of the members gives the action codes stored in records,
+    # so new actions have to be added at the end.
     idle = 'idle'
     forward = 'forward'
     backward = 'backward'
@@ -19,9 +32,29 @@ class Action(enum.Enum):
     guard = 'guard'
 
 
+ACTIONS = list(Action)
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+
 class Agent:
 
+    __slots__ = ('player_number', 'initial_position', 'health',
+                 'last_action', 'last_inflicted_damage', 'position',
+                 'previous_actions', 'action_counts', 'guard_count',
+                 'pending_action', 'action_memo')
+
+    #: Whether the action of the agent only depends on its payload, so
+    #: that :func:`evaluate` may reuse its answers when
+    #: ``game.fast_forward`` is on.
+    deterministic = False
+
+    #: Whether the action of the agent doesn't depend on ``time_left``
+    #: either, so that :func:`evaluate` may also skip the cycles of a round
+    #: between two such agents.
+    ignores_time_left = False
+
     def __init__(self):
+        self.action_memo = {}
         self.reset_with(0, 0)
 
     def reset_with(self, player_number: int, position: int):
@@ -35,6 +68,9 @@ class Agent:
         self.last_inflicted_damage = 0
         self.position = self.initial_position
         self.previous_actions = collections.deque(maxlen=5)
+        # How many times each action appears in previous_actions, so that
+        # their diversity doesn't have to be counted on every hit.
+        self.action_counts = {}
         self.guard_count = 0
 
     def distance(self, opponent):
@@ -60,11 +96,49 @@ class Agent:
 
     def get_action(self, opponent, match_records: typing.Sequence[str],
                    time_left: int) -> Action:
-        action = self._get_action(opponent, match_records, time_left)
+        self.request_action(opponent, match_records, time_left)
+        return self.receive_action()
+
+    def request_action(self, opponent, match_records: typing.Sequence[str],
+                       time_left: int):
+        """Start choosing the next action.  It has to be picked up with
+        :meth:`receive_action`, so the actions of both players can be
+        requested before either of them is received."""
+        self.pending_action = self._get_action(opponent, match_records,
+                                               time_left)
+
+    def receive_action(self) -> Action:
+        action = self.pending_action
         self.last_action = action
-        self.previous_actions.append(action)
+        previous_actions = self.previous_actions
+        counts = self.action_counts
+        if len(previous_actions) == previous_actions.maxlen:
+            forgotten = previous_actions[0]
+            if counts[forgotten] == 1:
+                del counts[forgotten]
+            else:
+                counts[forgotten] -= 1
+        previous_actions.append(action)
+        counts[action] = counts.get(action, 0) + 1
         return action
 
+    def get_memoized_action(self, opponent,
+                            match_records: typing.Sequence[str],
+                            time_left: int) -> Action:
+        """:meth:`get_action` of a :attr:`deterministic` agent, which is
+        only asked once for the same payload."""
+        key = (self.distance(opponent), self.health, opponent.health,
+               opponent.last_action, self.last_inflicted_damage,
+               opponent.last_inflicted_damage, tuple(match_records),
+               None if self.ignores_time_left else time_left)
+        action = self.action_memo.get(key)
+        if action is None:
+            action = self.get_action(opponent, match_records, time_left)
+            self.action_memo[key] = action
+            return action
+        self.pending_action = action
+        return Agent.receive_action(self)
+
     def _get_action(self, opponent, match_records: typing.Sequence[str],
                     time_left: int) -> Action:
         raise NotImplementedError
@@ -95,6 +169,12 @@ class Agent:
 
 class FixedAgent(Agent):
 
+    __slots__ = 'action',
+
+    deterministic = True
+
+    ignores_time_left = True
+
     def __init__(self, action: Action):
         super(FixedAgent, self).__init__()
         self.action = action
@@ -106,6 +186,8 @@ class FixedAgent(Agent):
 
 class RandomAgent(Agent):
 
+    __slots__ = ()
+
     choices = list(Action.__members__.values())
 
     def _get_action(self, opponent, match_records: typing.Sequence[str],
@@ -113,6 +195,29 @@ class RandomAgent(Agent):
         return random.choice(self.choices)
 
 
+class ReplayAgent(Agent):
+    """Takes the actions recorded for a player in a :class:`~.record.Record`
+    again, failing where the player failed."""
+
+    __slots__ = 'actions', 'tick'
+
+    def __init__(self, actions: typing.Sequence[int]):
+        super(ReplayAgent, self).__init__()
+        self.actions = actions
+
+    def reset(self):
+        super(ReplayAgent, self).reset()
+        self.tick = 0
+
+    def _get_action(self, opponent, match_records: typing.Sequence[str],
+                    time_left: int) -> Action:
+        code = self.actions[self.tick]
+        self.tick += 1
+        if code == FAILED:
+            raise ScriptException('Failed in the recorded match.', None)
+        return ACTIONS[code]
+
+
 class ScriptException(Exception):
 
     def __init__(self, message: str, output: str):
@@ -124,88 +229,465 @@ class ScriptException(Exception):
         return f'{super(ScriptException, self).__str__()}: {self.output}'
 
 
+#: A comment with which a script declares what may be assumed of it, e.g.
+#: ``# dodo: deterministic, ignores-time-left``: that its action only
+#: depends on its payload, and that it doesn't depend on ``time_left``
+#: either (see :attr:`Agent.deterministic` and
+#: :attr:`Agent.ignores_time_left`).
+SCRIPT_TRAITS_PATTERN = re.compile(r'^#\s*dodo:(.*)$', re.MULTILINE)
+
+
+def script_traits(code: str) -> typing.FrozenSet[str]:
+    """What ``code`` declares of itself with
+    :const:`SCRIPT_TRAITS_PATTERN`."""
+    return frozenset(
+        trait.strip()
+        for match in SCRIPT_TRAITS_PATTERN.finditer(code)
+        for trait in match.group(1).split(',')
+    )
+
+
+#: Characters which stand for the results of previous rounds in the lean
+#: protocol, from the point of view of the player receiving them.
+LEAN_RECORDS = {True: 'W', False: 'L', None: 'D'}
+
+
+def spawn_runner(app: App, path: str, *options: str) -> subprocess.Popen:
+    """Start a runner of the script at ``path``, forked from
+    :attr:`~.app.App.zygote` if ``game.zygote`` is on, in the
+    :attr:`~.app.App.runner_environment`."""
+    if app.game_protocol != 1:
+        options += ('--protocol', str(app.game_protocol))
+    if app.game_bytecode_cache_dir:
+        options += ('--cache-dir', app.game_bytecode_cache_dir)
+    if app.game_cpu_limit is not None:
+        options += ('--cpu-limit', str(app.game_cpu_limit))
+    if app.game_memory_limit is not None:
+        options += ('--memory-limit', str(app.game_memory_limit))
+    if app.game_file_limit is not None:
+        options += ('--file-limit', str(app.game_file_limit))
+    if app.game_zygote:
+        return app.zygote.spawn([*options, path])
+    return subprocess.Popen([app.game_evaluator_path, *options, path],
+                            stdout=subprocess.PIPE,
+                            stdin=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            env=app.runner_environment)
+
+
+#: Exit status of a runner whose script ran out of memory.
+EXIT_MEMORY_LIMIT = 3
+
+#: Line which tells a persistent runner that a match is over, and which it
+#: answers with once the script has been started afresh for the next one,
+#: along with the CPU time and the maximum resident set size of the match.
+NEXT_MATCH = b'M'
+
+
+class RunnerUsage(typing.NamedTuple):
+    """What a runner, or a match of a persistent runner, used, and why it
+    exited."""
+
+    cpu_time: float
+
+    #: Maximum resident set size, in kilobytes.
+    max_rss: int
+
+    exit_reason: str
+
+
+def exit_reason(returncode: int) -> str:
+    if returncode == 0:
+        return 'exit'
+    elif returncode == EXIT_MEMORY_LIMIT:
+        return 'memory_limit'
+    elif returncode == -signal.SIGXCPU:
+        return 'cpu_limit'
+    elif returncode == -signal.SIGTERM:
+        return 'terminated'
+    elif returncode < 0:
+        return 'killed'
+    return 'error'
+
+
+def stop_runner(
+    handle: typing.Union[subprocess.Popen, ZygoteProcess]
+) -> typing.Optional[RunnerUsage]:
+    """Terminate a runner unless it has exited, and wait for it.  Its
+    resource usage is returned, unless something else has already waited
+    for it (e.g. :meth:`subprocess.Popen.poll`)."""
+    if isinstance(handle, ZygoteProcess):
+        handle.terminate()
+        returncode = handle.wait()
+        if handle.cpu_time is None:
+            return None
+        return RunnerUsage(handle.cpu_time, handle.max_rss,
+                           exit_reason(returncode))
+    if handle.returncode is not None:
+        return None
+    # Not Popen.terminate(), which reaps the runner if it has exited.
+    try:
+        os.kill(handle.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    try:
+        _, status, usage = os.wait4(handle.pid, 0)
+    except ChildProcessError:
+        handle.wait()
+        return None
+    if os.WIFSIGNALED(status):
+        handle.returncode = -os.WTERMSIG(status)
+    else:
+        handle.returncode = os.WEXITSTATUS(status)
+    return RunnerUsage(usage.ru_utime + usage.ru_stime, usage.ru_maxrss,
+                       exit_reason(handle.returncode))
+
+
 class ExternalScriptAgent(Agent):
 
     def __init__(self, app: App, path: str):
         super(ExternalScriptAgent, self).__init__()
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                traits = script_traits(f.read())
+        except OSError:
+            traits = frozenset()
+        self.deterministic = 'deterministic' in traits
+        self.ignores_time_left = (self.deterministic and
+                                  'ignores-time-left' in traits)
         self.handle = None
+        self.selector = None
+        self.buffer = bytearray()
+        self.eof = False
         self.path = path
         self.error = False
+        self.turn_timeout = app.game_turn_timeout
+        self.match_timeout = app.game_match_timeout
+        self.time_used = 0.0
+        self.replied_at = None
+        self.protocol = app.game_protocol
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.metrics = AgentMetrics()
         self.open_subprocess(app)
 
+    def reset(self):
+        super(ExternalScriptAgent, self).reset()
+        self.sent_fields = None
+
     def open_subprocess(self, app):
         if self.handle is not None:
-            self.handle.terminate()
-        self.handle = subprocess.Popen([app.game_evaluator_path, self.path],
-                                       stdout=subprocess.PIPE,
-                                       stdin=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
+            self.record_usage(stop_runner(self.handle))
+        self.attach(spawn_runner(app, self.path))
+
+    def record_usage(self, usage: typing.Optional[RunnerUsage]):
+        if usage is not None:
+            self.metrics.add_usage(usage)
+
+    def attach(self, handle: subprocess.Popen, spawned: bool=True):
+        """Talk to ``handle`` from now on.  If it has just been
+        ``spawned``, the time until its first reply is recorded as the
+        spawn time."""
+        if self.selector is not None:
+            self.selector.close()
+        self.handle = handle
+        self.spawned_at = time.monotonic() if spawned else None
+        self.buffer = bytearray()
+        self.eof = False
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(handle.stdout, selectors.EVENT_READ)
 
     def reinitiate(self, app):
         if self.error:
             self.open_subprocess(app)
             self.error = False
 
-    def _get_action(self, opponent, match_records: typing.Sequence[str],
-                    time_left: int) -> Action:
-        payload = json.dumps(self.build_payload(opponent, match_records,
-                                                time_left))
+    def fill(self):
+        chunk = os.read(self.handle.stdout.fileno(), 4096)
+        self.bytes_received += len(chunk)
+        if chunk:
+            self.buffer += chunk
+        else:
+            self.eof = True
+        if self.replied_at is None and self.has_line():
+            self.replied_at = time.monotonic()
+
+    def has_line(self) -> bool:
+        return self.eof or b'\n' in self.buffer
+
+    def read_line(self, deadline: float) -> typing.Optional[bytes]:
+        """Read a line from the script without blocking past ``deadline``
+        (in terms of :func:`time.monotonic`).  Returns :const:`None` if the
+        deadline has passed, or what's left if the script has exited."""
+        while True:
+            index = self.buffer.find(b'\n')
+            if index >= 0:
+                line = bytes(self.buffer[:index])
+                del self.buffer[:index + 1]
+                return line
+            elif self.eof:
+                line = bytes(self.buffer)
+                self.buffer.clear()
+                return line
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or not self.selector.select(timeout):
+                return None
+            self.fill()
+
+    def read_error(self) -> str:
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.handle.stderr, selectors.EVENT_READ)
+            if not selector.select(0):
+                return ''
+        err = os.read(self.handle.stderr.fileno(), 1024)
+        return err.decode('utf-8', 'replace')
+
+    def encode_lean_payload(self, opponent,
+                            match_records: typing.Sequence[str],
+                            time_left: int) -> str:
+        """Encode the payload in the lean protocol (version 2), which
+        :prog:`script_runner` turns back into the JSON the script expects.
+
+        The results of previous rounds are sent once at the beginning of
+        a round on a line starting with ``R``.  Then every tick is a line
+        of space-separated fields in the order of :meth:`build_payload`,
+        where a field which hasn't changed since the previous tick is
+        left empty.
+
+        """
+        fields = (
+            str(self.distance(opponent)),
+            str(time_left),
+            str(self.health),
+            str(opponent.health),
+            opponent.last_action.value if opponent.last_action else '-',
+            str(self.last_inflicted_damage),
+            str(opponent.last_inflicted_damage),
+        )
+        sent_fields = self.sent_fields
+        self.sent_fields = fields
+        if sent_fields is None:
+            records = ''.join(
+                LEAN_RECORDS[x == self.player_number if x is not None
+                             else None]
+                for x in match_records
+            )
+            return f'R {records}\n' + ' '.join(fields) + '\n'
+        return ' '.join(
+            '' if field == sent else field
+            for field, sent in zip(fields, sent_fields)
+        ) + '\n'
+
+    def request_action(self, opponent, match_records: typing.Sequence[str],
+                       time_left: int):
+        if self.protocol == 1:
+            payload = json.dumps(self.build_payload(
+                opponent, match_records, time_left
+            )) + '\n'
+        else:
+            payload = self.encode_lean_payload(opponent, match_records,
+                                               time_left)
+        data = payload.encode('utf-8')
+        self.bytes_sent += len(data)
         try:
-            self.handle.stdin.write(payload.encode('utf-8'))
-            self.handle.stdin.write(b'\n')
+            self.handle.stdin.write(data)
             self.handle.stdin.flush()
         except Exception:
-            err = self.handle.stderr.read(1024).decode('utf-8')
             self.error = True
-            raise ScriptException('Broken pipe.', err)
-        action = self.handle.stdout.readline().decode('utf-8').strip()
+            self.metrics.errors['broken_pipe'] += 1
+            raise ScriptException('Broken pipe.', self.read_error())
+        self.requested_at = time.monotonic()
+        # When the reply was read in full, which may be well before it's
+        # received if the other player of a concurrent turn was slower.
+        self.replied_at = None
+        self.deadline = self.requested_at + min(
+            self.turn_timeout, self.match_timeout - self.time_used
+        )
+
+    def receive_action(self) -> Action:
+        line = self.read_line(self.deadline)
+        now = time.monotonic()
+        if line is not None and self.replied_at is not None:
+            now = self.replied_at
+        self.time_used += now - self.requested_at
+        if self.spawned_at is None:
+            self.metrics.turn_latency.observe(now - self.requested_at)
+        else:
+            # The first reply of a new runner mostly waits for it to start.
+            self.metrics.spawn_time.observe(now - self.spawned_at)
+            self.spawned_at = None
+        if line is None:
+            self.error = True
+            self.metrics.errors['timeout'] += 1
+            raise ScriptException('Timed out.', self.read_error())
+        action = line.decode('utf-8').strip()
         if not action:
-            err = self.handle.stderr.read(1024).decode('utf-8')
             self.error = True
-            raise ScriptException('Unexpected end of file.', err)
+            self.metrics.errors['end_of_file'] += 1
+            raise ScriptException('Unexpected end of file.',
+                                  self.read_error())
         try:
-            return Action(action)
+            self.pending_action = Action(action)
         except ValueError:
             self.error = True
+            self.metrics.errors['unknown_action'] += 1
             raise ScriptException(f'Unknown action {action}', None)
+        return super(ExternalScriptAgent, self).receive_action()
+
+    def __enter__(self):
+        self.time_used = 0.0
 
     def __exit__(self, exception_type, exception_value, traceback):
         if self.handle is not None:
-            self.handle.terminate()
-
-
-def evaluate(app: App, p1: Agent, p2: Agent,
-             match_records: typing.Sequence[str], raise_: bool=False):
-    record = []
-    time_left = app.game_round_time
-
-    p1.reset_with(0, app.game_p1_initial_position)
-    p2.reset_with(1, app.game_p2_initial_position)
-
-    def put_record(action: str, **kwargs):
-        record.append({
-            'action': action, 'time': time_left,
-            'p1': {'health': p1.health, 'position': p1.position},
-            'p2': {'health': p2.health, 'position': p2.position},
-            **kwargs})
-
-    while time_left >= 0:
+            self.record_usage(stop_runner(self.handle))
+        if self.selector is not None:
+            self.selector.close()
+
+
+def wait_for_replies(agents: typing.Iterable[Agent]):
+    """Wait until every :class:`ExternalScriptAgent` among ``agents`` has
+    replied, exited or passed its deadline, reading from all of them at
+    the same time."""
+    waiting = {
+        agent.handle.stdout.fileno(): agent
+        for agent in agents
+        if isinstance(agent, ExternalScriptAgent) and not agent.has_line()
+    }
+    while waiting:
+        now = time.monotonic()
+        for fd, agent in list(waiting.items()):
+            if agent.deadline <= now:
+                del waiting[fd]
+        if not waiting:
+            break
+        deadline = min(agent.deadline for agent in waiting.values())
+        ready, _, __ = select.select(list(waiting), [], [], deadline - now)
+        for fd in ready:
+            agent = waiting[fd]
+            agent.fill()
+            if agent.has_line():
+                del waiting[fd]
+
+
+def get_actions(p1: Agent, p2: Agent, match_records: typing.Sequence[str],
+                time_left: int, raise_: bool=False
+                ) -> typing.Tuple[typing.Optional[Action],
+                                  typing.Optional[Action]]:
+    """Request the actions of both players before receiving either, so
+    that two scripts think at the same time.  A player whose action
+    could not be received gets :const:`None`.
+
+    Unlike asking one after the other as :func:`evaluate` does by
+    default, both payloads are built from the state at the beginning of
+    the tick; p2 sees the previous action of p1 as ``opponent_action``,
+    not the one p1 is about to take.
+
+    """
+    agents = p1, p2
+    requested = []
+    actions = [None, None]
+    for agent, opponent in ((p1, p2), (p2, p1)):
         try:
-            p1a = p1.get_action(p2, match_records, time_left)
+            agent.request_action(opponent, match_records, time_left)
         except ScriptException:
             if raise_:
                 raise
-            p1_failed = True
         else:
-            p1_failed = False
+            requested.append(agent)
+    wait_for_replies(requested)
+    for i, agent in enumerate(agents):
+        if agent in requested:
+            try:
+                actions[i] = agent.receive_action()
+            except ScriptException:
+                if raise_:
+                    raise
+    return actions[0], actions[1]
+
+
+def ask_actions(p1: Agent, p2: Agent, match_records: typing.Sequence[str],
+                time_left: int, raise_: bool=False, concurrent: bool=False,
+                memoize: bool=False
+                ) -> typing.Tuple[typing.Optional[Action],
+                                  typing.Optional[Action]]:
+    """The actions of both players for a tick, p1 first and then p2
+    unless ``concurrent`` (see :func:`get_actions`).  A player whose
+    action could not be received gets :const:`None`.  With ``memoize``
+    both have to be :attr:`~Agent.deterministic`."""
+    if concurrent:
+        return get_actions(p1, p2, match_records, time_left, raise_)
+    actions = [None, None]
+    for i, (agent, opponent) in enumerate(((p1, p2), (p2, p1))):
         try:
-            p2a = p2.get_action(p1, match_records, time_left)
+            if memoize:
+                actions[i] = agent.get_memoized_action(opponent,
+                                                       match_records,
+                                                       time_left)
+            else:
+                actions[i] = agent.get_action(opponent, match_records,
+                                              time_left)
         except ScriptException:
             if raise_:
                 raise
-            p2_failed = True
-        else:
-            p2_failed = False
+    return actions[0], actions[1]
+
+
+def cycle_state(p1: Agent, p2: Agent) -> typing.Tuple:
+    """Everything the rest of a round depends on, apart from the time left
+    and the random numbers, if both players are deterministic and ignore
+    the time left."""
+    return (
+        p1.health, p1.position, p1.last_action, p1.last_inflicted_damage,
+        tuple(p1.previous_actions), p1.guard_count,
+        p2.health, p2.position, p2.last_action, p2.last_inflicted_damage,
+        tuple(p2.previous_actions), p2.guard_count,
+    )
+
+
+def evaluate(app: App, p1: Agent, p2: Agent,
+             match_records: typing.Sequence[str], raise_: bool=False,
+             seed: typing.Optional[int]=None):
+    """Play a round.  This is the reference implementation of the rules;
+    :func:`~.rules.play_round` plays the same rounds faster, and is used
+    if ``game.engine`` is ``'table'``."""
+    if seed is None:
+        seed = random.getrandbits(32)
+    rng = random.Random(seed)
+    record = Record(seed)
+    time_left = app.game_round_time
+
+    p1.reset_with(0, app.game_p1_initial_position)
+    p2.reset_with(1, app.game_p2_initial_position)
+
+    def put_record(action: str, damage: typing.Optional[int]=None):
+        record.put(EVENT_CODES[action], time_left,
+                   p1.health, p1.position, p2.health, p2.position, damage)
+
+    # If both players are deterministic, they're asked only once for the
+    # same payload.  If they ignore the time left as well and the state
+    # comes back to what it was some ticks ago without any damage (and
+    # thus random numbers) in between, the round repeats those ticks until
+    # the time is over.
+    memoize = (app.game_fast_forward and
+               p1.deterministic and p2.deterministic)
+    fast_forward = (memoize and
+                    p1.ignores_time_left and p2.ignores_time_left)
+    seen_states = {}
+    while time_left >= 0:
+        if fast_forward:
+            state = cycle_state(p1, p2)
+            since, damages = seen_states.get(state, (None, None))
+            if damages == len(record.damages):
+                record.repeat_ticks(since, time_left, app.game_round_time)
+                time_left = -1
+                break
+            seen_states[state] = time_left, len(record.damages)
+        p1a, p2a = ask_actions(p1, p2, match_records, time_left, raise_,
+                               app.game_concurrent_turns, memoize)
+        p1_failed = p1a is None
+        p2_failed = p2a is None
+        record.act(FAILED if p1_failed else ACTION_CODES[p1a],
+                   FAILED if p2_failed else ACTION_CODES[p2a])
         if p1_failed and p2_failed:
             put_record('both_error')
             return None, record
@@ -246,12 +728,12 @@ def evaluate(app: App, p1: Agent, p2: Agent,
                 p2.guard_count += 2
                 put_record('p1_punch_avoid')
             elif p2a is Action.guard:
-                damage = random.randrange(*app.game_hit_point_guard_range)
+                damage = rng.randrange(*app.game_hit_point_guard_range)
                 p2.guard_count += 1
                 p1.inflict_damage(p2, damage)
                 put_record('p1_punch_guard', damage=damage)
             else:
-                damage = random.randrange(*app.game_hit_point_range)
+                damage = rng.randrange(*app.game_hit_point_range)
                 p1.inflict_damage(p2, damage)
                 put_record('p1_punch', damage=damage)
             p1_idle = False
@@ -262,12 +744,12 @@ def evaluate(app: App, p1: Agent, p2: Agent,
                 p2.guard_count += 2
                 put_record('p1_kick_avoid')
             elif p2a is Action.guard:
-                damage = random.randrange(*app.game_hit_point_guard_range)
+                damage = rng.randrange(*app.game_hit_point_guard_range)
                 p2.guard_count += 1
                 p1.inflict_damage(p2, damage)
                 put_record('p1_kick_guard', damage=damage)
             else:
-                damage = random.randrange(*app.game_hit_point_range)
+                damage = rng.randrange(*app.game_hit_point_range)
                 p1.inflict_damage(p2, damage)
                 put_record('p1_kick', damage=damage)
             p1_idle = False
@@ -281,12 +763,12 @@ def evaluate(app: App, p1: Agent, p2: Agent,
                 p1.guard_count += 2
                 put_record('p2_punch_avoid')
             elif p1a is Action.guard:
-                damage = random.randrange(*app.game_hit_point_guard_range)
+                damage = rng.randrange(*app.game_hit_point_guard_range)
                 p1.guard_count += 1
                 p2.inflict_damage(p1, damage)
                 put_record('p2_punch_guard', damage=damage)
             else:
-                damage = random.randrange(*app.game_hit_point_range)
+                damage = rng.randrange(*app.game_hit_point_range)
                 p2.inflict_damage(p1, damage)
                 put_record('p2_punch', damage=damage)
             p2_idle = False
@@ -297,12 +779,12 @@ def evaluate(app: App, p1: Agent, p2: Agent,
                 p1.guard_count += 2
                 put_record('p2_kick_avoid')
             elif p1a is Action.guard:
-                damage = random.randrange(*app.game_hit_point_guard_range)
+                damage = rng.randrange(*app.game_hit_point_guard_range)
                 p1.guard_count += 1
                 p2.inflict_damage(p1, damage)
                 put_record('p2_kick_guard', damage=damage)
             else:
-                damage = random.randrange(*app.game_hit_point_range)
+                damage = rng.randrange(*app.game_hit_point_range)
                 p2.inflict_damage(p1, damage)
                 put_record('p2_kick', damage=damage)
             p2_idle = False
@@ -325,11 +807,26 @@ def evaluate(app: App, p1: Agent, p2: Agent,
         return 1, record
 
 
-def run_matches(app: App,
-                p1: typing.Union[Agent, str],
-                p2: typing.Union[Agent, str],
-                raise_: bool=False):
-    data = []
+def round_player(app: App) -> typing.Callable[..., typing.Tuple]:
+    """The engine ``game.engine`` picks, as a function which takes the
+    rest of the arguments of :func:`evaluate`."""
+    if app.game_engine != 'table':
+        return functools.partial(evaluate, app)
+    from .rules import play_round
+    return functools.partial(play_round, app.game_rules)
+
+
+def iter_matches(app: App,
+                 p1: typing.Union[Agent, str],
+                 p2: typing.Union[Agent, str],
+                 raise_: bool=False,
+                 seed: typing.Optional[int]=None
+                 ) -> typing.Iterator[typing.Tuple[typing.Optional[int],
+                                                   Record]]:
+    """Play a match like :func:`run_matches`, yielding the winner and the
+    record of every round as soon as the round is over.  Closing the
+    iterator early stops the match and releases both agents."""
+    seeds = random.Random(seed)
     wins = [0, 0]
     if isinstance(p1, str):
         p1a = ExternalScriptAgent(app, p1)
@@ -343,11 +840,13 @@ def run_matches(app: App,
         raise TypeError('p2 should be an agent or a string')
     else:
         p2a = p2
+    play = round_player(app)
     with p1a, p2a:
         match_records = []
         for i in range(app.game_round_count):
-            winner, matchdata = evaluate(app, p1a, p2a, match_records, raise_)
-            data.append(matchdata)
+            winner, matchdata = play(p1a, p2a, match_records, raise_,
+                                     seeds.getrandbits(32))
+            yield winner, matchdata
             match_records.append(winner)
             if winner is not None:
                 wins[winner] += 1
@@ -358,12 +857,81 @@ def run_matches(app: App,
                 p1a.reinitiate(app)
             if isinstance(p2a, ExternalScriptAgent) and p2a.error:
                 p2a.reinitiate(app)
+
+
+def match_winner(
+    round_winners: typing.Iterable[typing.Optional[int]]
+) -> typing.Optional[int]:
+    """The winner of a match by the winners of its rounds: whoever won
+    more of them, or :const:`None` for a draw."""
+    wins = [0, 0]
+    for winner in round_winners:
+        if winner is not None:
+            wins[winner] += 1
     if wins[0] == wins[1]:
-        return None, data
+        return None
     elif wins[0] > wins[1]:
-        return 0, data
+        return 0
     else:
-        return 1, data
+        return 1
+
+
+def run_matches(app: App,
+                p1: typing.Union[Agent, str],
+                p2: typing.Union[Agent, str],
+                raise_: bool=False,
+                seed: typing.Optional[int]=None):
+    """Play a match.  The random numbers of all its rounds are drawn from
+    ``seed``, so the same agents taking the same actions with the same
+    seed play the same match."""
+    rounds = list(iter_matches(app, p1, p2, raise_, seed))
+    return (match_winner(winner for winner, _ in rounds),
+            [record for _, record in rounds])
+
+
+def rules_config(app: App) -> typing.Mapping[str, int]:
+    """The ``game.*`` configuration a round depends on."""
+    return {
+        'duration': app.game_round_time,
+        'hit_point_min': app.game_hit_point_min,
+        'hit_point_max': app.game_hit_point_max,
+        'hit_point_guard_min': app.game_hit_point_guard_min,
+        'hit_point_guard_max': app.game_hit_point_guard_max,
+        'p1_initial_position': app.game_p1_initial_position,
+        'p2_initial_position': app.game_p2_initial_position,
+    }
+
+
+@functools.lru_cache(maxsize=1024)
+def replay_round(rules: typing.Tuple[typing.Tuple[str, int], ...], seed: int,
+                 p1_actions: str, p2_actions: str) -> Record:
+    app = App({'game': dict(rules)})
+    _, record = round_player(app)(ReplayAgent(unpack(p1_actions)),
+                                  ReplayAgent(unpack(p2_actions)),
+                                  [], seed=seed)
+    return record
+
+
+def store_match(app: App, records: typing.Sequence[Record]):
+    """Encode a match to be stored in :attr:`~.entities.Match.match_data`,
+    either in full or as a replay, according to ``game.match_storage``."""
+    if app.game_match_storage == 'replay':
+        return encode_replay(rules_config(app), records)
+    return encode_match(records)
+
+
+def load_match(data) -> typing.List[Record]:
+    """Get the records of a match stored by :func:`store_match`, playing
+    it again if it was stored as a replay.  Recently played replays are
+    cached."""
+    if isinstance(data, list) or data.get('mode', 'full') == 'full':
+        return decode_match(data)
+    rules = tuple(sorted(data['rules'].items()))
+    return [
+        replay_round(rules, round_['seed'],
+                     round_['p1_actions'], round_['p2_actions'])
+        for round_ in data['rounds']
+    ]
 
 
 def test():
@@ -385,7 +953,7 @@ def test():
     else:
         p1 = FixedAgent(Action.idle)
     winner, data = run_matches(app, p1, p2, raise_=True)
-    pprint.pprint(data)
+    pprint.pprint(dump_match(data))
     print(winner)
 
 
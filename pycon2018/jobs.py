@@ -0,0 +1,322 @@
+"""Queue of evaluations which are too slow to run in a request: playing a
+test match in the playground, validating a submission, and rating the new
+submissions of a league.
+
+With ``game.job_queue`` on, the web server only stores a
+:class:`~.entities.Job` and answers with its id, and the client polls
+``/jobs/<id>`` until it's done.  Jobs are run by worker processes,
+``game.worker_processes`` of them, which are started separately::
+
+    $ python worker.py local.toml
+
+A test match asked for as a stream is published round by round in
+:attr:`~.entities.Job.progress` instead, which the web server streams to
+the client while the match goes on.
+
+While a worker runs a job, it touches :attr:`~.entities.Job.heartbeat_at`
+every ``game.job_heartbeat_interval`` seconds.  A running job whose
+heartbeat is older than ``game.job_timeout`` seconds is taken as one whose
+worker has died, and is run again by another worker.
+
+Without it, :func:`dispatch` runs the evaluation right away, as the web
+server always used to.
+
+"""
+import contextlib
+import datetime
+import logging
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+import typing
+import uuid
+
+from sqlalchemy.orm.session import Session
+from sqlalchemy.sql.expression import and_, or_
+
+from .app import App
+from .cache import (Player, is_validated, iter_cached_matches, mark_validated,
+                    run_cached_matches)
+from .entities import Audit, Job, Submission, Tournament, User
+from .game import (Action, FixedAgent, RandomAgent, ScriptException,
+                   match_winner, run_matches)
+from .league import update_league
+from .record import FORMAT_VERSION, Record, dump_match
+from .util import make_tempfile_public, utcnow
+
+__all__ = ('HANDLERS', 'Publish', 'claim_job', 'dispatch', 'enqueue',
+           'match_lines', 'playground_opponent', 'rate_league', 'run_job',
+           'submit_code', 'test_code', 'work')
+
+
+logger = logging.getLogger(__name__)
+
+Handler = typing.Callable[..., typing.Mapping[str, typing.Any]]
+
+Publish = typing.Callable[[typing.Mapping[str, typing.Any]], None]
+
+#: Functions which run the jobs of each kind.  They take the app, a session,
+#: the user who asked for the job and a :data:`Publish` function which adds
+#: a line to the progress of the job, plus the payload of the job as
+#: keyword arguments, and return the response to the user.
+HANDLERS: typing.Dict[str, Handler] = {}
+
+
+def handler(kind: str) -> typing.Callable[[Handler], Handler]:
+    def register(function: Handler) -> Handler:
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+def playground_opponent(code: str, opponent: str) -> Player:
+    """The ``opponent`` (``clone``, ``random`` or an action) to test
+    ``code`` against in the playground."""
+    if opponent == 'clone':
+        return code
+    elif opponent == 'random':
+        return RandomAgent()
+    return FixedAgent(Action(opponent))
+
+
+def match_lines(
+    p1: typing.Mapping[str, typing.Any], p2: typing.Mapping[str, typing.Any],
+    rounds: typing.Iterator[typing.Tuple[typing.Optional[int], Record]],
+    compact: bool=False
+) -> typing.Iterator[typing.Mapping[str, typing.Any]]:
+    """A match as lines to stream while its rounds are played: the players
+    first, then every round as soon as it's over, and the winner of the
+    match last, or an error if a script fails."""
+    names = {0: 'p1', 1: 'p2'}
+    header = {'type': 'match', 'p1': p1, 'p2': p2}
+    if compact:
+        header['version'] = FORMAT_VERSION
+    yield header
+    winners = []
+    try:
+        for index, (winner, record) in enumerate(rounds):
+            winners.append(winner)
+            yield {
+                'type': 'round',
+                'index': index,
+                'winner': names.get(winner),
+                'data': record.encode() if compact else record.to_json(),
+            }
+    except ScriptException as e:
+        yield {'type': 'error', 'result': 'failed', 'error': 'script_error',
+               'output': e.output or e.message}
+        return
+    yield {'type': 'result', 'winner': names.get(match_winner(winners))}
+
+
+@handler('test')
+def test_code(app: App, session: Session, user: User, publish: Publish,
+              code: str, opponent: str, p1: typing.Mapping,
+              p2: typing.Mapping, compact: bool=False,
+              stream: bool=False) -> typing.Mapping[str, typing.Any]:
+    """Play a match between ``code`` and the ``opponent`` for the
+    playground, or serve it from the result cache.  If ``stream`` is
+    true, every round is also published as soon as it's over (see
+    :func:`match_lines`)."""
+    agent = playground_opponent(code, opponent)
+    if stream:
+        records = []
+
+        def rounds():
+            for winner, record in iter_cached_matches(app, session, code,
+                                                      agent, True):
+                records.append(record)
+                yield winner, record
+        for line in match_lines(p1, p2, rounds(), compact):
+            publish(line)
+        if line['type'] == 'error':
+            return {k: v for k, v in line.items() if k != 'type'}
+        winner, data = line['winner'], records
+    else:
+        try:
+            winner, data = run_cached_matches(app, session, code, agent,
+                                              True)
+        except ScriptException as e:
+            return {'result': 'failed', 'error': 'script_error',
+                    'output': e.output or e.message}
+        winner = {0: 'p1', 1: 'p2'}.get(winner)
+    match = {
+        'p1': p1,
+        'p2': p2,
+        'winner': winner,
+        'data': dump_match(data, compact),
+    }
+    return {'result': 'success', 'match': match}
+
+
+@handler('submit')
+def submit_code(app: App, session: Session, user: User, publish: Publish,
+                code: str,
+                tournament_id: str) -> typing.Mapping[str, typing.Any]:
+    """Validate ``code`` with a test match unless it's already validated,
+    and make it the submission of the ``user``."""
+    tournament = session.query(Tournament).filter_by(
+        id=uuid.UUID(tournament_id)
+    ).one()
+    if not is_validated(session, app, code):
+        with tempfile.NamedTemporaryFile() as tf:
+            make_tempfile_public(tf)
+            tf.write(code.encode('utf-8'))
+            tf.flush()
+            try:
+                winner, _ = run_matches(app, tf.name,
+                                        FixedAgent(Action.idle))
+                if winner != 0:
+                    return {'result': 'failed', 'error': 'test_not_passed'}
+            except ScriptException as e:
+                return {'result': 'failed', 'error': 'error_in_code',
+                        'output': e.output}
+        mark_validated(session, app, code)
+    submission = session.query(Submission).filter_by(
+        user=user,
+        tournament=tournament
+    ).one_or_none()
+    if submission:
+        submission.code = code
+        submission.created_at = utcnow()
+    else:
+        submission = Submission(tournament=tournament, user=user, code=code)
+        session.add(submission)
+    session.add(Audit(user=user, code=code))
+    session.commit()
+    return {'result': 'success'}
+
+
+@handler('league')
+def rate_league(app: App, session: Session, user: User, publish: Publish,
+                tournament_id: str) -> typing.Mapping[str, typing.Any]:
+    """Rate the new and updated submissions of a tournament in its league.
+    The first run over a large field may take long; it can also be done
+    with ``python -m pycon2018.league``."""
+    tournament = session.query(Tournament).filter_by(
+        id=uuid.UUID(tournament_id)
+    ).one()
+    matches = update_league(session, app, tournament)
+    return {'result': 'success', 'matches': matches}
+
+
+def enqueue(session: Session, kind: str, user: User,
+            payload: typing.Mapping[str, typing.Any]) -> Job:
+    job = Job(kind=kind, user=user, payload=payload)
+    session.add(job)
+    session.commit()
+    return job
+
+
+def dispatch(app: App, session: Session, kind: str, user: User,
+             payload: typing.Mapping[str, typing.Any],
+             job_url: typing.Callable[[Job], str]
+             ) -> typing.Mapping[str, typing.Any]:
+    """Queue a job if ``game.job_queue`` is on, and return where to poll
+    for it; or else run it and return its response."""
+    if not app.game_job_queue:
+        return HANDLERS[kind](app, session, user, lambda line: None,
+                              **payload)
+    job = enqueue(session, kind, user, payload)
+    return {'result': 'queued', 'job_id': str(job.id), 'url': job_url(job)}
+
+
+def claim_job(app: App, session: Session, worker: str) -> typing.Optional[Job]:
+    """Take the oldest queued job, or one whose worker seems to have died
+    as it hasn't sent a heartbeat for ``game.job_timeout`` seconds.
+    Workers skip the rows others have locked, so they never take the same
+    job."""
+    stale = utcnow() - datetime.timedelta(seconds=app.game_job_timeout)
+    job = session.query(Job).filter(
+        or_(Job.status == 'queued',
+            and_(Job.status == 'running', Job.heartbeat_at < stale))
+    ).order_by(Job.created_at).with_for_update(skip_locked=True).first()
+    if job is not None:
+        job.status = 'running'
+        job.started_at = job.heartbeat_at = utcnow()
+        job.worker = worker
+        job.progress = None
+    session.commit()
+    return job
+
+
+@contextlib.contextmanager
+def heartbeat(app: App, job_id: uuid.UUID, worker: str):
+    """Touch :attr:`~.entities.Job.heartbeat_at` of the job every
+    ``game.job_heartbeat_interval`` seconds while the block runs.  It's
+    done from a thread with a session of its own, so that handlers which
+    take long in a single call keep their job too."""
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(app.game_job_heartbeat_interval):
+            session = app.create_session()
+            try:
+                session.query(Job).filter_by(id=job_id, worker=worker).update(
+                    {'heartbeat_at': utcnow()}, synchronize_session=False
+                )
+                session.commit()
+            except Exception:
+                session.rollback()
+                logger.exception('Failed to send a heartbeat of job %s.',
+                                 job_id)
+            finally:
+                session.close()
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run_job(app: App, session: Session, job: Job):
+    def publish(line: typing.Mapping[str, typing.Any]):
+        job.progress = (job.progress or []) + [line]
+        job.heartbeat_at = utcnow()
+        session.commit()
+    try:
+        with heartbeat(app, job.id, job.worker):
+            result = HANDLERS[job.kind](app, session, job.user, publish,
+                                        **job.payload)
+    except Exception:
+        session.rollback()
+        logger.exception('Job %s (%s) failed.', job.id, job.kind)
+        job.status = 'failed'
+        job.result = {'result': 'failed', 'error': 'internal_error'}
+    else:
+        job.status = 'done'
+        job.result = result
+    job.finished_at = utcnow()
+    session.commit()
+
+
+def work(app: App, name: typing.Optional[str]=None):
+    """Run jobs until SIGTERM or SIGINT.  The job in progress is finished
+    before returning."""
+    if name is None:
+        name = f'{socket.gethostname()}:{os.getpid()}'
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info('Worker %s started.', name)
+    while not stopping:
+        session = app.create_session()
+        try:
+            job = claim_job(app, session, name)
+            if job is None:
+                time.sleep(app.game_job_poll_interval)
+                continue
+            logger.debug('Worker %s runs job %s (%s).', name, job.id,
+                         job.kind)
+            run_job(app, session, job)
+        finally:
+            session.close()
+    logger.info('Worker %s stopped.', name)
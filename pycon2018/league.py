@@ -0,0 +1,233 @@
+"""League mode, which rates every submission of a tournament by its results
+against the others instead of knocking it out after a single match.
+
+Ratings are Elo ratings kept in :class:`~.entities.LeagueRating`, and the
+results they were made of in :class:`~.entities.LeagueResult`.
+:func:`update_league` only plays the matches of submissions which are new
+or whose code has changed since they were rated: every pair of them if the
+field has at most ``game.league_round_robin_limit`` submissions, or else
+``game.league_swiss_rounds`` rounds against opponents of a similar rating.
+
+As that may be a lot of matches, the admin page rates a league through the
+job queue (see :mod:`.jobs`).  It can also be rated from the command line::
+
+    $ python -m pycon2018.league local.toml TOURNAMENT_ID
+
+"""
+import argparse
+import pathlib
+import random
+import typing
+import uuid
+
+from sqlalchemy.orm.session import Session
+from sqlalchemy.sql.expression import or_
+
+from .app import App
+from .entities import LeagueRating, LeagueResult, Submission, Tournament
+from .pool import code_hash, run_matches_concurrently
+
+__all__ = ('expected_score', 'get_standings', 'play_league_matches',
+           'round_robin_pairs', 'swiss_pairs', 'sync_ratings',
+           'update_league')
+
+
+Pair = typing.Tuple[LeagueRating, LeagueRating]
+
+
+def expected_score(rating: float, opponent_rating: float) -> float:
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def sync_ratings(
+    session: Session, app: App, tournament: Tournament
+) -> typing.Tuple[typing.Mapping[uuid.UUID, LeagueRating],
+                  typing.List[LeagueRating]]:
+    """Make sure every submission of ``tournament`` has a rating, and
+    return all ratings by submission id along with those which have to be
+    (re)rated.
+
+    The results of an updated submission are thrown away, and so are the
+    wins, losses and draws they gave to its opponents; the rating points
+    the opponents won or lost are kept, like in any Elo system.
+
+    """
+    ratings = {
+        rating.submission_id: rating
+        for rating in session.query(LeagueRating).filter_by(
+            tournament=tournament
+        )
+    }
+    changed = []
+    for submission in session.query(Submission).filter_by(
+        tournament=tournament
+    ):
+        hash_ = code_hash(submission.code)
+        rating = ratings.get(submission.id)
+        if rating is None:
+            rating = LeagueRating(tournament=tournament,
+                                  submission=submission)
+            session.add(rating)
+            ratings[submission.id] = rating
+        elif rating.code_hash == hash_:
+            continue
+        rating.code_hash = hash_
+        rating.rating = app.game_league_initial_rating
+        rating.wins = rating.losses = rating.draws = 0
+        changed.append(rating)
+    changed_ids = {rating.submission_id for rating in changed
+                   if rating.submission_id is not None}
+    if changed_ids:
+        stale = session.query(LeagueResult).filter(
+            or_(LeagueResult.p1_id.in_(list(changed_ids)),
+                LeagueResult.p2_id.in_(list(changed_ids)))
+        )
+        for result in stale:
+            for player, submission_id in enumerate((result.p1_id,
+                                                    result.p2_id)):
+                if submission_id in changed_ids:
+                    continue
+                rating = ratings[submission_id]
+                if result.winner is None:
+                    rating.draws -= 1
+                elif result.winner == player:
+                    rating.wins -= 1
+                else:
+                    rating.losses -= 1
+            session.delete(result)
+    session.flush()
+    return ratings, changed
+
+
+def round_robin_pairs(
+    ratings: typing.Mapping[uuid.UUID, LeagueRating],
+    changed: typing.Sequence[LeagueRating]
+) -> typing.List[Pair]:
+    """Every pair which involves a changed rating, once."""
+    done = set()
+    pairs = []
+    for rating in changed:
+        done.add(rating.submission_id)
+        for opponent in ratings.values():
+            if opponent.submission_id not in done:
+                pairs.append((rating, opponent))
+    return pairs
+
+
+def swiss_pairs(
+    ratings: typing.Mapping[uuid.UUID, LeagueRating],
+    changed: typing.Sequence[LeagueRating],
+    played: typing.AbstractSet[typing.FrozenSet[uuid.UUID]]
+) -> typing.List[Pair]:
+    """A round in which every changed rating plays the closest rated
+    opponent it hasn't played yet.  A changed rating plays at most once a
+    round, but others may be picked by several."""
+    changed_ids = {rating.submission_id for rating in changed}
+    busy = set()
+    pairs = []
+    opponents = list(ratings.values())
+    random.shuffle(opponents)
+    for rating in sorted(changed, key=lambda r: r.rating, reverse=True):
+        if rating.submission_id in busy:
+            continue
+        candidates = sorted(opponents,
+                            key=lambda o: abs(o.rating - rating.rating))
+        for opponent in candidates:
+            pair = frozenset((rating.submission_id, opponent.submission_id))
+            if (opponent is rating or opponent.submission_id in busy or
+                    pair in played):
+                continue
+            pairs.append((rating, opponent))
+            busy.add(rating.submission_id)
+            if opponent.submission_id in changed_ids:
+                busy.add(opponent.submission_id)
+            break
+    return pairs
+
+
+def play_league_matches(session: Session, app: App, tournament: Tournament,
+                        pairs: typing.Sequence[Pair]):
+    """Play ``pairs`` at the same time, and record their results and the
+    rating changes in the order of ``pairs``."""
+    results = run_matches_concurrently(app, [
+        (p1.submission.code, p2.submission.code) for p1, p2 in pairs
+    ])
+    k = app.game_league_k_factor
+    for (p1, p2), (winner, _, __) in zip(pairs, results):
+        session.add(LeagueResult(
+            tournament=tournament,
+            p1_id=p1.submission_id, p1_code_hash=p1.code_hash,
+            p2_id=p2.submission_id, p2_code_hash=p2.code_hash,
+            winner=winner
+        ))
+        if winner is None:
+            score = 0.5
+            p1.draws += 1
+            p2.draws += 1
+        elif winner == 0:
+            score = 1.0
+            p1.wins += 1
+            p2.losses += 1
+        else:
+            score = 0.0
+            p1.losses += 1
+            p2.wins += 1
+        delta = k * (score - expected_score(p1.rating, p2.rating))
+        p1.rating += delta
+        p2.rating -= delta
+
+
+def update_league(session: Session, app: App, tournament: Tournament) -> int:
+    """Rate the new and updated submissions of ``tournament``, and return
+    how many matches it took."""
+    ratings, changed = sync_ratings(session, app, tournament)
+    matches = 0
+    if not changed:
+        session.commit()
+        return matches
+    if len(ratings) <= app.game_league_round_robin_limit:
+        pairs = round_robin_pairs(ratings, changed)
+        play_league_matches(session, app, tournament, pairs)
+        matches += len(pairs)
+    else:
+        played = set()
+        for _ in range(app.game_league_swiss_rounds):
+            pairs = swiss_pairs(ratings, changed, played)
+            if not pairs:
+                break
+            play_league_matches(session, app, tournament, pairs)
+            played.update(frozenset((p1.submission_id, p2.submission_id))
+                          for p1, p2 in pairs)
+            matches += len(pairs)
+    session.commit()
+    return matches
+
+
+def get_standings(session: Session,
+                  tournament: Tournament) -> typing.List[LeagueRating]:
+    return session.query(LeagueRating).filter_by(
+        tournament=tournament
+    ).order_by(LeagueRating.rating.desc()).all()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', type=pathlib.Path)
+    parser.add_argument('tournament_id', type=uuid.UUID)
+    args = parser.parse_args()
+    if not args.config.is_file():
+        parser.error('file not found: {!s}'.format(args.config))
+    app = App.from_path(args.config)
+    session = app.create_session()
+    try:
+        tournament = session.query(Tournament).filter_by(
+            id=args.tournament_id
+        ).one()
+        matches = update_league(session, app, tournament)
+    finally:
+        session.close()
+    print(f'{matches} matches')
+
+
+if __name__ == '__main__':
+    main()
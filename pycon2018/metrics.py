@@ -0,0 +1,239 @@
+"""Timing instrumentation of external scripts.
+
+Every :class:`~.game.ExternalScriptAgent` keeps an :class:`AgentMetrics`
+which records how long each turn took, how long the runner took to start,
+how many bytes went back and forth and why the script failed, if it did.
+:func:`run_measured_matches` collects them into a :class:`MatchMetrics`,
+which is stored in :attr:`~.entities.Match.metrics` and aggregated per
+submission by :func:`aggregate_metrics`.
+
+"""
+import bisect
+import collections
+import time
+import typing
+
+from .app import App
+
+__all__ = ('AgentMetrics', 'BUCKETS', 'Histogram', 'MatchMetrics',
+           'aggregate_metrics', 'run_measured_matches')
+
+
+#: Upper bounds (in seconds) of the buckets of a :class:`Histogram`, from
+#: 10 microseconds to about 40 seconds.  Each is 2 ** 0.25 times the
+#: previous one, so a quantile is off by 19% at most.
+BUCKETS = tuple(1e-5 * 2 ** (i / 4) for i in range(88))
+
+
+class Histogram:
+    """Counts of durations in the logarithmic :const:`BUCKETS`.  The last
+    count is of the durations which don't fit in any bucket."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'Histogram'):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> typing.Optional[float]:
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q: float) -> typing.Optional[float]:
+        """The upper bound of the bucket the ``q``-quantile falls in, or
+        :const:`None` if nothing was observed."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+
+    def to_json(self) -> typing.Mapping[str, typing.Any]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'buckets': {str(i): c for i, c in enumerate(self.counts) if c},
+        }
+
+    @classmethod
+    def from_json(cls, data: typing.Mapping[str, typing.Any]) -> 'Histogram':
+        histogram = cls()
+        histogram.count = data['count']
+        histogram.sum = data['sum']
+        histogram.max = data['max']
+        for i, count in data['buckets'].items():
+            histogram.counts[int(i)] = count
+        return histogram
+
+
+class AgentMetrics:
+    """What an external script did during one or more matches."""
+
+    def __init__(self):
+        self.turn_latency = Histogram()
+        self.spawn_time = Histogram()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = collections.Counter()
+        self.matches = 0
+        #: CPU time of the runners which exited, or of the matches of
+        #: persistent runners which are over.
+        self.cpu_time = 0.0
+        #: The largest maximum resident set size among them, in kilobytes.
+        self.max_rss = 0
+        #: Why they exited.
+        self.exits = collections.Counter()
+
+    def add_usage(self, usage):
+        """Count the :class:`~.game.RunnerUsage` of a runner which has
+        exited, or of a match of a persistent runner."""
+        self.cpu_time += usage.cpu_time
+        self.max_rss = max(self.max_rss, usage.max_rss)
+        self.exits[usage.exit_reason] += 1
+
+    def merge(self, other: 'AgentMetrics'):
+        self.turn_latency.merge(other.turn_latency)
+        self.spawn_time.merge(other.spawn_time)
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.errors.update(other.errors)
+        self.matches += other.matches
+        self.cpu_time += other.cpu_time
+        self.max_rss = max(self.max_rss, other.max_rss)
+        self.exits.update(other.exits)
+
+    def summary(self) -> typing.Mapping[str, typing.Any]:
+        """Figures to show to admins, in seconds and bytes."""
+        return {
+            'matches': self.matches,
+            'turns': self.turn_latency.count,
+            'turn_latency_p50': self.turn_latency.quantile(0.5),
+            'turn_latency_p99': self.turn_latency.quantile(0.99),
+            'turn_latency_max': self.turn_latency.max,
+            'spawn_time_p50': self.spawn_time.quantile(0.5),
+            'spawns': self.spawn_time.count,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'errors': dict(self.errors),
+            'cpu_time': self.cpu_time,
+            'max_rss': self.max_rss * 1024,
+            'exits': dict(self.exits),
+        }
+
+    def to_json(self) -> typing.Mapping[str, typing.Any]:
+        return {
+            'turn_latency': self.turn_latency.to_json(),
+            'spawn_time': self.spawn_time.to_json(),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'errors': dict(self.errors),
+            'matches': self.matches,
+            'cpu_time': self.cpu_time,
+            'max_rss': self.max_rss,
+            'exits': dict(self.exits),
+        }
+
+    @classmethod
+    def from_json(cls,
+                  data: typing.Mapping[str, typing.Any]) -> 'AgentMetrics':
+        metrics = cls()
+        metrics.turn_latency = Histogram.from_json(data['turn_latency'])
+        metrics.spawn_time = Histogram.from_json(data['spawn_time'])
+        metrics.bytes_sent = data['bytes_sent']
+        metrics.bytes_received = data['bytes_received']
+        metrics.errors.update(data['errors'])
+        metrics.matches = data['matches']
+        # Metrics stored before resource usage was collected lack these.
+        metrics.cpu_time = data.get('cpu_time', 0.0)
+        metrics.max_rss = data.get('max_rss', 0)
+        metrics.exits.update(data.get('exits', {}))
+        return metrics
+
+
+class MatchMetrics(typing.NamedTuple):
+    """How long a match took, and the metrics of both players.  Players
+    which aren't external scripts have no metrics."""
+
+    duration: float
+    p1: typing.Optional[AgentMetrics]
+    p2: typing.Optional[AgentMetrics]
+
+    def to_json(self) -> typing.Mapping[str, typing.Any]:
+        return {
+            'duration': self.duration,
+            'p1': self.p1 and self.p1.to_json(),
+            'p2': self.p2 and self.p2.to_json(),
+        }
+
+    @classmethod
+    def from_json(cls,
+                  data: typing.Mapping[str, typing.Any]) -> 'MatchMetrics':
+        return cls(
+            data['duration'],
+            data['p1'] and AgentMetrics.from_json(data['p1']),
+            data['p2'] and AgentMetrics.from_json(data['p2']),
+        )
+
+
+def agent_metrics(agent) -> typing.Optional[AgentMetrics]:
+    from .game import ExternalScriptAgent
+    if not isinstance(agent, ExternalScriptAgent):
+        return None
+    metrics = agent.metrics
+    metrics.bytes_sent = agent.bytes_sent
+    metrics.bytes_received = agent.bytes_received
+    metrics.matches = 1
+    return metrics
+
+
+def run_measured_matches(app: App, p1, p2,
+                         raise_: bool=False,
+                         seed: typing.Optional[int]=None
+                         ) -> typing.Tuple[typing.Optional[int],
+                                           typing.List, MatchMetrics]:
+    """:func:`~.game.run_matches` which also returns the
+    :class:`MatchMetrics` of the match."""
+    from .game import run_matches
+    started_at = time.monotonic()
+    winner, data = run_matches(app, p1, p2, raise_, seed)
+    metrics = MatchMetrics(time.monotonic() - started_at,
+                           agent_metrics(p1), agent_metrics(p2))
+    return winner, data, metrics
+
+
+def aggregate_metrics(
+    matches: typing.Iterable[typing.Tuple[typing.Any, typing.Any,
+                                          typing.Mapping]]
+) -> typing.Mapping[typing.Any, AgentMetrics]:
+    """Merge the metrics of both players of each ``(p1_key, p2_key,
+    metrics)``, where ``metrics`` is what :meth:`MatchMetrics.to_json`
+    returned, into an :class:`AgentMetrics` for each key."""
+    result = {}
+    for p1_key, p2_key, data in matches:
+        match = MatchMetrics.from_json(data)
+        for key, metrics in ((p1_key, match.p1), (p2_key, match.p2)):
+            if metrics is None:
+                continue
+            if key not in result:
+                result[key] = AgentMetrics()
+            result[key].merge(metrics)
+    return result
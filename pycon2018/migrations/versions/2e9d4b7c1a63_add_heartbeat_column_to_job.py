@@ -0,0 +1,27 @@
+"""Add heartbeat column to job
+
+Revision ID: 2e9d4b7c1a63
+Revises: 7c3e1f9a5b2d
+Create Date: 2018-09-05 16:40:18.283917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e9d4b7c1a63'
+down_revision = '7c3e1f9a5b2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('job', sa.Column('heartbeat_at',
+                                   sa.DateTime(timezone=True),
+                                   nullable=True))
+    op.execute('UPDATE job SET heartbeat_at = started_at')
+
+
+def downgrade():
+    op.drop_column('job', 'heartbeat_at')
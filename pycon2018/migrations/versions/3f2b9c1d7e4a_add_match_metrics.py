@@ -0,0 +1,26 @@
+"""Add match metrics
+
+Revision ID: 3f2b9c1d7e4a
+Revises: bb62ce2d3dc1
+Create Date: 2018-08-27 14:02:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2b9c1d7e4a'
+down_revision = 'bb62ce2d3dc1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('match', sa.Column('metrics', postgresql.JSON(),
+                                     nullable=True))
+
+
+def downgrade():
+    op.drop_column('match', 'metrics')
@@ -0,0 +1,42 @@
+"""Add job table
+
+Revision ID: 5d1c9a7f3b28
+Revises: e0b4f71a92c6
+Create Date: 2018-08-31 14:22:09.518306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy_utils.types.uuid import UUIDType
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1c9a7f3b28'
+down_revision = 'e0b4f71a92c6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'job',
+        sa.Column('id', UUIDType(), nullable=False),
+        sa.Column('kind', sa.String(length=32), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False),
+        sa.Column('user_id', UUIDType(), nullable=False),
+        sa.Column('payload', postgresql.JSON(), nullable=False),
+        sa.Column('result', postgresql.JSON(), nullable=True),
+        sa.Column('worker', sa.String(length=128), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('started_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_job_status'), 'job', ['status'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_job_status'), table_name='job')
+    op.drop_table('job')
@@ -0,0 +1,26 @@
+"""Add progress column to job
+
+Revision ID: 7c3e1f9a5b2d
+Revises: a4e8c2d6f19b
+Create Date: 2018-09-04 10:12:37.604219
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '7c3e1f9a5b2d'
+down_revision = 'a4e8c2d6f19b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('job', sa.Column('progress', postgresql.JSON(),
+                                   nullable=True))
+
+
+def downgrade():
+    op.drop_column('job', 'progress')
@@ -0,0 +1,67 @@
+"""Add league tables
+
+Revision ID: 8a61d0e5c3f7
+Revises: 3f2b9c1d7e4a
+Create Date: 2018-08-29 16:40:12.084517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils.types.uuid import UUIDType
+
+
+# revision identifiers, used by Alembic.
+revision = '8a61d0e5c3f7'
+down_revision = '3f2b9c1d7e4a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'league_rating',
+        sa.Column('id', UUIDType(), nullable=False),
+        sa.Column('tournament_id', UUIDType(), nullable=False),
+        sa.Column('submission_id', UUIDType(), nullable=False),
+        sa.Column('code_hash', sa.String(length=64), nullable=False),
+        sa.Column('rating', sa.Float(), nullable=False),
+        sa.Column('wins', sa.Integer(), nullable=False),
+        sa.Column('losses', sa.Integer(), nullable=False),
+        sa.Column('draws', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(['submission_id'], ['submission.id'], ),
+        sa.ForeignKeyConstraint(['tournament_id'], ['tournament.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('submission_id')
+    )
+    op.create_index(op.f('ix_league_rating_tournament_id'), 'league_rating',
+                    ['tournament_id'], unique=False)
+    op.create_table(
+        'league_result',
+        sa.Column('id', UUIDType(), nullable=False),
+        sa.Column('tournament_id', UUIDType(), nullable=False),
+        sa.Column('p1_id', UUIDType(), nullable=False),
+        sa.Column('p1_code_hash', sa.String(length=64), nullable=False),
+        sa.Column('p2_id', UUIDType(), nullable=False),
+        sa.Column('p2_code_hash', sa.String(length=64), nullable=False),
+        sa.Column('winner', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(['p1_id'], ['submission.id'], ),
+        sa.ForeignKeyConstraint(['p2_id'], ['submission.id'], ),
+        sa.ForeignKeyConstraint(['tournament_id'], ['tournament.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('p1_id', 'p2_id', name='uc_league_result')
+    )
+    op.create_index(op.f('ix_league_result_p1_id'), 'league_result',
+                    ['p1_id'], unique=False)
+    op.create_index(op.f('ix_league_result_p2_id'), 'league_result',
+                    ['p2_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_league_result_p2_id'), table_name='league_result')
+    op.drop_index(op.f('ix_league_result_p1_id'), table_name='league_result')
+    op.drop_table('league_result')
+    op.drop_index(op.f('ix_league_rating_tournament_id'),
+                  table_name='league_rating')
+    op.drop_table('league_rating')
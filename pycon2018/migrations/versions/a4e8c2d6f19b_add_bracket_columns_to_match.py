@@ -0,0 +1,101 @@
+"""Add bracket columns to match
+
+Revision ID: a4e8c2d6f19b
+Revises: 5d1c9a7f3b28
+Create Date: 2018-09-03 11:06:42.170254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils.types.uuid import UUIDType
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e8c2d6f19b'
+down_revision = '5d1c9a7f3b28'
+branch_labels = None
+depends_on = None
+
+
+# Every match under a terminal match, with how many rounds it is before
+# the terminal match and its order in its round.
+BRACKET = '''
+WITH RECURSIVE bracket(id, p1_parent_id, p2_parent_id, terminal_id,
+                       depth, position) AS (
+    SELECT id, p1_parent_id, p2_parent_id, id, 0, 0
+    FROM match
+    WHERE id IN (SELECT final_match_id FROM {table})
+    UNION ALL
+    SELECT parent.id, parent.p1_parent_id, parent.p2_parent_id,
+           bracket.terminal_id, bracket.depth + 1,
+           bracket.position * 2 +
+           CASE WHEN parent.id = bracket.p2_parent_id THEN 1 ELSE 0 END
+    FROM match AS parent
+    JOIN bracket ON parent.id IN (bracket.p1_parent_id,
+                                  bracket.p2_parent_id)
+)
+'''
+
+
+def upgrade():
+    op.add_column('match', sa.Column('terminal_id', UUIDType(),
+                                     nullable=True))
+    op.add_column('match', sa.Column('tournament_id', UUIDType(),
+                                     nullable=True))
+    op.add_column('match', sa.Column('match_set_id', UUIDType(),
+                                     nullable=True))
+    op.add_column('match', sa.Column('depth', sa.Integer(), nullable=True))
+    op.add_column('match', sa.Column('position', sa.Integer(),
+                                     nullable=True))
+    op.create_foreign_key(op.f('match_terminal_id_fkey'), 'match', 'match',
+                          ['terminal_id'], ['id'])
+    op.create_foreign_key(op.f('match_tournament_id_fkey'),
+                          'match', 'tournament', ['tournament_id'], ['id'])
+    op.create_foreign_key(op.f('match_match_set_id_fkey'),
+                          'match', 'tournament_match_set',
+                          ['match_set_id'], ['id'])
+    op.execute(BRACKET.format(table='tournament_match_set') + '''
+        UPDATE match
+        SET terminal_id = bracket.terminal_id,
+            tournament_id = tournament_match_set.tournament_id,
+            match_set_id = tournament_match_set.id,
+            depth = bracket.depth,
+            position = bracket.position
+        FROM bracket
+        JOIN tournament_match_set
+          ON tournament_match_set.final_match_id = bracket.terminal_id
+        WHERE match.id = bracket.id
+    ''')
+    op.execute(BRACKET.format(table='tournament') + '''
+        UPDATE match
+        SET terminal_id = bracket.terminal_id,
+            tournament_id = tournament.id,
+            depth = bracket.depth,
+            position = bracket.position
+        FROM bracket
+        JOIN tournament ON tournament.final_match_id = bracket.terminal_id
+        WHERE match.id = bracket.id
+    ''')
+    op.create_index(op.f('ix_match_terminal_id'), 'match', ['terminal_id'],
+                    unique=False)
+    op.create_index(op.f('ix_match_tournament_id'), 'match',
+                    ['tournament_id'], unique=False)
+    op.create_index(op.f('ix_match_match_set_id'), 'match', ['match_set_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_match_match_set_id'), table_name='match')
+    op.drop_index(op.f('ix_match_tournament_id'), table_name='match')
+    op.drop_index(op.f('ix_match_terminal_id'), table_name='match')
+    op.drop_constraint(op.f('match_match_set_id_fkey'), 'match',
+                       type_='foreignkey')
+    op.drop_constraint(op.f('match_tournament_id_fkey'), 'match',
+                       type_='foreignkey')
+    op.drop_constraint(op.f('match_terminal_id_fkey'), 'match',
+                       type_='foreignkey')
+    op.drop_column('match', 'position')
+    op.drop_column('match', 'depth')
+    op.drop_column('match', 'match_set_id')
+    op.drop_column('match', 'tournament_id')
+    op.drop_column('match', 'terminal_id')
@@ -0,0 +1,37 @@
+"""Add cached_result table
+
+Revision ID: c57e2a9b41d0
+Revises: 8a61d0e5c3f7
+Create Date: 2018-08-30 11:23:57.640915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy_utils.types.uuid import UUIDType
+
+
+# revision identifiers, used by Alembic.
+revision = 'c57e2a9b41d0'
+down_revision = '8a61d0e5c3f7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cached_result',
+        sa.Column('id', UUIDType(), nullable=False),
+        sa.Column('key', sa.String(length=64), nullable=False),
+        sa.Column('winner', sa.Integer(), nullable=True),
+        sa.Column('match_data', postgresql.JSON(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_cached_result_key'), 'cached_result', ['key'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_cached_result_key'), table_name='cached_result')
+    op.drop_table('cached_result')
@@ -0,0 +1,34 @@
+"""Add validated_code table
+
+Revision ID: e0b4f71a92c6
+Revises: c57e2a9b41d0
+Create Date: 2018-08-30 17:05:31.772046
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils.types.uuid import UUIDType
+
+
+# revision identifiers, used by Alembic.
+revision = 'e0b4f71a92c6'
+down_revision = 'c57e2a9b41d0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'validated_code',
+        sa.Column('id', UUIDType(), nullable=False),
+        sa.Column('code_hash', sa.String(length=64), nullable=False),
+        sa.Column('rules_hash', sa.String(length=64), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('code_hash', 'rules_hash',
+                            name='uc_validated_code')
+    )
+
+
+def downgrade():
+    op.drop_table('validated_code')
@@ -0,0 +1,235 @@
+import collections
+import concurrent.futures
+import hashlib
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+import typing
+
+from .app import App
+from .game import (NEXT_MATCH, ExternalScriptAgent, RunnerUsage, spawn_runner,
+                   stop_runner)
+from .metrics import MatchMetrics, run_measured_matches
+
+__all__ = ('PooledScriptAgent', 'RunnerPool', 'code_hash',
+           'run_matches_concurrently')
+
+
+def code_hash(code: str) -> str:
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+class RunnerPool:
+    """Keeps warm :prog:`script_runner` processes, keyed by the code of the
+    submission they run, so that the same submission fighting several
+    matches in a row doesn't pay the interpreter startup every time.
+
+    A runner forks a fresh process for the script at every match (see
+    :meth:`PooledScriptAgent.next_match`), so that a submission doesn't
+    carry what it kept in its globals over to its next match.
+
+    At most ``size`` idle runners are kept; the least recently used ones
+    are evicted first.  A runner is recycled after ``max_uses`` matches,
+    or as soon as it fails.
+
+    """
+
+    def __init__(self, app: App, size: int, max_uses: int,
+                 directory: typing.Optional[str]=None):
+        self.app = app
+        self.size = size
+        self.max_uses = max_uses
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='pycon2018-pool-')
+            os.chmod(directory, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP |
+                     stat.S_IROTH | stat.S_IXOTH)
+        self.directory = directory
+        self.idle = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.spawned = 0
+        self.reused = 0
+        self.recycled = 0
+        self.evicted = 0
+
+    def script_path(self, code: str) -> typing.Tuple[str, str]:
+        key = code_hash(code)
+        path = os.path.join(self.directory, key + '.py')
+        if not os.path.isfile(path):
+            with tempfile.NamedTemporaryFile(dir=self.directory,
+                                             delete=False) as tf:
+                tf.write(code.encode('utf-8'))
+            os.chmod(tf.name, stat.S_IRUSR | stat.S_IWUSR |
+                     stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tf.name, path)
+        return key, path
+
+    def agent(self, code: str) -> 'PooledScriptAgent':
+        key, path = self.script_path(code)
+        return PooledScriptAgent(self, key, path)
+
+    def spawn(self, path: str) -> subprocess.Popen:
+        return spawn_runner(self.app, path, '--persistent')
+
+    def checkout(self, key: str,
+                 path: str) -> typing.Tuple[subprocess.Popen, int, float]:
+        """Take a runner, along with how many matches it has played and
+        the CPU time of them which has already been reported."""
+        with self.lock:
+            runners = self.idle.get(key)
+            while runners:
+                handle, uses, cpu_time = runners.pop()
+                if not runners:
+                    del self.idle[key]
+                if handle.poll() is None:
+                    self.reused += 1
+                    return handle, uses, cpu_time
+                self.recycled += 1
+                runners = self.idle.get(key)
+            self.spawned += 1
+        return self.spawn(path), 0, 0.0
+
+    def checkin(self, key: str, handle: subprocess.Popen, uses: int,
+                cpu_time: float, healthy: bool=True
+                ) -> typing.Optional[RunnerUsage]:
+        """Give a runner back.  If it is retired instead of being kept,
+        its resource usage is returned, apart from the ``cpu_time`` of its
+        matches which has already been reported."""
+        if not healthy or uses >= self.max_uses or handle.poll() is not None:
+            with self.lock:
+                self.recycled += 1
+            usage = stop_runner(handle)
+            if usage is not None:
+                usage = usage._replace(
+                    cpu_time=max(0.0, usage.cpu_time - cpu_time)
+                )
+            return usage
+        evicted = []
+        with self.lock:
+            self.idle.setdefault(key, []).append((handle, uses, cpu_time))
+            self.idle.move_to_end(key)
+            while self.idle_count > self.size:
+                oldest_key, runners = next(iter(self.idle.items()))
+                evicted.append(runners.pop(0)[0])
+                if not runners:
+                    del self.idle[oldest_key]
+            self.evicted += len(evicted)
+        for handle in evicted:
+            stop_runner(handle)
+
+    @property
+    def idle_count(self) -> int:
+        return sum(len(runners) for runners in self.idle.values())
+
+    def stats(self) -> typing.Mapping[str, int]:
+        with self.lock:
+            return {
+                'size': self.idle_count,
+                'capacity': self.size,
+                'max_uses': self.max_uses,
+                'spawned': self.spawned,
+                'reused': self.reused,
+                'recycled': self.recycled,
+                'evicted': self.evicted,
+            }
+
+    def close(self):
+        with self.lock:
+            runners = [handle
+                       for handles in self.idle.values()
+                       for handle, _, __ in handles]
+            self.idle.clear()
+        for handle in runners:
+            stop_runner(handle)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class PooledScriptAgent(ExternalScriptAgent):
+    """:class:`~.game.ExternalScriptAgent` which borrows its process from
+    a :class:`RunnerPool` and gives it back when the match is over."""
+
+    def __init__(self, pool: RunnerPool, key: str, path: str):
+        self.pool = pool
+        self.key = key
+        self.uses = 0
+        #: The CPU time of the matches of the runner which has been
+        #: reported by :meth:`next_match`.
+        self.reported_cpu_time = 0.0
+        super(PooledScriptAgent, self).__init__(pool.app, path)
+
+    def open_subprocess(self, app):
+        if self.handle is not None:
+            self.record_usage(self.pool.checkin(
+                self.key, self.handle, self.uses, self.reported_cpu_time,
+                False
+            ))
+        handle, self.uses, self.reported_cpu_time = self.pool.checkout(
+            self.key, self.path
+        )
+        self.attach(handle, self.uses == 0)
+
+    def next_match(self) -> bool:
+        """Tell the runner the match is over, so that the script starts
+        afresh for the next match, and wait until it has.  What the match
+        used is recorded.  Returns whether the runner can be reused."""
+        try:
+            self.handle.stdin.write(NEXT_MATCH + b'\n')
+            self.handle.stdin.flush()
+        except Exception:
+            return False
+        line = self.read_line(time.monotonic() + self.turn_timeout)
+        if line is None:
+            return False
+        kind, *usage = line.split() or [None]
+        if kind != NEXT_MATCH:
+            return False
+        try:
+            cpu_time, max_rss = float(usage[0]), int(usage[1])
+        except (IndexError, ValueError):
+            return False
+        self.reported_cpu_time += cpu_time
+        self.record_usage(RunnerUsage(cpu_time, max_rss, 'exit'))
+        return True
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self.handle is not None:
+            healthy = (not self.error and exception_type is None and
+                       self.next_match())
+            self.record_usage(self.pool.checkin(
+                self.key, self.handle, self.uses + 1,
+                self.reported_cpu_time, healthy
+            ))
+            self.handle = None
+        if self.selector is not None:
+            self.selector.close()
+
+
+def run_matches_concurrently(
+    app: App, pairs: typing.Sequence[typing.Tuple[str, str]],
+    seed: typing.Optional[int]=None
+) -> typing.List[
+    typing.Tuple[typing.Optional[int], typing.List, MatchMetrics]
+]:
+    """Run matches between each pair of codes at the same time, at most
+    ``game.concurrency`` at once, and return their results in the order
+    of ``pairs``.  Each result is a winner, the records and the metrics
+    of the match, as :func:`~.metrics.run_measured_matches` returns.
+    Every match is played with ``seed`` if it's given.
+
+    Every match drives its own pair of runner processes, so the actual
+    work is spread over as many cores as there are matches in flight.
+
+    """
+    if not pairs:
+        return []
+    pool = app.runner_pool
+
+    def run(pair):
+        return run_measured_matches(app, pool.agent(pair[0]),
+                                    pool.agent(pair[1]), seed=seed)
+    workers = min(len(pairs), app.game_concurrency)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(run, pairs))
@@ -0,0 +1,277 @@
+import array
+import base64
+import sys
+import typing
+
+__all__ = ('EVENTS', 'EVENT_CODES', 'FAILED', 'FORMAT_VERSION', 'Record',
+           'dump_match', 'encode_match', 'encode_replay', 'decode_match')
+
+
+#: The version of the compact format written by :meth:`Record.encode`.
+FORMAT_VERSION = 1
+
+#: Every event a round record can contain.  The index of an event is its
+#: code in the compact format, so the table must only be appended to.
+EVENTS = (
+    'idle',
+    'p1_forward', 'p1_backward', 'p2_forward', 'p2_backward',
+    'p1_punch', 'p1_punch_unreachable', 'p1_punch_avoid', 'p1_punch_guard',
+    'p1_kick', 'p1_kick_unreachable', 'p1_kick_avoid', 'p1_kick_guard',
+    'p2_punch', 'p2_punch_unreachable', 'p2_punch_avoid', 'p2_punch_guard',
+    'p2_kick', 'p2_kick_unreachable', 'p2_kick_avoid', 'p2_kick_guard',
+    'p1_victory_ko', 'p2_victory_ko',
+    'p1_victory_time_over', 'p2_victory_time_over', 'draw',
+    'both_error', 'p1_error', 'p2_error',
+)
+
+EVENT_CODES = {event: code for code, event in enumerate(EVENTS)}
+
+#: Codes of the events which carry a ``damage`` field.
+DAMAGE_EVENTS = frozenset(
+    EVENT_CODES[f'{player}_{attack}{suffix}']
+    for player in ('p1', 'p2')
+    for attack in ('punch', 'kick')
+    for suffix in ('', '_guard')
+)
+
+#: Winners of rounds by the codes of the events which end them.
+ROUND_WINNERS = {
+    EVENT_CODES['p1_victory_ko']: 0,
+    EVENT_CODES['p1_victory_time_over']: 0,
+    EVENT_CODES['p2_error']: 0,
+    EVENT_CODES['p2_victory_ko']: 1,
+    EVENT_CODES['p2_victory_time_over']: 1,
+    EVENT_CODES['p1_error']: 1,
+}
+
+COLUMNS = ('time', 'p1_health', 'p1_position', 'p2_health', 'p2_position')
+
+#: Action code of a player whose action couldn't be received.  Other codes
+#: are indices of :class:`~.game.Action` members.
+FAILED = -1
+
+
+def pack(typecode: str, values: typing.Sequence[int]) -> str:
+    column = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return typecode + ':' + base64.b64encode(column.tobytes()).decode()
+
+
+def unpack(packed: str) -> array.array:
+    typecode, _, data = packed.partition(':')
+    column = array.array(typecode)
+    column.frombytes(base64.b64decode(data))
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+def pack_integers(values: typing.Sequence[int]) -> str:
+    low = min(values, default=0)
+    high = max(values, default=0)
+    for typecode in 'bhiq':
+        bits = array.array(typecode).itemsize * 8 - 1
+        if -(1 << bits) <= low and high < (1 << bits):
+            break
+    return pack(typecode, values)
+
+
+def delta_encode(values: typing.Sequence[int]) -> typing.List[int]:
+    previous = 0
+    result = []
+    for value in values:
+        result.append(value - previous)
+        previous = value
+    return result
+
+
+def delta_decode(deltas: typing.Sequence[int]) -> typing.List[int]:
+    value = 0
+    result = []
+    for delta in deltas:
+        value += delta
+        result.append(value)
+    return result
+
+
+class Record:
+    """The record of a round, kept in columns rather than as a list of
+    event dicts so that :func:`~.game.evaluate` only appends integers.
+
+    :meth:`to_json` turns it into the list of events the Unity client
+    understands, and :meth:`encode` into the compact format that is
+    stored in :attr:`~.entities.Match.match_data`.
+
+    Besides the events, it keeps the actions both players took on each
+    tick and the seed of the random number generator the round was
+    played with, which is all it takes to play the round again.
+
+    """
+
+    __slots__ = ('events', 'damages', 'p1_actions', 'p2_actions',
+                 'seed') + COLUMNS
+
+    def __init__(self, seed: typing.Optional[int]=None):
+        self.seed = seed
+        self.p1_actions = array.array('b')
+        self.p2_actions = array.array('b')
+        self.events = array.array('B')
+        self.damages = array.array('l')
+        self.time = array.array('l')
+        self.p1_health = array.array('l')
+        self.p1_position = array.array('l')
+        self.p2_health = array.array('l')
+        self.p2_position = array.array('l')
+
+    def put(self, event: int, time: int,
+            p1_health: int, p1_position: int,
+            p2_health: int, p2_position: int,
+            damage: typing.Optional[int]=None):
+        self.events.append(event)
+        self.time.append(time)
+        self.p1_health.append(p1_health)
+        self.p1_position.append(p1_position)
+        self.p2_health.append(p2_health)
+        self.p2_position.append(p2_position)
+        if damage is not None:
+            self.damages.append(damage)
+
+    def act(self, p1_action: int, p2_action: int):
+        self.p1_actions.append(p1_action)
+        self.p2_actions.append(p2_action)
+
+    def repeat_ticks(self, since: int, until: int, round_time: int):
+        """Fill the ticks from ``until`` down to 0 (in time left) by
+        repeating the ticks from ``since`` down to ``until + 1``, which is
+        what happens if the round is at the same state at ``until`` as it
+        was at ``since`` and nothing random happened in between."""
+        period = since - until
+        spans = {}
+        for index, time in enumerate(self.time):
+            if until < time <= since:
+                spans.setdefault(time, [index, index])[1] = index + 1
+        for time in range(until, -1, -1):
+            source = until + 1 + (time - until - 1) % period
+            start, end = spans[source]
+            for index in range(start, end):
+                self.put(self.events[index], time,
+                         self.p1_health[index], self.p1_position[index],
+                         self.p2_health[index], self.p2_position[index])
+            action = round_time - source
+            self.act(self.p1_actions[action], self.p2_actions[action])
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    @property
+    def winner(self) -> typing.Optional[int]:
+        """The player number of the winner of the round, by the event which
+        ended it, or :const:`None` for a draw."""
+        if not self.events:
+            return None
+        return ROUND_WINNERS.get(self.events[-1])
+
+    def to_json(self) -> typing.List[typing.Mapping[str, typing.Any]]:
+        result = []
+        damages = iter(self.damages)
+        for event, time, p1h, p1p, p2h, p2p in zip(
+            self.events, self.time, self.p1_health, self.p1_position,
+            self.p2_health, self.p2_position
+        ):
+            item = {
+                'action': EVENTS[event], 'time': time,
+                'p1': {'health': p1h, 'position': p1p},
+                'p2': {'health': p2h, 'position': p2p},
+            }
+            if event in DAMAGE_EVENTS:
+                item['damage'] = next(damages)
+            result.append(item)
+        return result
+
+    @classmethod
+    def from_json(
+        cls, events: typing.Sequence[typing.Mapping[str, typing.Any]]
+    ) -> 'Record':
+        record = cls()
+        for event in events:
+            record.put(EVENT_CODES[event['action']], event['time'],
+                       event['p1']['health'], event['p1']['position'],
+                       event['p2']['health'], event['p2']['position'],
+                       event.get('damage'))
+        return record
+
+    def encode(self) -> typing.Mapping[str, str]:
+        encoded = {
+            column: pack_integers(delta_encode(getattr(self, column)))
+            for column in COLUMNS
+        }
+        encoded['events'] = pack('B', self.events)
+        encoded['damages'] = pack_integers(self.damages)
+        encoded.update(self.encode_actions())
+        return encoded
+
+    def encode_actions(self) -> typing.Mapping[str, typing.Any]:
+        return {
+            'seed': self.seed,
+            'p1_actions': pack('b', self.p1_actions),
+            'p2_actions': pack('b', self.p2_actions),
+        }
+
+    @classmethod
+    def decode(cls, encoded: typing.Mapping[str, str]) -> 'Record':
+        record = cls(encoded.get('seed'))
+        if 'p1_actions' in encoded:
+            record.p1_actions = unpack(encoded['p1_actions'])
+            record.p2_actions = unpack(encoded['p2_actions'])
+        record.events = unpack(encoded['events'])
+        record.damages = unpack(encoded['damages'])
+        for column in COLUMNS:
+            setattr(record, column, array.array(
+                'l', delta_decode(unpack(encoded[column]))
+            ))
+        return record
+
+
+def encode_match(records: typing.Sequence[Record]) -> typing.Mapping:
+    return {
+        'version': FORMAT_VERSION,
+        'rounds': [record.encode() for record in records],
+    }
+
+
+def encode_replay(rules: typing.Mapping[str, int],
+                  records: typing.Sequence[Record]) -> typing.Mapping:
+    """Encode only what it takes to play the match again: the rules, and
+    the seed and the actions of both players for every round.  See
+    :func:`~.game.load_match` to get the records back."""
+    return {
+        'version': FORMAT_VERSION,
+        'mode': 'replay',
+        'rules': dict(rules),
+        'rounds': [record.encode_actions() for record in records],
+    }
+
+
+def decode_match(data) -> typing.List[Record]:
+    """Load the rounds of a match from :attr:`~.entities.Match.match_data`,
+    which is either in the compact format or, for matches made before it,
+    a list of event lists.
+
+    Matches stored with :func:`encode_replay` have to be played again,
+    which :func:`~.game.load_match` does.
+
+    """
+    if isinstance(data, list):
+        return [Record.from_json(events) for events in data]
+    if data.get('version') != FORMAT_VERSION:
+        raise ValueError(f'unsupported record version: {data.get("version")}')
+    elif data.get('mode', 'full') != 'full':
+        raise ValueError(f'{data["mode"]} records have to be played again')
+    return [Record.decode(encoded) for encoded in data['rounds']]
+
+
+def dump_match(records: typing.Sequence[Record], compact: bool=False):
+    if compact:
+        return encode_match(records)
+    return [record.to_json() for record in records]
@@ -0,0 +1,333 @@
+"""Table-driven engine which plays the same rounds as :func:`~.game.evaluate`
+faster.
+
+The ``game.*`` configuration is compiled once into a :class:`GameRules`
+(see :attr:`~.app.App.game_rules`), in which what every action does
+against every other action of the opponent is looked up from tables
+instead of being worked out by a chain of conditions on every tick.
+:func:`~.game.evaluate` stays the reference implementation of the rules,
+and the default engine.  Setting ``game.engine`` to ``'table'`` switches to
+this one; :func:`check_equivalence` plays random rounds under random rules
+with both to make sure they agree::
+
+    $ python -m pycon2018.rules 1000
+
+"""
+import random
+import typing
+
+from .app import App
+from .game import (ACTION_CODES, ACTIONS, Action, Agent, ReplayAgent,
+                   ask_actions, cycle_state, evaluate)
+from .record import EVENT_CODES, FAILED, Record
+
+__all__ = ('Attack', 'GameRules', 'Outcome', 'check_equivalence',
+           'play_round')
+
+
+class Outcome(typing.NamedTuple):
+    """What a reachable attack does against an action of the defender."""
+
+    event: int
+
+    #: The range of the damage, or :const:`None` if the attack is avoided.
+    damage_range: typing.Optional[typing.Tuple[int, int]]
+
+    #: How much the guard count of the defender grows.
+    guard: int
+
+
+class Attack(typing.NamedTuple):
+
+    unreachable_event: int
+
+    #: :class:`Outcome` by the action code of the defender.
+    outcomes: typing.Tuple[Outcome, ...]
+
+
+#: Which action of the defender avoids each attack.
+AVOIDED_BY = {Action.punch: Action.crouch, Action.kick: Action.jump}
+
+#: Damage multipliers by the number of distinct actions among the last
+#: five of the attacker, once it has taken at least three.
+DIVERSITY_MULTIPLIERS = (1.0, 1 / 3, 2 / 3, 1.0, 1.0, 1.0)
+
+
+class GameRules(typing.NamedTuple):
+    """An immutable snapshot of the ``game.*`` configuration a round
+    depends on, with its tables.  Tables are indexed by player number and
+    then by action codes."""
+
+    round_time: int
+    hit_point_range: typing.Tuple[int, int]
+    hit_point_guard_range: typing.Tuple[int, int]
+    p1_initial_position: int
+    p2_initial_position: int
+    concurrent_turns: bool
+    fast_forward: bool
+
+    #: Events of moving actions, or :const:`None` for other actions.
+    moves: typing.Tuple[typing.Tuple[typing.Optional[int], ...], ...]
+
+    #: :class:`Attack` of attacking actions, or :const:`None`.
+    attacks: typing.Tuple[typing.Tuple[typing.Optional[Attack], ...], ...]
+
+    @classmethod
+    def from_app(cls, app: App) -> 'GameRules':
+        hit_point_range = tuple(app.game_hit_point_range)
+        hit_point_guard_range = tuple(app.game_hit_point_guard_range)
+        moves = []
+        attacks = []
+        for player in ('p1', 'p2'):
+            moves.append(tuple(
+                EVENT_CODES[f'{player}_{action.value}']
+                if action in (Action.forward, Action.backward) else None
+                for action in ACTIONS
+            ))
+            player_attacks = []
+            for action in ACTIONS:
+                if action not in AVOIDED_BY:
+                    player_attacks.append(None)
+                    continue
+                name = f'{player}_{action.value}'
+                outcomes = []
+                for defense in ACTIONS:
+                    if defense is AVOIDED_BY[action]:
+                        outcome = Outcome(EVENT_CODES[f'{name}_avoid'],
+                                          None, 2)
+                    elif defense is Action.guard:
+                        outcome = Outcome(EVENT_CODES[f'{name}_guard'],
+                                          hit_point_guard_range, 1)
+                    else:
+                        outcome = Outcome(EVENT_CODES[name],
+                                          hit_point_range, 0)
+                    outcomes.append(outcome)
+                player_attacks.append(Attack(
+                    EVENT_CODES[f'{name}_unreachable'], tuple(outcomes)
+                ))
+            attacks.append(tuple(player_attacks))
+        return cls(
+            round_time=app.game_round_time,
+            hit_point_range=hit_point_range,
+            hit_point_guard_range=hit_point_guard_range,
+            p1_initial_position=app.game_p1_initial_position,
+            p2_initial_position=app.game_p2_initial_position,
+            concurrent_turns=app.game_concurrent_turns,
+            fast_forward=app.game_fast_forward,
+            moves=tuple(moves),
+            attacks=tuple(attacks),
+        )
+
+
+def inflict_damage(attacker: Agent, defender: Agent, damage: int) -> int:
+    """:meth:`~.game.Agent.inflict_damage`, with the diversity of the
+    actions of the attacker taken from its running counts."""
+    if len(attacker.previous_actions) >= 3:
+        multiplier = DIVERSITY_MULTIPLIERS[len(attacker.action_counts)]
+    else:
+        multiplier = 1.0
+    damage = int(damage * multiplier * 1.25 ** attacker.guard_count)
+    defender.health = max(0, defender.health - damage)
+    attacker.last_inflicted_damage = damage
+    attacker.guard_count = 0
+    return damage
+
+
+def play_round(rules: GameRules, p1: Agent, p2: Agent,
+               match_records: typing.Sequence[str], raise_: bool=False,
+               seed: typing.Optional[int]=None
+               ) -> typing.Tuple[typing.Optional[int], Record]:
+    """Play a round like :func:`~.game.evaluate` does under ``rules``."""
+    if seed is None:
+        seed = random.getrandbits(32)
+    randrange = random.Random(seed).randrange
+    record = Record(seed)
+    put = record.put
+    time_left = rules.round_time
+    p1.reset_with(0, rules.p1_initial_position)
+    p2.reset_with(1, rules.p2_initial_position)
+    p1_retreat_limit = rules.p1_initial_position - 2
+    p2_retreat_limit = rules.p2_initial_position + 2
+    p1_moves, p2_moves = rules.moves
+    p1_attacks, p2_attacks = rules.attacks
+    forward = ACTION_CODES[Action.forward]
+    idle = EVENT_CODES['idle']
+    memoize = rules.fast_forward and p1.deterministic and p2.deterministic
+    fast_forward = (memoize and
+                    p1.ignores_time_left and p2.ignores_time_left)
+    seen_states = {}
+    while time_left >= 0:
+        if fast_forward:
+            state = cycle_state(p1, p2)
+            since, damages = seen_states.get(state, (None, None))
+            if damages == len(record.damages):
+                record.repeat_ticks(since, time_left, rules.round_time)
+                time_left = -1
+                break
+            seen_states[state] = time_left, len(record.damages)
+        p1a, p2a = ask_actions(p1, p2, match_records, time_left, raise_,
+                               rules.concurrent_turns, memoize)
+        if p1a is None or p2a is None:
+            record.act(FAILED if p1a is None else ACTION_CODES[p1a],
+                       FAILED if p2a is None else ACTION_CODES[p2a])
+            if p1a is None and p2a is None:
+                event, winner = 'both_error', None
+            elif p1a is None:
+                event, winner = 'p1_error', 1
+            else:
+                event, winner = 'p2_error', 0
+            put(EVENT_CODES[event], time_left,
+                p1.health, p1.position, p2.health, p2.position)
+            return winner, record
+        p1c = ACTION_CODES[p1a]
+        p2c = ACTION_CODES[p2a]
+        record.act(p1c, p2c)
+        p1.last_inflicted_damage = 0
+        p2.last_inflicted_damage = 0
+        active = False
+        event = p1_moves[p1c]
+        if event is not None:
+            if p1c == forward:
+                if p2.position > p1.position:
+                    p1.position += 1
+            elif p1.position >= p1_retreat_limit:
+                p1.position -= 1
+            put(event, time_left,
+                p1.health, p1.position, p2.health, p2.position)
+            active = True
+        event = p2_moves[p2c]
+        if event is not None:
+            if p2c == forward:
+                if p2.position > p1.position:
+                    p2.position -= 1
+            elif p2.position <= p2_retreat_limit:
+                p2.position += 1
+            put(event, time_left,
+                p1.health, p1.position, p2.health, p2.position)
+            active = True
+        for attacker, defender, attack, defense in (
+            (p1, p2, p1_attacks[p1c], p2c),
+            (p2, p1, p2_attacks[p2c], p1c),
+        ):
+            if attack is not None:
+                active = True
+                damage = None
+                if p1.position != p2.position:
+                    event = attack.unreachable_event
+                else:
+                    event, damage_range, guard = attack.outcomes[defense]
+                    defender.guard_count += guard
+                    if damage_range is not None:
+                        damage = randrange(*damage_range)
+                        inflict_damage(attacker, defender, damage)
+                put(event, time_left,
+                    p1.health, p1.position, p2.health, p2.position, damage)
+            if defender.health <= 0:
+                put(EVENT_CODES[f'p{attacker.player_number + 1}_victory_ko'],
+                    time_left, p1.health, p1.position, p2.health, p2.position)
+                return attacker.player_number, record
+        if not active:
+            put(idle, time_left,
+                p1.health, p1.position, p2.health, p2.position)
+        time_left -= 1
+    if time_left < 0:
+        time_left = 0
+    if p1.health == p2.health:
+        event, winner = 'draw', None
+    elif p1.health > p2.health:
+        event, winner = 'p1_victory_time_over', 0
+    else:
+        event, winner = 'p2_victory_time_over', 1
+    put(EVENT_CODES[event], time_left,
+        p1.health, p1.position, p2.health, p2.position)
+    return winner, record
+
+
+def random_case(
+    rng: random.Random
+) -> typing.Tuple[App, typing.List[int], typing.List[int]]:
+    """A random configuration and actions of both players, which fail now
+    and then, for :func:`check_equivalence`."""
+    hit_point_min = rng.randrange(1, 30)
+    guard_min = rng.randrange(0, hit_point_min)
+    p1_position = rng.randrange(-3, 3)
+    app = App({'game': {
+        'duration': rng.choice([0, 1, 5, 30, 100]),
+        'hit_point_min': hit_point_min,
+        'hit_point_max': hit_point_min + rng.randrange(1, 10),
+        'hit_point_guard_min': guard_min,
+        'hit_point_guard_max': guard_min + rng.randrange(1, 10),
+        'p1_initial_position': p1_position,
+        'p2_initial_position': p1_position + rng.randrange(0, 6),
+        'concurrent_turns': rng.random() < 0.5,
+    }})
+    # Players mostly stick to a few actions, so that the diversity
+    # multipliers and the guard counts come into play.
+    failure_rate = rng.choice([0, 0, 0.001, 0.02])
+    actions = []
+    for _ in range(2):
+        choices = rng.sample(range(len(ACTIONS)), rng.randrange(1, 5))
+        actions.append([
+            FAILED if rng.random() < failure_rate else rng.choice(choices)
+            for _ in range(app.game_round_time + 1)
+        ])
+    return app, actions[0], actions[1]
+
+
+def check_equivalence(count: int=1000,
+                      seed: typing.Optional[int]=None) -> typing.List[int]:
+    """Play ``count`` random rounds with both :func:`play_round` and
+    :func:`~.game.evaluate`, and return the indices of the rounds whose
+    winners or records differ."""
+    rng = random.Random(seed)
+    different = []
+    for i in range(count):
+        app, p1_actions, p2_actions = random_case(rng)
+        round_seed = rng.getrandbits(32)
+        results = []
+        for play in (play_round, evaluate):
+            winner, record = play(
+                app.game_rules if play is play_round else app,
+                ReplayAgent(p1_actions), ReplayAgent(p2_actions),
+                [], seed=round_seed
+            )
+            results.append((winner, record.encode(), record.encode_actions()))
+        if results[0] != results[1]:
+            different.append(i)
+    return different
+
+
+def test():
+    import argparse
+    import sys
+    import time
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('count', type=int, nargs='?', default=1000,
+                        help='random rounds to compare')
+    count = parser.parse_args().count
+    different = check_equivalence(count, seed=0)
+    print(f'{count - len(different)}/{count} random rounds are the same')
+    app = App({'game': {'duration': 1000}})
+    for name, play in (('reference', evaluate),
+                       ('table', play_round)):
+        rules = app if play is evaluate else app.game_rules
+        rng = random.Random(0)
+        started_at = time.perf_counter()
+        ticks = 0
+        for _ in range(20):
+            actions = [[rng.randrange(len(ACTIONS)) for _ in range(1001)]
+                       for _ in range(2)]
+            _, record = play(rules, ReplayAgent(actions[0]),
+                             ReplayAgent(actions[1]), [],
+                             seed=rng.getrandbits(32))
+            ticks += len(record.p1_actions)
+        elapsed = time.perf_counter() - started_at
+        print(f'{name}: {ticks / elapsed:.0f} ticks/s')
+    if different:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,374 @@
+"""Match trees: loading them for :func:`~.util.build_match_tree`, and
+caching them.
+
+A tree is loaded by a single query of the matches whose terminal match it
+is, which returns them with the names of their players and their winners
+as :class:`TreeNode` rows rather than ORM objects.  :func:`walk_match_tree`
+builds the tree the way it used to be built, following the relationships
+of matches one lazy load at a time, and :func:`check_queries` makes sure
+both build the same trees, the former with a few queries however large
+the tree is::
+
+    $ python -m pycon2018.tree local.toml
+
+A tree only changes when one of its matches is disclosed or its bracket is
+made or cleared, but it's asked for by every spectator of the tournament.
+:class:`TreeCache` keeps trees by the id of their terminal match, whether
+they're of the final bracket, and whether everything is disclosed, until
+the web server invalidates the terminal match on any of those changes.
+Building a tree takes a lock of its key, so that a crowd of spectators
+asking for a tree which was just invalidated waits for a single build and
+shares it.
+
+"""
+import argparse
+import collections
+import pathlib
+import sys
+import threading
+import typing
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, aliased
+
+from .entities import (Match, Submission, Tournament, TournamentMatchSet,
+                       TournamentMatchSetItem, User)
+
+__all__ = ('TreeCache', 'TreeKey', 'TreeNode', 'build_tree', 'check_queries',
+           'load_tree_nodes', 'walk_match_tree')
+
+
+#: The id of the terminal match, whether it's the final bracket, and
+#: whether everything is disclosed.
+TreeKey = typing.Tuple[uuid.UUID, bool, bool]
+
+Tree = typing.List[typing.Mapping[str, typing.Any]]
+
+#: How many queries :func:`~.util.build_match_tree` may take at most: the
+#: tree, and for the final bracket its group names.
+MAX_QUERIES = 2
+
+
+class TreeNode(typing.NamedTuple):
+    """A match of a tree, with what it takes to show it."""
+
+    id: uuid.UUID
+    p1_parent_id: typing.Optional[uuid.UUID]
+    p2_parent_id: typing.Optional[uuid.UUID]
+    iteration: int
+    disclosed: bool
+    tournament_id: typing.Optional[uuid.UUID]
+    p1_id: typing.Optional[uuid.UUID]
+    p1_name: typing.Optional[str]
+    p1_set_id: typing.Optional[uuid.UUID]
+    p2_id: typing.Optional[uuid.UUID]
+    p2_name: typing.Optional[str]
+    p2_set_id: typing.Optional[uuid.UUID]
+    winner_id: typing.Optional[uuid.UUID]
+    winner_name: typing.Optional[str]
+
+
+def load_tree_nodes(
+    session: Session, terminal_id: uuid.UUID
+) -> typing.Dict[uuid.UUID, TreeNode]:
+    """Every match under the terminal match, including itself, by id."""
+    columns = []
+    joins = []
+    for name in ('p1', 'p2', 'winner'):
+        item = aliased(TournamentMatchSetItem, name=f'{name}_item')
+        submission = aliased(Submission, name=f'{name}_submission')
+        user = aliased(User, name=f'{name}_user')
+        columns.append(user.display_name)
+        if name != 'winner':
+            columns.append(item.tournament_match_set_id)
+        joins.extend([
+            (item, getattr(Match, f'{name}_id') == item.id),
+            (submission, item.submission_id == submission.id),
+            (user, submission.user_id == user.id),
+        ])
+    query = session.query(
+        Match.id, Match.p1_parent_id, Match.p2_parent_id, Match.iteration,
+        Match.disclosed, Match.tournament_id, Match.p1_id, Match.p2_id,
+        Match.winner_id, *columns
+    )
+    for target, condition in joins:
+        query = query.outerjoin(target, condition)
+    query = query.filter(Match.terminal_id == terminal_id)
+    nodes = {}
+    for (id, p1_parent_id, p2_parent_id, iteration, disclosed, tournament_id,
+         p1_id, p2_id, winner_id, p1_name, p1_set_id, p2_name, p2_set_id,
+         winner_name) in query:
+        nodes[id] = TreeNode(
+            id=id, p1_parent_id=p1_parent_id, p2_parent_id=p2_parent_id,
+            iteration=iteration, disclosed=disclosed,
+            tournament_id=tournament_id,
+            p1_id=p1_id, p1_name=p1_name, p1_set_id=p1_set_id,
+            p2_id=p2_id, p2_name=p2_name, p2_set_id=p2_set_id,
+            winner_id=winner_id, winner_name=winner_name,
+        )
+    return nodes
+
+
+def build_tree(
+    nodes: typing.Mapping[uuid.UUID, TreeNode], terminal_id: uuid.UUID,
+    group_names: typing.Optional[typing.Mapping[uuid.UUID, str]],
+    full_disclosure: bool
+) -> Tree:
+    """The tree :func:`~.util.build_match_tree` returns, from the
+    ``nodes`` :func:`load_tree_nodes` loaded.  Players are labeled with
+    their ``group_names`` for the final bracket, or else :const:`None`."""
+    terminal = nodes[terminal_id]
+    nodes_by_iteration = collections.defaultdict(list)
+
+    def traverse(node: TreeNode):
+        nodes_by_iteration[node.iteration].append(node)
+        if node.p1_parent_id:
+            traverse(nodes[node.p1_parent_id])
+        if node.p2_parent_id:
+            traverse(nodes[node.p2_parent_id])
+    traverse(terminal)
+    result = []
+    group_disclosed = True
+    for i in range(terminal.iteration + 1):
+        iteration_nodes = nodes_by_iteration[i]
+        for node in iteration_nodes:
+            item = {
+                'id': str(node.id),
+                'round': 2 ** (terminal.iteration + 1 - node.iteration),
+                'p1': '?',
+                'p1_group': None,
+                'p2': '?',
+                'p2_group': None,
+                'winner': '?'
+            }
+            if node.disclosed or group_disclosed or full_disclosure:
+                for player in ('p1', 'p2'):
+                    if getattr(node, f'{player}_id'):
+                        item[player] = getattr(node, f'{player}_name')
+                        if group_names is not None:
+                            item[f'{player}_group'] = group_names[
+                                getattr(node, f'{player}_set_id')
+                            ]
+                    else:
+                        item[player] = None
+            if node.disclosed or full_disclosure:
+                item['winner'] = node.winner_name if node.winner_id else None
+            result.append(item)
+        group_disclosed = all(node.disclosed for node in iteration_nodes)
+    return result
+
+
+def walk_match_tree(
+        session: Session, terminal, final: bool, full_disclosure: bool
+) -> Tree:
+    """:func:`~.util.build_match_tree` as it used to be, by following the
+    relationships of matches, for :func:`check_queries`."""
+    from .util import get_match_set_group_names
+    matches_by_iteration = {}
+    result = []
+
+    def traverse(node):
+        if node.iteration not in matches_by_iteration:
+            matches_by_iteration[node.iteration] = []
+        matches_by_iteration[node.iteration].append(node)
+        if node.p1_parent:
+            traverse(node.p1_parent)
+        if node.p2_parent:
+            traverse(node.p2_parent)
+    traverse(terminal)
+    group_disclosed = True
+    if final:
+        group_names = get_match_set_group_names(session,
+                                                terminal.tournament_id)
+    for i in range(terminal.iteration + 1):
+        matches = matches_by_iteration[i]
+        for match in matches:
+            item = {
+                'id': str(match.id),
+                'round': 2 ** (terminal.iteration + 1 - match.iteration),
+                'p1': '?',
+                'p1_group': None,
+                'p2': '?',
+                'p2_group': None,
+                'winner': '?'
+            }
+            if match.disclosed or group_disclosed or full_disclosure:
+                if match.p1:
+                    item['p1'] = match.p1.submission.user.display_name
+                    if final:
+                        item['p1_group'] = group_names[
+                            match.p1.tournament_match_set.id
+                        ]
+                else:
+                    item['p1'] = None
+                if match.p2:
+                    item['p2'] = match.p2.submission.user.display_name
+                    if final:
+                        item['p2_group'] = group_names[
+                            match.p2.tournament_match_set.id
+                        ]
+                else:
+                    item['p2'] = None
+            if match.disclosed or full_disclosure:
+                if match.winner:
+                    item['winner'] = match.winner.submission.user.display_name
+                else:
+                    item['winner'] = None
+            result.append(item)
+        group_disclosed = all(map(lambda x: x.disclosed, matches))
+    return result
+
+
+class TreeCache:
+    """The most recently used ``size`` trees by :data:`TreeKey`."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: typing.MutableMapping[TreeKey, Tree] = \
+            collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.building: typing.Dict[TreeKey, threading.Lock] = {}
+        # Bumped by every invalidation of a terminal match, so that a build
+        # which read the database before it isn't kept.
+        self.generations: typing.Dict[uuid.UUID, int] = \
+            collections.defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: TreeKey, build: typing.Callable[[], Tree]) -> Tree:
+        """The tree of ``key``, which ``build`` makes if it isn't cached.
+        Only one build of the same key runs at a time; the others wait for
+        it instead of building the same tree again."""
+        with self.lock:
+            tree = self.lookup(key)
+            if tree is not None:
+                self.hits += 1
+                return tree
+            building = self.building.setdefault(key, threading.Lock())
+        with building:
+            with self.lock:
+                tree = self.lookup(key)
+                if tree is not None:
+                    self.hits += 1
+                    return tree
+                self.misses += 1
+                generation = self.generations[key[0]]
+            try:
+                tree = build()
+                with self.lock:
+                    if self.generations[key[0]] == generation:
+                        self.entries[key] = tree
+                        while len(self.entries) > self.size:
+                            self.entries.popitem(last=False)
+            finally:
+                with self.lock:
+                    if self.building.get(key) is building:
+                        del self.building[key]
+        return tree
+
+    def lookup(self, key: TreeKey) -> typing.Optional[Tree]:
+        tree = self.entries.get(key)
+        if tree is not None:
+            self.entries.move_to_end(key)
+        return tree
+
+    def invalidate(self, terminal_id: uuid.UUID):
+        """Forget every tree of the terminal match."""
+        with self.lock:
+            self.generations[terminal_id] += 1
+            self.invalidations += 1
+            for key in [key for key in self.entries if key[0] == terminal_id]:
+                del self.entries[key]
+
+    def stats(self) -> typing.Mapping[str, int]:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'capacity': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'building': len(self.building),
+            }
+
+
+def count_queries(session: Session,
+                  function: typing.Callable[[], typing.Any]
+                  ) -> typing.Tuple[typing.Any, int]:
+    """Call ``function``, and return what it returns and how many queries
+    it took."""
+    queries = []
+
+    def count(*args):
+        queries.append(args)
+    engine = session.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        result = function()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return result, len(queries)
+
+
+def check_queries(session: Session) -> typing.List[str]:
+    """Build the tree of every bracket with both
+    :func:`~.util.build_match_tree` and :func:`walk_match_tree`, and
+    return the problems: trees which differ, and builds which took more
+    than :const:`MAX_QUERIES` queries."""
+    from .util import build_match_tree
+    brackets = [(terminal_id, True) for terminal_id, in session.query(
+        Tournament.final_match_id
+    ).filter(Tournament.final_match_id.isnot(None))]
+    brackets.extend((terminal_id, False) for terminal_id, in session.query(
+        TournamentMatchSet.final_match_id
+    ).filter(TournamentMatchSet.final_match_id.isnot(None)))
+    problems = []
+    for terminal_id, final in brackets:
+        for full_disclosure in (False, True):
+            trees = []
+            for build in (build_match_tree, walk_match_tree):
+                # Both start from the terminal match alone, as web requests
+                # do.
+                session.expunge_all()
+                session.info.pop('group_names', None)
+                terminal = session.query(Match).get(terminal_id)
+                tree, queries = count_queries(session, lambda: build(
+                    session, terminal, final, full_disclosure
+                ))
+                trees.append(tree)
+                print(f'{terminal_id} final={final} '
+                      f'full_disclosure={full_disclosure} '
+                      f'{build.__name__}: {len(tree)} matches, '
+                      f'{queries} queries')
+                if build is build_match_tree and queries > MAX_QUERIES:
+                    problems.append(f'{terminal_id}: {queries} queries')
+            if trees[0] != trees[1]:
+                problems.append(f'{terminal_id}: trees differ')
+    return problems
+
+
+def main():
+    from .app import App
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', type=pathlib.Path)
+    args = parser.parse_args()
+    if not args.config.is_file():
+        parser.error('file not found: {!s}'.format(args.config))
+    app = App.from_path(args.config)
+    # Without the group name cache of the app, so that every build loads
+    # what it needs.
+    session = Session(bind=app.database_engine)
+    try:
+        problems = check_queries(session)
+    finally:
+        session.close()
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,9 @@ import os
 import stat
 import string
 import tempfile
+import threading
 import typing
+import uuid
 
 from sqlalchemy.orm import Session
 
@@ -19,59 +21,21 @@ def ngroup(n: int, iterable: typing.Iterable[typing.Any], fillvalue=None):
 def build_match_tree(
         session: Session, terminal, final: bool, full_disclosure: bool
 ) -> typing.Mapping[int, typing.Any]:
-    matches_by_iteration = {}
-    result = []
-
-    def traverse(node):
-        if node.iteration not in matches_by_iteration:
-            matches_by_iteration[node.iteration] = []
-        matches_by_iteration[node.iteration].append(node)
-        if node.p1_parent:
-            traverse(node.p1_parent)
-        if node.p2_parent:
-            traverse(node.p2_parent)
-    traverse(terminal)
-    group_disclosed = True
-    if final:
-        group_names = get_match_set_group_names(session,
-                                                terminal.match_set.tournament)
-    for i in range(terminal.iteration + 1):
-        matches = matches_by_iteration[i]
-        for match in matches:
-            item = {
-                'id': str(match.id),
-                'round': 2 ** (terminal.iteration + 1 - match.iteration),
-                'p1': '?',
-                'p1_group': None,
-                'p2': '?',
-                'p2_group': None,
-                'winner': '?'
-            }
-            if match.disclosed or group_disclosed or full_disclosure:
-                if match.p1:
-                    item['p1'] = match.p1.submission.user.display_name
-                    if final:
-                        item['p1_group'] = group_names[
-                            match.p1.tournament_match_set.id
-                        ]
-                else:
-                    item['p1'] = None
-                if match.p2:
-                    item['p2'] = match.p2.submission.user.display_name
-                    if final:
-                        item['p2_group'] = group_names[
-                            match.p2.tournament_match_set.id
-                        ]
-                else:
-                    item['p2'] = None
-            if match.disclosed or full_disclosure:
-                if match.winner:
-                    item['winner'] = match.winner.submission.user.display_name
-                else:
-                    item['winner'] = None
-            result.append(item)
-        group_disclosed = all(map(lambda x: x.disclosed, matches))
-    return result
+    """The matches of the bracket under the ``terminal`` match, by round,
+    with what spectators may see of them.  It takes a constant number of
+    queries; see :mod:`.tree`."""
+    from .tree import build_tree, load_tree_nodes
+    nodes = load_tree_nodes(session, terminal.id)
+    group_names = None
+    if final and terminal.id in nodes:
+        set_ids = {set_id
+                   for node in nodes.values()
+                   for set_id in (node.p1_set_id, node.p2_set_id)
+                   if set_id is not None}
+        group_names = get_match_set_group_names(
+            session, nodes[terminal.id].tournament_id, set_ids
+        )
+    return build_tree(nodes, terminal.id, group_names, full_disclosure)
 
 
 def make_tempfile_public(temp: tempfile.TemporaryFile):
@@ -80,13 +44,46 @@ def make_tempfile_public(temp: tempfile.TemporaryFile):
     )
 
 
-def get_match_set_group_names(
-    session: Session, tournament
+class GroupNameCache:
+    """The group names of match sets by the ids of their tournaments, kept
+    across requests.  They only change when a match set is added to a
+    tournament, which should :meth:`invalidate` them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.generations = collections.Counter()
+
+    def get(
+        self, tournament_id: uuid.UUID
+    ) -> typing.Tuple[typing.Optional[collections.OrderedDict], int]:
+        """The group names of the tournament if they're kept, and the
+        generation to :meth:`put` them back with if they aren't."""
+        with self.lock:
+            return (self.entries.get(tournament_id),
+                    self.generations[tournament_id])
+
+    def put(self, tournament_id: uuid.UUID,
+            group_names: collections.OrderedDict, generation: int):
+        with self.lock:
+            # Names loaded before the tournament was invalidated may miss
+            # the match set which was just added.
+            if self.generations[tournament_id] == generation:
+                self.entries[tournament_id] = group_names
+
+    def invalidate(self, tournament_id: uuid.UUID):
+        with self.lock:
+            self.generations[tournament_id] += 1
+            self.entries.pop(tournament_id, None)
+
+
+def load_match_set_group_names(
+    session: Session, tournament_id: uuid.UUID
 ) -> collections.OrderedDict:
     from .entities import TournamentMatchSet
     az = string.ascii_uppercase
     query = session.query(TournamentMatchSet.id).filter_by(
-        tournament=tournament
+        tournament_id=tournament_id
     ).order_by(TournamentMatchSet.created_at.asc())
     result = collections.OrderedDict()
     for index, (id, ) in enumerate(query):
@@ -98,4 +95,37 @@ def get_match_set_group_names(
     return result
 
 
+def get_match_set_group_names(
+    session: Session, tournament_id: uuid.UUID,
+    match_set_ids: typing.Iterable[uuid.UUID]=()
+) -> collections.OrderedDict:
+    """The group names of the match sets of a tournament.  The session
+    remembers them, and so does the :class:`GroupNameCache` of the app it
+    was made by; they're loaded again if any of ``match_set_ids`` is missing
+    from them, e.g. when another process has just added the match set.
+    Don't modify them."""
+    memo = session.info.setdefault('group_names', {})
+    cache = session.info.get('group_name_cache')
+    group_names = memo.get(tournament_id)
+    generation = None
+    if group_names is None and cache is not None:
+        group_names, generation = cache.get(tournament_id)
+    if group_names is None or not group_names.keys() >= set(match_set_ids):
+        if cache is not None and generation is None:
+            _, generation = cache.get(tournament_id)
+        group_names = load_match_set_group_names(session, tournament_id)
+        if cache is not None:
+            cache.put(tournament_id, group_names, generation)
+    memo[tournament_id] = group_names
+    return group_names
+
+
+def invalidate_match_set_group_names(session: Session,
+                                     tournament_id: uuid.UUID):
+    session.info.get('group_names', {}).pop(tournament_id, None)
+    cache = session.info.get('group_name_cache')
+    if cache is not None:
+        cache.invalidate(tournament_id)
+
+
 utcnow = functools.partial(datetime.datetime.now, datetime.timezone.utc)
@@ -1,12 +1,14 @@
 import datetime
 import functools
+import json
 import random
-import tempfile
+import time
+import typing
 import uuid
 
-from flask import (Blueprint, Flask, abort, current_app as current_flask_app,
-                   g, jsonify, redirect, render_template, request,
-                   url_for)
+from flask import (Blueprint, Flask, Response, abort,
+                   current_app as current_flask_app, g, jsonify, redirect,
+                   render_template, request, stream_with_context, url_for)
 from flask_cdn import CDN
 from flask_login import (LoginManager, current_user, login_required,
                          login_user, logout_user)
@@ -16,17 +18,23 @@ from requests import get, post
 from sassutils.wsgi import SassMiddleware
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.session import Session
-from sqlalchemy.sql.expression import or_
 from werkzeug.local import LocalProxy
 from werkzeug.urls import url_decode
 
 from .app import App
-from .entities import (Audit, Match, Submission, Tournament,
+from .broker import format_event
+from .cache import (iter_cached_matches, run_cached_matches,
+                    run_cached_matches_concurrently)
+from .entities import (Audit, Job, Match, Submission, Tournament,
                        TournamentMatchSet, TournamentMatchSetItem, User)
-from .game import (Action, FixedAgent, RandomAgent, ScriptException,
-                   run_matches)
+from .estimate import estimate, load_player
+from .game import Action, load_match, store_match
+from .jobs import dispatch, enqueue, match_lines, playground_opponent
+from .league import get_standings
+from .metrics import aggregate_metrics
+from .record import Record, dump_match
 from .util import (build_match_tree, get_match_set_group_names,
-                   make_tempfile_public, ngroup, utcnow)
+                   invalidate_match_set_group_names, ngroup)
 
 
 current_app = LocalProxy(lambda: current_flask_app.config['APP'])
@@ -66,16 +74,190 @@ def to_kst(datetime: datetime.datetime):
     return datetime.astimezone(kst).strftime('%Y-%m-%d %H:%M')
 
 
+def format_match_data(records):
+    return dump_match(records, request.args.get('format') == 'compact')
+
+
+def stream_requested() -> bool:
+    return request.args.get('stream') == 'ndjson'
+
+
+def stream_match(
+    p1: typing.Mapping[str, typing.Any], p2: typing.Mapping[str, typing.Any],
+    rounds: typing.Iterator[typing.Tuple[typing.Optional[int], Record]]
+) -> Response:
+    """Stream a match as lines of JSON while its rounds are played (see
+    :func:`~.jobs.match_lines`).  The client can play the first round
+    without waiting for the rest."""
+    compact = request.args.get('format') == 'compact'
+
+    def generate():
+        for line in match_lines(p1, p2, rounds, compact):
+            yield json.dumps(line) + '\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def stream_job(job_id: uuid.UUID) -> Response:
+    """Stream the lines a job publishes (see :attr:`~.entities.Job.progress`)
+    as lines of JSON until it's over.  The job is polled every
+    ``game.job_poll_interval`` seconds, and the database isn't held in
+    between."""
+    app = current_app._get_current_object()
+
+    def generate():
+        sent = 0
+        deadline = time.monotonic() + app.game_job_timeout
+        while True:
+            db = app.create_session()
+            try:
+                job = db.query(Job).filter_by(id=job_id).one()
+                status, result = job.status, job.result
+                progress = job.progress or []
+            finally:
+                db.close()
+            for line in progress[sent:]:
+                yield json.dumps(line) + '\n'
+            sent = len(progress)
+            if status in ('done', 'failed'):
+                if not progress or \
+                   progress[-1]['type'] not in ('result', 'error'):
+                    yield json.dumps(dict(result or {}, type='error')) + '\n'
+                return
+            elif time.monotonic() > deadline:
+                yield json.dumps({'type': 'error', 'result': 'failed',
+                                  'error': 'timeout'}) + '\n'
+                return
+            time.sleep(app.game_job_poll_interval)
+    return Response(generate(), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+def get_match_tree(terminal: Match, final: bool,
+                   full_disclosure: bool=False) -> list:
+    """:func:`~.util.build_match_tree` through
+    :attr:`~.app.App.tree_cache`."""
+    return current_app.tree_cache.get(
+        (terminal.id, final, full_disclosure),
+        lambda: build_match_tree(session, terminal, final, full_disclosure)
+    )
+
+
+def invalidate_match_tree(terminal: Match):
+    current_app.tree_cache.invalidate(terminal.id)
+
+
+def get_tournament_tree(tournament: Tournament) -> list:
+    if tournament.final_match is None:
+        return []
+    return get_match_tree(tournament.final_match, True)
+
+
+def get_match_set_tree(mset: TournamentMatchSet) -> list:
+    if mset.final_match is None:
+        return []
+    return get_match_tree(mset.final_match, False)
+
+
+def publish_tournament_tree(tournament: Tournament):
+    current_app.tree_broker.publish(('tournament', tournament.id),
+                                    get_tournament_tree(tournament))
+
+
+def publish_match_set_tree(mset: TournamentMatchSet):
+    current_app.tree_broker.publish(('match_set', mset.id),
+                                    get_match_set_tree(mset))
+
+
+def stream_tree(key, load: typing.Callable[[], list]) -> Response:
+    """Stream the tree of a channel of :attr:`~.app.App.tree_broker` as
+    server-sent events: the whole tree first (unless the client already
+    has it, as told by ``Last-Event-ID`` when it reconnects to the same
+    process), and then what changed every time it changes.  The events
+    don't touch the database, which is released as soon as the stream
+    starts; a subscriber which falls behind is sent the latest tree the
+    broker keeps."""
+    broker = current_app.tree_broker
+    keepalive = current_app.web_event_keepalive
+    last_version = broker.parse_event_id(request.headers.get('Last-Event-ID'))
+    # Subscribe before taking the snapshot, so that no change is missed;
+    # the changes the snapshot already has are skipped below.
+    subscription = broker.subscribe(key)
+    try:
+        version, tree = broker.snapshot(key, load)
+    except Exception:
+        broker.unsubscribe(subscription)
+        raise
+
+    def generate():
+        current = version
+        try:
+            if last_version != current:
+                yield format_event('tree', {'tree': tree},
+                                   broker.event_id(current))
+            while True:
+                item = subscription.get(keepalive)
+                if subscription.stale:
+                    subscription.resync()
+                    current, latest = broker.latest(key)
+                    yield format_event('tree', {'tree': latest},
+                                       broker.event_id(current))
+                elif item is None:
+                    yield ': keepalive\n\n'
+                elif item[0] > current:
+                    current, delta = item
+                    yield format_event('delta', delta,
+                                       broker.event_id(current))
+        finally:
+            broker.unsubscribe(subscription)
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 def run_matches_submission(p1: Submission, p2: Submission):
-    with tempfile.NamedTemporaryFile() as tf1, \
-         tempfile.NamedTemporaryFile() as tf2:
-        make_tempfile_public(tf1)
-        make_tempfile_public(tf2)
-        tf1.write(p1.code.encode('utf-8'))
-        tf1.flush()
-        tf2.write(p2.code.encode('utf-8'))
-        tf2.flush()
-        return run_matches(current_app, tf1.name, tf2.name)
+    return run_cached_matches(current_app._get_current_object(), session,
+                              p1.code, p2.code)
+
+
+def dispatch_job(kind: str, payload: typing.Mapping[str, typing.Any]):
+    return dispatch(current_app._get_current_object(), session, kind,
+                    current_user._get_current_object(), payload,
+                    lambda job: url_for('ep.show_job', job_id=job.id))
+
+
+def run_matches_submissions(
+    pairs: typing.Sequence[typing.Tuple[Submission, Submission]]
+):
+    return run_cached_matches_concurrently(
+        current_app._get_current_object(), session,
+        [(p1.code, p2.code) for p1, p2 in pairs]
+    )
+
+
+def get_submission_metrics(
+    tournament: Tournament
+) -> typing.List[typing.Tuple[Submission, typing.Mapping[str, typing.Any]]]:
+    """The metrics of every submission which played a match of the
+    tournament, slowest (in terms of p99 turn latency) first."""
+    items = session.query(TournamentMatchSetItem).join(
+        TournamentMatchSet
+    ).filter(
+        TournamentMatchSet.tournament == tournament
+    )
+    items = {item.id: item for item in items}
+    matches = session.query(
+        Match.p1_id, Match.p2_id, Match.metrics
+    ).filter(
+        Match.p1_id.in_(list(items)),
+        Match.metrics.isnot(None)
+    )
+    metrics = aggregate_metrics(matches)
+    result = [(items[item_id].submission, m.summary())
+              for item_id, m in metrics.items()]
+    result.sort(key=lambda pair: pair[1]['turn_latency_p99'] or 0,
+                reverse=True)
+    return result
 
 
 @login_manager.user_loader
@@ -168,10 +350,14 @@ def game(tournament_id: uuid.UUID):
 @ep.route('/tournaments/<uuid:tournament_id>/tree')
 def tournament_match_tree(tournament_id: uuid.UUID):
     tournament = session.query(Tournament).filter_by(id=tournament_id).one()
-    return jsonify(
-        result='success',
-        tree=build_match_tree(session, tournament.final_match, True, False)
-    )
+    return jsonify(result='success', tree=get_tournament_tree(tournament))
+
+
+@ep.route('/tournaments/<uuid:tournament_id>/tree/events')
+def tournament_match_tree_events(tournament_id: uuid.UUID):
+    tournament = session.query(Tournament).filter_by(id=tournament_id).one()
+    return stream_tree(('tournament', tournament.id),
+                       lambda: get_tournament_tree(tournament))
 
 
 @ep.route('/match_sets/<uuid:set_id>')
@@ -185,10 +371,14 @@ def game_subtournament(set_id: uuid.UUID):
 @ep.route('/match_sets/<uuid:set_id>/tree')
 def subtournament_match_tree(set_id: uuid.UUID):
     mset = session.query(TournamentMatchSet).filter_by(id=set_id).one()
-    return jsonify(
-        result='success',
-        tree=build_match_tree(session, mset.final_match, False, False)
-    )
+    return jsonify(result='success', tree=get_match_set_tree(mset))
+
+
+@ep.route('/match_sets/<uuid:set_id>/tree/events')
+def subtournament_match_tree_events(set_id: uuid.UUID):
+    mset = session.query(TournamentMatchSet).filter_by(id=set_id).one()
+    return stream_tree(('match_set', mset.id),
+                       lambda: get_match_set_tree(mset))
 
 
 @ep.route('/oauth/authorized')
@@ -245,6 +435,18 @@ def random_match():
     p1s = session.query(Submission).offset(p1o).limit(1).first()
     p2s = session.query(Submission).offset(p2o).limit(1).first()
     assert p1s and p2s
+    p1 = {
+        'display_name': p1s.user.display_name,
+        'avatar': p1s.user.avatar
+    }
+    p2 = {
+        'display_name': p2s.user.display_name,
+        'avatar': p2s.user.avatar
+    }
+    if stream_requested():
+        return stream_match(p1, p2, iter_cached_matches(
+            current_app._get_current_object(), session, p1s.code, p2s.code
+        ))
     winner, data = run_matches_submission(p1s, p2s)
     if winner == 0:
         winner_ = 'p1'
@@ -253,16 +455,10 @@ def random_match():
     else:
         winner_ = None
     result = {
-        'p1': {
-            'display_name': p1s.user.display_name,
-            'avatar': p1s.user.avatar
-        },
-        'p2': {
-            'display_name': p2s.user.display_name,
-            'avatar': p2s.user.avatar
-        },
+        'p1': p1,
+        'p2': p2,
         'winner': winner_,
-        'data': data
+        'data': format_match_data(data)
     }
     return jsonify(**result)
 
@@ -289,7 +485,7 @@ def show_match(match_id: uuid.UUID):
             'avatar': match.p2.submission.user.avatar
         },
         'winner': winner,
-        'data': match.match_data
+        'data': format_match_data(load_match(match.match_data))
     }
     return jsonify(**result)
 
@@ -300,11 +496,15 @@ def disclose_match(match_id: uuid.UUID):
     match = session.query(Match).filter_by(id=match_id).one()
     match.disclosed = True
     session.commit()
-    tournament = match.match_set.tournament
     terminal = match.terminal
-    tree = build_match_tree(
-        session, terminal, terminal is tournament.final_match, False
-    )
+    final = match.match_set_id is None
+    invalidate_match_tree(terminal)
+    tree = get_match_tree(terminal, final)
+    if final:
+        key = 'tournament', match.tournament_id
+    else:
+        key = 'match_set', match.match_set_id
+    current_app.tree_broker.publish(key, tree)
     return jsonify(result='success', tree=tree)
 
 
@@ -312,61 +512,53 @@ def disclose_match(match_id: uuid.UUID):
 @login_required
 def test_submission():
     type = request.form.get('type', 'random')
-    if type == 'clone':
-        pass
-    elif type == 'random':
-        agent = RandomAgent()
-    else:
-        agent = FixedAgent(Action(type))
+    if type not in ('clone', 'random') and type not in Action.__members__:
+        abort(400)
     file = request.files.get('script')
     text = request.form.get('script_text')
     if file is None and text is None:
         return jsonify(result='failed', error='no_input')
-    with tempfile.NamedTemporaryFile() as tf:
-        make_tempfile_public(tf)
-        if file:
-            file.save(tf)
-            file.seek(0)
-            code = file.read().decode('utf-8')
-        else:
-            tf.write(text.encode('utf-8'))
-            code = text
-        tf.flush()
-        audit = Audit(user=current_user, code=code)
-        session.add(audit)
-        session.commit()
-        if type == 'clone':
-            agent = tf.name
-            p2 = {
-                'display_name': current_user.display_name,
-                'avatar': current_user.avatar
-            }
-        else:
-            p2 = {
-                'display_name': 'D0D0B0T',
-                'avatar': url_for('static', filename='images/bot.png')
-            }
-        try:
-            winner, data = run_matches(
-                current_app, tf.name, agent, True
-            )
-        except ScriptException as e:
-            return jsonify(result='failed', error='script_error',
-                           output=e.output or e.message)
-    if winner == 0:
-        winner = 'p1'
-    elif winner == 1:
-        winner = 'p2'
-    match = {
-        'p1': {
+    if file:
+        code = file.read().decode('utf-8')
+    else:
+        code = text
+    audit = Audit(user=current_user, code=code)
+    session.add(audit)
+    session.commit()
+    if type == 'clone':
+        p2 = {
             'display_name': current_user.display_name,
             'avatar': current_user.avatar
-        },
+        }
+    else:
+        p2 = {
+            'display_name': 'D0D0B0T',
+            'avatar': url_for('static', filename='images/bot.png')
+        }
+    p1 = {
+        'display_name': current_user.display_name,
+        'avatar': current_user.avatar
+    }
+    payload = {
+        'code': code,
+        'opponent': type,
+        'p1': p1,
         'p2': p2,
-        'winner': winner,
-        'data': data
+        'compact': request.args.get('format') == 'compact',
     }
-    return jsonify(result='success', match=match)
+    if stream_requested():
+        # With game.job_queue on, a worker plays the match and publishes
+        # its rounds, which are streamed from the job.
+        app = current_app._get_current_object()
+        if app.game_job_queue:
+            job = enqueue(session, 'test', current_user._get_current_object(),
+                          dict(payload, stream=True))
+            return stream_job(job.id)
+
+        return stream_match(p1, p2, iter_cached_matches(
+            app, session, code, playground_opponent(code, type), True
+        ))
+    return jsonify(**dispatch_job('test', payload))
 
 
 @ep.route('/tournaments/<uuid:tournament_id>/submission', methods=['POST'])
@@ -377,37 +569,21 @@ def submit(tournament_id: uuid.UUID):
     file = request.files.get('script')
     if file is None:
         return jsonify(result='failed', error='no_file_input')
-    with tempfile.NamedTemporaryFile() as tf:
-        make_tempfile_public(tf)
-        file.save(tf)
-        tf.flush()
-        try:
-            winner, data = run_matches(
-                current_app, tf.name,
-                FixedAgent(Action.idle)
-            )
-            if winner != 0:
-                return jsonify(result='failed', error='test_not_passed')
-        except ScriptException as e:
-            return jsonify(result='failed', error='error_in_code',
-                           output=e.output)
-        tf.seek(0)
-        data = tf.read().decode('utf-8')
-    submission = session.query(Submission).filter_by(
-        user=current_user,
-        tournament=tournament
-    ).one_or_none()
-    if submission:
-        submission.code = data
-        submission.created_at = utcnow()
-    else:
-        submission = Submission(tournament=tournament, user=current_user,
-                                code=data)
-        session.add(submission)
-    audit = Audit(user=current_user, code=data)
-    session.add(audit)
-    session.commit()
-    return jsonify(result='success')
+    data = file.read().decode('utf-8')
+    return jsonify(**dispatch_job('submit', {
+        'code': data,
+        'tournament_id': str(tournament.id),
+    }))
+
+
+@ep.route('/jobs/<uuid:job_id>')
+@login_required
+def show_job(job_id: uuid.UUID):
+    """The status of a job, and its response once it's done."""
+    job = session.query(Job).filter_by(id=job_id).one()
+    if job.user_id != current_user.id and not current_user.moderator:
+        abort(404)
+    return jsonify(result='success', status=job.status, response=job.result)
 
 
 @admin.route('/tournaments/<uuid:tournament_id>', methods=['GET'])
@@ -422,15 +598,27 @@ def tournament(tournament_id: uuid.UUID):
         Submission.tournament == tournament
     ).order_by(Submission.created_at)
     if tournament.final_match:
-        tree = build_match_tree(
-            session, tournament.final_match, True, True
-        )
+        tree = get_match_tree(tournament.final_match, True, True)
     else:
         tree = None
-    group_names = get_match_set_group_names(session, tournament)
+    group_names = get_match_set_group_names(session, tournament.id)
     return render_template('admin/tournament.html', tournament=tournament,
                            submissions_without_match=submissions_without_match,
-                           tree=tree, range=range, group_names=group_names)
+                           tree=tree, range=range, group_names=group_names,
+                           metrics=get_submission_metrics(tournament))
+
+
+@admin.route('/tournaments/<uuid:tournament_id>/metrics')
+def tournament_metrics(tournament_id: uuid.UUID):
+    tournament = session.query(Tournament).filter_by(
+        id=tournament_id
+    ).one()
+    return jsonify(result='success', metrics=[
+        dict(summary,
+             submission_id=str(submission.id),
+             display_name=submission.user.display_name)
+        for submission, summary in get_submission_metrics(tournament)
+    ])
 
 
 @admin.route('/tournaments/<uuid:tournament_id>/match_sets',
@@ -455,21 +643,84 @@ def create_match_set(tournament_id: uuid.UUID):
     session.add(set)
     session.add_all(items)
     session.commit()
+    invalidate_match_set_group_names(session, tournament_id)
     return redirect(url_for('.tournament', tournament_id=tournament_id))
 
 
+@admin.route('/tournaments/<uuid:tournament_id>/league', methods=['GET'])
+def league(tournament_id: uuid.UUID):
+    tournament = session.query(Tournament).filter_by(
+        id=tournament_id
+    ).one()
+    standings = get_standings(session, tournament)
+    if request.args.get('format') == 'json':
+        return jsonify(result='success', standings=[
+            {
+                'submission_id': str(rating.submission_id),
+                'display_name': rating.submission.user.display_name,
+                'rating': rating.rating,
+                'wins': rating.wins,
+                'losses': rating.losses,
+                'draws': rating.draws,
+                'updated_at': rating.updated_at.isoformat(),
+            }
+            for rating in standings
+        ])
+    job_id = request.args.get('job_id', type=uuid.UUID)
+    job = job_id and session.query(Job).filter_by(
+        id=job_id, kind='league'
+    ).one_or_none()
+    return render_template('admin/league.html', tournament=tournament,
+                           standings=standings, job=job)
+
+
+@admin.route('/tournaments/<uuid:tournament_id>/league', methods=['POST'])
+def run_league(tournament_id: uuid.UUID):
+    tournament = session.query(Tournament).filter_by(
+        id=tournament_id
+    ).one()
+    response = dispatch_job('league', {'tournament_id': str(tournament.id)})
+    return redirect(url_for('.league', tournament_id=tournament_id,
+                            job_id=response.get('job_id')))
+
+
 @admin.route('/submissions/<uuid:submission_id>')
 def submission(submission_id: uuid.UUID):
     submission = session.query(Submission).filter_by(id=submission_id).one()
     return render_template('admin/submission.html', submission=submission)
 
 
+@admin.route('/submissions/<uuid:submission_id>/estimate')
+def estimate_submission(submission_id: uuid.UUID):
+    """Stream the estimate of how strong the submission is against the
+    ``opponent`` (another submission's id, ``random`` or an action) as
+    lines of JSON, until it's decided."""
+    submission = session.query(Submission).filter_by(id=submission_id).one()
+    opponent = request.args.get('opponent', 'random')
+    try:
+        opponent_id = uuid.UUID(opponent)
+    except ValueError:
+        if opponent != 'random' and opponent not in Action.__members__:
+            abort(400)
+        p2 = load_player(opponent)
+    else:
+        p2 = session.query(Submission).filter_by(id=opponent_id).one().code
+    max_matches = request.args.get('max_matches', type=int)
+    app = current_app._get_current_object()
+
+    def generate():
+        for result in estimate(app, submission.code, p2, max_matches):
+            yield json.dumps(result.to_json()) + '\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
 @admin.route('/match_sets/<uuid:set_id>')
 def match_set(set_id: uuid.UUID):
     mset = session.query(TournamentMatchSet).filter_by(id=set_id).one()
     if not mset.final_match:
         abort(404)
-    tree = build_match_tree(session, mset.final_match, False, True)
+    tree = get_match_tree(mset.final_match, False, True)
     print(tree)
     return render_template('admin/match_set.html', match_set=mset,
                            tree=tree, range=range)
@@ -484,29 +735,38 @@ def create_matches(set_id: uuid.UUID):
     subs = [(i, None) for i in mset.items]
     level = 0
     match = None
+    matches = []
     while len(subs) > 1:
-        pairs = ngroup(2, subs, fillvalue=(None, None))
+        pairs = list(ngroup(2, subs, fillvalue=(None, None)))
+        results = iter(run_matches_submissions([
+            (p1.submission, p2.submission)
+            for (p1, _), (p2, __) in pairs
+            if p1 is not None and p2 is not None
+        ]))
         nsubs = []
-        for pair in pairs:
+        for position, pair in enumerate(pairs):
             match = Match(
                 p1=pair[0][0],
                 p2=pair[1][0],
                 p1_parent=pair[0][1],
                 p2_parent=pair[1][1],
                 iteration=level,
-                match_data=[]
+                match_data=[],
+                tournament_id=mset.tournament_id,
+                match_set_id=mset.id,
+                position=position
             )
             if pair[0][0] is not None and pair[1][0] is not None:
-                winner, data = run_matches_submission(
-                    pair[0][0].submission, pair[1][0].submission
-                )
+                winner, data, metrics = next(results)
                 if winner is not None:
                     nsubs.append((pair[winner][0], match))
                     wm = pair[winner][0]
                 else:
                     nsubs.append((None, match))
                     wm = None
-                match.match_data = data
+                match.match_data = store_match(current_app, data)
+                if metrics is not None:
+                    match.metrics = metrics.to_json()
             else:
                 if pair[0][0]:
                     nsubs.append((pair[0][0], match))
@@ -515,21 +775,32 @@ def create_matches(set_id: uuid.UUID):
                     nsubs.append((pair[1][0], match))
                     wm = pair[1][0]
                 else:
-                    subs.append((None, match))
+                    nsubs.append((None, match))
                     wm = None
             match.winner = wm
             session.add(match)
+            matches.append(match)
         level += 1
         subs.clear()
         subs.extend(nsubs)
     if len(subs) == 1 and match:
         mset.final_match = match
+        set_bracket_terminal(matches, match)
         session.commit()
+        invalidate_match_tree(match)
+        publish_match_set_tree(mset)
     else:
         abort(500)
     return redirect(url_for('.tournament', tournament_id=mset.tournament.id))
 
 
+def set_bracket_terminal(matches: typing.Sequence[Match], terminal: Match):
+    session.flush()
+    for match in matches:
+        match.terminal_id = terminal.id
+        match.depth = terminal.iteration - match.iteration
+
+
 @admin.route('/tournaments/<uuid:tournament_id>/create_matches')
 def finalize_matches(tournament_id: uuid.UUID):
     tournament = session.query(Tournament).filter_by(id=tournament_id).one()
@@ -537,31 +808,40 @@ def finalize_matches(tournament_id: uuid.UUID):
         if match_set.final_match is None:
             abort(400)
     level = 0
+    match = None
+    matches = []
     msets = [(i, None) for i in tournament.match_sets]
     while len(msets) > 1:
-        pairs = ngroup(2, msets, fillvalue=(None, None))
+        pairs = list(ngroup(2, msets, fillvalue=(None, None)))
+        results = iter(run_matches_submissions([
+            (p1.final_match.winner.submission,
+             p2.final_match.winner.submission)
+            for (p1, _), (p2, __) in pairs
+            if p1 is not None and p2 is not None
+        ]))
         lmsets = []
-        for pair in pairs:
+        for position, pair in enumerate(pairs):
             match = Match(
                 p1=pair[0][0].final_match.winner if pair[0][0] else None,
                 p2=pair[1][0].final_match.winner if pair[1][0] else None,
                 p1_parent=pair[0][1],
                 p2_parent=pair[1][1],
                 iteration=level,
-                match_data=[]
+                match_data=[],
+                tournament_id=tournament.id,
+                position=position
             )
             if pair[0][0] is not None and pair[1][0] is not None:
-                winner, data = run_matches_submission(
-                    pair[0][0].final_match.winner.submission,
-                    pair[1][0].final_match.winner.submission
-                )
+                winner, data, metrics = next(results)
                 if winner is not None:
                     lmsets.append((pair[winner][0], match))
                     wm = pair[winner][0].final_match.winner
                 else:
                     lmsets.append((None, match))
                     wm = None
-                match.match_data = data
+                match.match_data = store_match(current_app, data)
+                if metrics is not None:
+                    match.metrics = metrics.to_json()
             else:
                 if pair[0][0]:
                     lmsets.append((pair[0][0], match))
@@ -574,30 +854,57 @@ def finalize_matches(tournament_id: uuid.UUID):
                     wm = None
             match.winner = wm
             session.add(match)
+            matches.append(match)
         level += 1
         msets.clear()
         msets.extend(lmsets)
     if len(msets) == 1 and match:
         tournament.final_match = match
+        set_bracket_terminal(matches, match)
         session.commit()
+        invalidate_match_tree(match)
+        publish_tournament_tree(tournament)
     else:
         abort(500)
     return redirect(url_for('.tournament', tournament_id=tournament.id))
 
 
+@admin.route('/pool')
+def pool_stats():
+    return jsonify(result='success', pool=current_app.runner_pool.stats())
+
+
+@admin.route('/tree_broker')
+def tree_broker_stats():
+    return jsonify(result='success',
+                   tree_broker=current_app.tree_broker.stats())
+
+
+@admin.route('/tree_cache')
+def tree_cache_stats():
+    return jsonify(result='success', tree_cache=current_app.tree_cache.stats())
+
+
+@admin.route('/result_cache')
+def result_cache_stats():
+    return jsonify(result='success',
+                   result_cache=current_app.result_cache.stats())
+
+
 @admin.route('/match_sets/<uuid:set_id>/clear')
 def clear_matches(set_id: uuid.UUID):
     mset = session.query(TournamentMatchSet).filter_by(id=set_id).one()
     if not mset.tournament.final_match:
-        tmsis = [x.id for x in session.query(TournamentMatchSetItem).filter(
-            TournamentMatchSetItem.tournament_match_set == mset
-        )]
+        terminal = mset.final_match
         mset.final_match = None
         session.flush()
-        session.query(Match).filter(or_(
-            Match.p1_id.in_(tmsis), Match.p2_id.in_(tmsis)
-        )).delete(synchronize_session='fetch')
+        session.query(Match).filter_by(
+            match_set_id=mset.id
+        ).delete(synchronize_session='fetch')
         session.commit()
+        if terminal is not None:
+            invalidate_match_tree(terminal)
+        publish_match_set_tree(mset)
     return redirect(url_for('.tournament', tournament_id=mset.tournament.id))
 
 
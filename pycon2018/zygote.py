@@ -0,0 +1,176 @@
+"""Client of the zygote mode of :prog:`script_runner` (``--zygote``), which
+forks runners from a process that has already booted the interpreter and
+imported the permitted modules instead of executing a new one.
+
+It is used by :func:`~.game.spawn_runner` when ``game.zygote`` is on.
+
+"""
+import array
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+import stat
+import subprocess
+import tempfile
+import time
+import typing
+
+__all__ = 'Zygote', 'ZygoteProcess'
+
+
+class ZygoteProcess:
+    """A runner forked by the zygote.  It has the part of the interface of
+    :class:`subprocess.Popen` the evaluator uses: :attr:`stdin`,
+    :attr:`stdout`, :attr:`stderr`, :meth:`poll`, :meth:`wait` and
+    :meth:`terminate`.
+
+    Since the runner is a child of the zygote rather than of the
+    evaluator, its exit status and resource usage are reported over the
+    control connection, and shutting the connection down terminates it.
+
+    """
+
+    def __init__(self, connection: socket.socket, stdin, stdout, stderr):
+        self.connection = connection
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.buffer = b''
+        self.pid = None
+        self.returncode = None
+        #: CPU time and maximum resident set size, once it has exited.
+        self.cpu_time = None
+        self.max_rss = None
+        self.read_status(None)
+        if self.pid is None:
+            raise OSError('the zygote did not fork a runner')
+
+    def read_status(self, timeout: typing.Optional[float]):
+        """Read the messages of the zygote which are available within
+        ``timeout`` seconds, or until one arrives if it's :const:`None`."""
+        while self.connection is not None:
+            if b'\n' not in self.buffer:
+                ready, _, __ = select.select([self.connection], [], [],
+                                             timeout)
+                if not ready:
+                    return
+                chunk = self.connection.recv(512)
+                if not chunk:
+                    if self.returncode is None:
+                        self.returncode = -signal.SIGKILL
+                    self.close()
+                    return
+                self.buffer += chunk
+                continue
+            line, _, self.buffer = self.buffer.partition(b'\n')
+            kind, _, value = line.decode().partition(' ')
+            if kind == 'pid':
+                self.pid = int(value)
+                if timeout is None:
+                    return
+            elif kind == 'exit':
+                code, cpu_time, max_rss = value.split()
+                self.returncode = int(code)
+                self.cpu_time = float(cpu_time)
+                self.max_rss = int(max_rss)
+                self.close()
+
+    def poll(self) -> typing.Optional[int]:
+        self.read_status(0)
+        return self.returncode
+
+    def wait(self, timeout: typing.Optional[float]=None) -> int:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.returncode is None:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(str(self.pid), timeout)
+            self.read_status(remaining)
+        return self.returncode
+
+    def terminate(self):
+        """Have the zygote terminate the runner.  Its status can still be
+        waited for with :meth:`wait`."""
+        if self.connection is not None:
+            try:
+                self.connection.shutdown(socket.SHUT_WR)
+            except OSError:
+                self.close()
+
+    kill = terminate
+
+    def close(self):
+        # Without the connection nothing more can be known about the
+        # runner, which the zygote terminates.
+        if self.returncode is None:
+            self.returncode = -signal.SIGTERM
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Zygote:
+    """Starts a zygote with ``command`` (:prog:`script_runner` and its
+    options), and forks runners from it.
+
+    The zygote listens on a socket in a private temporary directory, so
+    it has to run as the same user as the evaluator.
+
+    """
+
+    def __init__(self, command: typing.Sequence[str],
+                 env: typing.Optional[typing.Mapping[str, str]]=None,
+                 startup_timeout: float=10.0):
+        self.directory = tempfile.mkdtemp(prefix='pycon2018-zygote-')
+        os.chmod(self.directory, stat.S_IRWXU)
+        self.path = os.path.join(self.directory, 'zygote.sock')
+        self.handle = subprocess.Popen([*command, '--zygote', self.path],
+                                       stdin=subprocess.DEVNULL, env=env)
+        deadline = time.monotonic() + startup_timeout
+        while not os.path.exists(self.path):
+            if self.handle.poll() is not None:
+                raise OSError('the zygote exited with '
+                              f'{self.handle.returncode}')
+            elif time.monotonic() > deadline:
+                self.close()
+                raise OSError('the zygote did not start')
+            time.sleep(0.01)
+
+    def spawn(self, argv: typing.Sequence[str]) -> ZygoteProcess:
+        """Fork a runner with the arguments ``argv``, with pipes for its
+        standard streams like :class:`subprocess.Popen` makes."""
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+            header = json.dumps({'argv': list(argv)}).encode() + b'\n'
+            fds = array.array('i', [stdin_r, stdout_w, stderr_w])
+            connection.sendmsg(
+                [header],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds.tobytes())]
+            )
+        except OSError:
+            connection.close()
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            raise
+        finally:
+            for fd in (stdin_r, stdout_w, stderr_w):
+                os.close(fd)
+        return ZygoteProcess(connection,
+                             open(stdin_w, 'wb'),
+                             open(stdout_r, 'rb'),
+                             open(stderr_r, 'rb'))
+
+    def close(self):
+        if self.handle.poll() is None:
+            self.handle.terminate()
+            self.handle.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
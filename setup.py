@@ -5,5 +5,8 @@ setup(
     version='0.0.1',
     description='PyCon KR 2018 coding event',
     packages=find_packages(exclude=['migration', 'migration.*']),
-    scripts=['scripts/script_runner']
+    scripts=['scripts/script_runner'],
+    extras_require={
+        'batch': ['numpy >= 1.14'],
+    }
 )
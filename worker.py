@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import multiprocessing
+import pathlib
+import signal
+
+from pycon2018.app import App
+from pycon2018.jobs import work
+
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('-c', '--concurrency', type=int,
+                    help='number of worker processes; game.worker_processes '
+                         'by default')
+parser.add_argument('-d', '--debug', action='store_true', default=False)
+parser.add_argument('--log-file', default='-', help='file to write logs')
+parser.add_argument('config', type=pathlib.Path)
+
+
+def run_worker(config: pathlib.Path):
+    # Every process makes its own app, since database connections and
+    # runner processes can't be shared across a fork.
+    work(App.from_path(config))
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(levelname).1s | %(process)d | %(name)s | %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO,
+        **({} if args.log_file == '-' else {'filename': args.log_file})
+    )
+    if not args.config.is_file():
+        parser.error('file not found: {!s}'.format(args.config))
+    app = App.from_path(args.config)
+    concurrency = args.concurrency or app.game_worker_processes
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(args.config,))
+        for _ in range(concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()